@@ -0,0 +1,324 @@
+'''
+Batch scheduler for the reduction of many targets and epochs.
+
+A manifest lists the reductions to run, one entry per target and epoch:
+
+    [{"target":"SN2017gmr", "epoch":"epoch1", "data_dir":"../data/reduced/2017gmr/epoch1",
+      "raw_dirs":["../data/raw/2017gmr/epoch1_img_obs", "../data/raw/2017gmr/epoch1_img_calib"],
+      "qd":{"use_me":1, "Instrument":"GMOS-S", "CcdBin":"2 2", "RoI":"Full",
+            "Object":"SN2017gmr%", "DateObs":"2018-09-02:2018-09-03"},
+      "nprocesses":2, "memory_mb":4000, "options":{"backend":"native"}},
+     ...]
+
+data_dir is the reduction directory, raw_dirs (optional) the download directories staged
+into it, nprocesses and memory_mb (optional) the CPUs and memory the entry is allowed to
+use, and options (optional) other parameters of GMOS_pipeline.run_pipeline (backend,
+filters, compress, workspace_dir, bias_date_range, ...). db_file (optional) is the name
+of the observation database (default obsLog.sqlite3).
+
+Each entry is reduced by GMOS_pipeline.run_pipeline in its own process. Entries run
+concurrently as long as the sum of their nprocesses and memory_mb stays within the limits
+of run_batch; entries which share a reduction directory run one after the other.
+
+Entries whose bias and flat nodes combine the same frames with the same configuration
+(e.g. several targets observed on the same night) form a calibration group: the master
+calibrations of the group are built once, by a calibration job run before the reductions,
+and stored in the shared calibration cache (GMOS_calibration_cache), from which the
+pipelines of all entries of the group copy them.
+
+The status of every job is written to a JSON status file each time it changes, so the
+progress of a batch can be followed from another session with read_status and
+format_status.
+'''
+import os
+import sys
+import json
+import time
+import queue
+import traceback
+import multiprocessing
+
+import GMOS_iraf_pool
+import GMOS_parallel
+import GMOS_pipeline
+import GMOS_precalibration
+
+#Memory (MB) assumed for entries which don't give memory_mb
+DEFAULT_MEMORY_MB = 2048
+
+STATUS_FILENAME = 'batch_status.json'
+
+#Seconds between checks of the worker processes
+POLL_INTERVAL = 5.
+
+def read_manifest(filename):
+    '''
+    Read a JSON manifest (a list of entries, see the module documentation)
+    '''
+    with open(filename, 'r') as ofile:
+        return json.load(ofile)
+
+def _entry_name(entry):
+    return '{}_{}'.format(entry['target'], entry.get('epoch', ''))
+
+def _pipeline_kwargs(entry, cache_dir):
+    kwargs = dict(entry.get('options', {}))
+    kwargs['cache_dir'] = cache_dir
+    #only used when the raw data are staged (by plan_batch)
+    kwargs.pop('decompress', None)
+    return kwargs
+
+def _db_file(entry):
+    return entry.get('db_file', 'obsLog.sqlite3')
+
+def _is_calibration_node(name):
+    return (name == 'bias') or name.startswith('flat_')
+
+def calibration_signature(entry, pipeline):
+    '''
+    Identify the master calibrations of an entry by the frames and configuration of its
+    bias and flat nodes. Entries with the same signature share their master calibrations.
+    '''
+    options = entry.get('options', {})
+    config = dict((k, entry['qd'].get(k)) for k in ['Instrument', 'CcdBin', 'RoI'])
+    config['backend'] = options.get('backend', 'iraf')
+    config['compress'] = options.get('compress', False)
+    nodes = [(name, sorted(pipeline.nodes[name].inputs)) for name in sorted(pipeline.nodes)
+             if _is_calibration_node(name)]
+    return json.dumps({'config':config, 'nodes':nodes}, sort_keys=True, default=str)
+
+def plan_batch(entries, cache_dir):
+    '''
+    Stage the new downloads and update the observation database of each entry, and
+    group the entries by calibration signature
+
+    Input:
+        entries: list
+            manifest entries
+        cache_dir: str
+            shared calibration cache directory
+    Output:
+        jobs: list
+            a dictionary for each job with its 'name', 'kind' ('calibrate' or 'reduce'),
+            'entry', 'depends' (names of the jobs which must finish first), 'cpus',
+            'memory_mb', and 'data_dir'
+    '''
+    jobs = []
+    calibration_jobs = {}
+    for entry in entries:
+        data_dir = os.path.abspath(entry['data_dir'])
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        if entry.get('raw_dirs'):
+            decompress = entry.get('options', {}).get('decompress', True)
+            GMOS_precalibration.stage_in(entry['raw_dirs'], data_dir, decompress=decompress)
+        GMOS_precalibration.create_observation_database(None, data_dir, database_filename=_db_file(entry))
+        kwargs = _pipeline_kwargs(entry, cache_dir)
+        pipeline = GMOS_pipeline.build_pipeline(dict(entry['qd']), [entry['target']], _db_file(entry),
+                                                data_dir, **kwargs)
+        cpus = entry.get('nprocesses', 1)
+        memory_mb = entry.get('memory_mb', DEFAULT_MEMORY_MB)
+        signature = calibration_signature(entry, pipeline)
+        depends = []
+        if signature not in calibration_jobs:
+            name = 'calibrate_{}'.format(_entry_name(entry))
+            calibration_jobs[signature] = name
+            jobs.append({'name':name, 'kind':'calibrate', 'entry':entry, 'depends':[],
+                         'cpus':cpus, 'memory_mb':memory_mb, 'data_dir':data_dir})
+            print('BATCH {}: building calibrations'.format(_entry_name(entry)))
+        else:
+            print('BATCH {}: sharing calibrations of {}'.format(_entry_name(entry),
+                                                                 calibration_jobs[signature]))
+        depends.append(calibration_jobs[signature])
+        jobs.append({'name':'reduce_{}'.format(_entry_name(entry)), 'kind':'reduce', 'entry':entry,
+                     'depends':depends, 'cpus':cpus, 'memory_mb':memory_mb, 'data_dir':data_dir})
+    return jobs
+
+def build_calibrations(entry, cache_dir):
+    '''
+    Run the bias and flat nodes of the pipeline of an entry, adding the master
+    calibrations to the calibration cache
+    '''
+    data_dir = os.path.abspath(entry['data_dir'])
+    kwargs = _pipeline_kwargs(entry, cache_dir)
+    nprocesses = entry.get('nprocesses', 1)
+    workspace_dir = kwargs.pop('workspace_dir', None)
+    #as in GMOS_pipeline.run_pipeline, IRAF nodes run concurrently on an IrafPool
+    iraf_pool = None
+    if nprocesses > 1 and kwargs.get('iraf_pool') is None and kwargs.get('backend', 'iraf') == 'iraf':
+        iraf_pool = GMOS_iraf_pool.IrafPool(nprocesses)
+        kwargs['iraf_pool'] = iraf_pool
+    pipeline = GMOS_pipeline.build_pipeline(dict(entry['qd']), [entry['target']], _db_file(entry),
+                                            data_dir, **kwargs)
+    calibration = GMOS_pipeline.Pipeline(data_dir)
+    for name in pipeline.nodes:
+        if _is_calibration_node(name):
+            node = pipeline.nodes[name]
+            calibration.add(name, node.inputs, node.outputs, node.func, node.kwargs, clean=node.clean)
+    try:
+        with GMOS_parallel.workspace(workspace_dir):
+            return calibration.run(nthreads=nprocesses)
+    finally:
+        if iraf_pool is not None:
+            iraf_pool.close()
+
+def reduce_entry(entry, cache_dir):
+    '''
+    Run the whole pipeline of an entry (its raw data were staged by plan_batch)
+    '''
+    kwargs = _pipeline_kwargs(entry, cache_dir)
+    return GMOS_pipeline.run_pipeline(dict(entry['qd']), [entry['target']], _db_file(entry),
+                                      os.path.abspath(entry['data_dir']),
+                                      nprocesses=entry.get('nprocesses', 1), **kwargs)
+
+def _run_job(job, cache_dir, log_filename, messages):
+    '''
+    Run a job in a worker process, writing its output to log_filename
+    '''
+    with open(log_filename, 'a') as log:
+        sys.stdout = log
+        sys.stderr = log
+        try:
+            if job['kind'] == 'calibrate':
+                build_calibrations(job['entry'], cache_dir)
+            else:
+                reduce_entry(job['entry'], cache_dir)
+            messages.put((job['name'], None))
+        except BaseException: #including the sys.exit calls of the reduction functions
+            error = traceback.format_exc()
+            log.write(error)
+            messages.put((job['name'], error))
+        finally:
+            log.flush()
+
+def _write_status(status_filename, status):
+    tmp_filename = '{}.tmp'.format(status_filename)
+    with open(tmp_filename, 'w') as ofile:
+        json.dump(status, ofile, indent=1, sort_keys=True)
+    os.rename(tmp_filename, status_filename)
+
+def read_status(status_filename):
+    '''
+    Read the status file of a (running or finished) batch
+    '''
+    with open(status_filename, 'r') as ofile:
+        return json.load(ofile)
+
+def format_status(status):
+    '''
+    Return a summary of a batch status: the number of jobs in each state and a line
+    for each job with its state and run time
+    '''
+    now = time.time()
+    counts = {}
+    lines = []
+    for job in status['jobs']:
+        counts[job['state']] = counts.get(job['state'], 0) + 1
+        if job['start'] is None:
+            elapsed = ''
+        else:
+            elapsed = '{:8.0f} s'.format((job['end'] if job['end'] is not None else now) - job['start'])
+        lines.append('{:40s} {:8s} {}'.format(job['name'], job['state'], elapsed))
+    summary = ', '.join('{} {}'.format(counts[state], state) for state in
+                        ['done', 'running', 'pending', 'failed', 'skipped'] if state in counts)
+    header = 'BATCH {} jobs: {} (cpus {}/{}, memory {}/{} MB)'.format(
+             len(status['jobs']), summary, status['cpus_used'], status['max_cpus'],
+             status['memory_used'], status['max_memory_mb'])
+    return '\n'.join([header] + lines)
+
+def run_batch(entries, cache_dir, max_cpus=None, max_memory_mb=None, status_filename=None,
+              log_dir=None):
+    '''
+    Reduce all entries of a manifest
+
+    Input:
+        entries: list or str
+            manifest entries, or the name of a JSON manifest file
+        cache_dir: str
+            shared calibration cache directory (created if it doesn't exist)
+        max_cpus: int
+            maximum sum of the nprocesses of the running jobs. If None, the number of CPUs
+        max_memory_mb: int
+            maximum sum of the memory_mb of the running jobs. If None, memory isn't limited.
+            A job which exceeds a limit on its own is run when no other job is running
+        status_filename: str
+            JSON file the status of the jobs is written to (default batch_status.json in
+            cache_dir)
+        log_dir: str
+            directory of the log file of each job (default: the reduction directory of
+            the entry). The output of each job is written to batch_<job name>.log
+    Output:
+        status: dict
+            'jobs': a dictionary for each job with its 'name', 'kind', 'state' ('pending',
+            'running', 'done', 'failed', or 'skipped' if a job it depends on failed),
+            'start' and 'end' times, 'error' and 'log'; and the limits and resources in use
+    '''
+    if isinstance(entries, str):
+        entries = read_manifest(entries)
+    cache_dir = os.path.abspath(cache_dir)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    if max_cpus is None:
+        max_cpus = multiprocessing.cpu_count()
+    if status_filename is None:
+        status_filename = os.path.join(cache_dir, STATUS_FILENAME)
+    jobs = plan_batch(entries, cache_dir)
+    for job in jobs:
+        job_log_dir = log_dir if log_dir is not None else job['data_dir']
+        job.update({'state':'pending', 'start':None, 'end':None, 'error':None,
+                    'log':os.path.join(job_log_dir, 'batch_{}.log'.format(job['name']))})
+    status = {'jobs':[dict((k, v) for k, v in job.items() if k != 'entry') for job in jobs],
+              'max_cpus':max_cpus, 'max_memory_mb':max_memory_mb, 'cpus_used':0, 'memory_used':0}
+    job_status = dict((job['name'], job) for job in status['jobs'])
+
+    #Spawned (not forked or daemonic) processes, so that jobs can start their own workers
+    spawn = multiprocessing.get_context('spawn')
+    messages = spawn.Queue()
+    processes = {}
+    while True:
+        for job in jobs:
+            state = job_status[job['name']]
+            if state['state'] != 'pending':
+                continue
+            if any(job_status[dep]['state'] in ['failed', 'skipped'] for dep in job['depends']):
+                state['state'] = 'skipped'
+                print('BATCH skipping {}'.format(job['name']))
+                continue
+            if not all(job_status[dep]['state'] == 'done' for dep in job['depends']):
+                continue
+            if any(job_status[name]['data_dir'] == job['data_dir'] for name in processes):
+                continue
+            fits_cpus = status['cpus_used'] + job['cpus'] <= max_cpus
+            fits_memory = (max_memory_mb is None) or (status['memory_used'] + job['memory_mb'] <= max_memory_mb)
+            if (len(processes) > 0) and not (fits_cpus and fits_memory):
+                continue
+            process = spawn.Process(target=_run_job, args=(job, cache_dir, state['log'], messages))
+            process.start()
+            processes[job['name']] = process
+            state['state'] = 'running'
+            state['start'] = time.time()
+            status['cpus_used'] += job['cpus']
+            status['memory_used'] += job['memory_mb']
+            print('BATCH running {} (log {})'.format(job['name'], state['log']))
+        _write_status(status_filename, status)
+        if len(processes) == 0:
+            break
+        try:
+            name, error = messages.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            #A worker which was killed (e.g. out of memory) doesn't report back
+            dead = [name for name, process in processes.items()
+                    if (not process.is_alive()) and (process.exitcode != 0)]
+            if len(dead) == 0:
+                continue
+            name, error = dead[0], 'Worker process exited with code {}'.format(processes[dead[0]].exitcode)
+        processes.pop(name).join()
+        state = job_status[name]
+        state['end'] = time.time()
+        state['state'] = 'done' if error is None else 'failed'
+        state['error'] = error
+        status['cpus_used'] -= state['cpus']
+        status['memory_used'] -= state['memory_mb']
+        print('BATCH {} {} ({:.0f} s)'.format(name, state['state'], state['end'] - state['start']))
+    print(format_status(status))
+    return status
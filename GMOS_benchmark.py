@@ -0,0 +1,338 @@
+'''
+Benchmarks of the stages of the reduction on synthetic data.
+
+A synthetic night (GMOS_synthetic.make_night) is written for each data size and every
+stage (checksum, stage-in, indexing, calibration selection, native combine, native
+reduction, co-add, photometry, and QA rendering) is timed on it. Each stage runs in a
+freshly spawned process so that its peak memory (the maximum resident set size of the
+process, or of any of the worker processes it starts) can be measured. The files a stage
+needs (e.g. the master calibrations used by the reduction) are made before the stage is
+timed.
+
+Results can be written to a JSON file and compared to the results of an earlier run
+to find the stages which became slower.
+'''
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import resource
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import GMOS_synthetic
+
+#Parameters of the synthetic night of each data size (see GMOS_synthetic.make_night)
+DATA_SIZES = OrderedDict([('small', {'binning':4, 'nbias':3, 'nflat':3, 'nscience':2}),
+                          ('medium', {'binning':2, 'nbias':7, 'nflat':7, 'nscience':4}),
+                          ('large', {'binning':1, 'nbias':7, 'nflat':7, 'nscience':8})])
+
+STAGES = ['checksum', 'stage_in', 'index', 'select', 'combine', 'reduce', 'mosaic', 'coadd', 'photometry', 'qa']
+
+#Number of calibration selections timed by the select stage
+SELECT_REPEATS = 50
+
+def _file_sizes(file_list):
+    return sum(os.path.getsize(ifile) for ifile in file_list)
+
+def _raw_files(night):
+    return night['bias'] + night['flat'] + night['science']
+
+def _download_dir(context):
+    return os.path.join(context['work_dir'], 'download')
+
+#---------------------
+#SETUP (not timed)
+#---------------------
+
+def _setup_download(context):
+    download_dir = _download_dir(context)
+    if os.path.exists(download_dir):
+        shutil.rmtree(download_dir)
+    GMOS_synthetic.write_download(_raw_files(context['night']), download_dir, compress=True)
+
+def _setup_stage_in(context):
+    _setup_download(context)
+    staged_dir = os.path.join(context['work_dir'], 'staged')
+    if os.path.exists(staged_dir):
+        shutil.rmtree(staged_dir)
+    os.makedirs(staged_dir)
+
+def _index_db(context):
+    return os.path.join(context['work_dir'], 'benchmark_obsLog.sqlite3')
+
+def _setup_index(context):
+    db_file = _index_db(context)
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+def _setup_reduce(context):
+    if not os.path.exists(os.path.join(context['work_dir'], 'MCflat.fits')):
+        _run_combine(context)
+
+#---------------------
+#STAGES
+#Each stage returns the number of items (frames, or queries for select) and the
+#number of bytes of input it processed
+#---------------------
+
+def _run_checksum(context):
+    import GMOS_precalibration
+    report = GMOS_precalibration.verify_checksums([_download_dir(context)], nthreads=context['nprocesses'],
+                                                  cache_filename=None)
+    files = report['verified'] + [mismatch[0] for mismatch in report['mismatched']]
+    return len(files), _file_sizes(files)
+
+def _run_stage_in(context):
+    import GMOS_precalibration
+    download_list = glob.glob(os.path.join(_download_dir(context), '*.bz2'))
+    nbytes = _file_sizes(download_list)
+    report = GMOS_precalibration.stage_in([_download_dir(context)], os.path.join(context['work_dir'], 'staged'),
+                                          nprocesses=context['nprocesses'])
+    return len(report['staged']), nbytes
+
+def _run_index(context):
+    import GMOS_obslog
+    summary = GMOS_obslog.index_observations(context['night_dir'], _index_db(context),
+                                             nprocesses=context['nprocesses'])
+    return summary['indexed'], _file_sizes(_raw_files(context['night']))
+
+def _run_select(context):
+    import GMOS_obslog
+    db_file = os.path.join(context['night_dir'], 'obsLog.sqlite3')
+    qd = {'Instrument':context['instrument'], 'CcdBin':'{0} {0}'.format(context['binning']), 'RoI':'Full',
+          'DateObs':'{0}:{0}'.format(context['date_obs']), 'Filter2':'r_G%'}
+    for i in range(SELECT_REPEATS):
+        GMOS_obslog.select_calibrations('bias', qd, db_file)
+        GMOS_obslog.select_calibrations('twiFlat', qd, db_file)
+    return 2*SELECT_REPEATS, 0
+
+def _run_combine(context):
+    import GMOS_native_combine
+    night = context['night']
+    bias = os.path.join(context['work_dir'], 'MCbias.fits')
+    GMOS_native_combine.make_master_bias(night['bias'], bias, nthreads=context['nprocesses'])
+    GMOS_native_combine.make_master_flat(night['flat'], os.path.join(context['work_dir'], 'MCflat.fits'),
+                                         bias=bias, nthreads=context['nprocesses'])
+    files = night['bias'] + night['flat']
+    return len(files), _file_sizes(files)
+
+def _run_reduce(context):
+    import GMOS_native_reduction
+    night = context['night']
+    output_list = GMOS_native_reduction.reduce_frames(night['science'],
+                                                      bias=os.path.join(context['work_dir'], 'MCbias.fits'),
+                                                      flat=os.path.join(context['work_dir'], 'MCflat.fits'),
+                                                      nprocesses=context['nprocesses'],
+                                                      output_dir=context['work_dir'])
+    return len(output_list), _file_sizes(night['science'])
+
+def _reduced_files(context):
+    return [os.path.join(context['work_dir'], 'rg'+os.path.basename(ifile)) for ifile in context['night']['science']]
+
+def _setup_mosaic(context):
+    if not all(os.path.exists(ifile) for ifile in _reduced_files(context)):
+        _setup_reduce(context)
+        _run_reduce(context)
+
+def _run_mosaic(context):
+    import GMOS_native_mosaic
+    #The mosaics are written next to the reduced frames in work_dir; the output prefix
+    #keeps them apart from the synthetic mosaics used by the following stages
+    reduced = _reduced_files(context)
+    output_list = GMOS_native_mosaic.mosaic_frames(reduced, prefix='n', nprocesses=context['nprocesses'])
+    return len(output_list), _file_sizes(reduced)
+
+def _run_coadd(context):
+    import GMOS_native_coadd
+    night = context['night']
+    GMOS_native_coadd.coadd_frames(night['mosaic'], os.path.join(context['work_dir'], 'coadd.fits'),
+                                   nprocesses=context['nprocesses'])
+    return len(night['mosaic']), _file_sizes(night['mosaic'])
+
+def _run_photometry(context):
+    from astropy import table
+    import GMOS_photometry
+    night = context['night']
+    stars = table.Table.read(night['catalog'])
+    for filename in night['mosaic']:
+        with GMOS_photometry.PhotometrySession(filename) as session:
+            session.detect_sources()
+            x, y = session.wcs.all_world2pix(stars['ra'], stars['dec'], 0)
+            inside = (x > 0) & (x < session.data.shape[1]-1) & (y > 0) & (y < session.data.shape[0]-1)
+            session.curve_of_growth(np.transpose([x[inside], y[inside]]))
+            #find_obj_center takes 1-indexed positions, as world_to_pixel returns
+            session.find_obj_center(x=x[inside][0]+1, y=y[inside][0]+1, plot=False)
+    return len(night['mosaic']), _file_sizes(night['mosaic'])
+
+def _run_qa(context):
+    import GMOS_visualization
+    night = context['night']
+    jobs = [('bias', ifile, os.path.join(context['work_dir'], 'qa_{}.png'.format(os.path.basename(ifile))))
+            for ifile in night['bias']]
+    jobs += [('flat' if ifile in night['flat'] else 'science', ifile,
+              os.path.join(context['work_dir'], 'qa_{}.png'.format(os.path.basename(ifile))))
+             for ifile in night['flat'] + night['science']]
+    failed = GMOS_visualization.render_qa_files(jobs, nprocesses=context['nprocesses'])
+    if len(failed) > 0:
+        raise RuntimeError('QA rendering failed: {}'.format(failed))
+    return len(jobs), _file_sizes(_raw_files(night))
+
+STAGE_FUNCTIONS = {'checksum':(_setup_download, _run_checksum),
+                   'stage_in':(_setup_stage_in, _run_stage_in),
+                   'index':(_setup_index, _run_index),
+                   'select':(None, _run_select),
+                   'combine':(None, _run_combine),
+                   'reduce':(_setup_reduce, _run_reduce),
+                   'mosaic':(_setup_mosaic, _run_mosaic),
+                   'coadd':(None, _run_coadd),
+                   'photometry':(None, _run_photometry),
+                   'qa':(None, _run_qa)}
+
+def _peak_memory():
+    '''
+    Peak resident set size (MB) of this process and of its (waited for) child processes
+    '''
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin': #bytes on macOS, kB elsewhere
+        return peak/2.**20
+    return peak/2.**10
+
+def _timed_stage(stage, context):
+    start = time.time()
+    nitems, nbytes = STAGE_FUNCTIONS[stage][1](context)
+    return time.time() - start, nitems, nbytes, _peak_memory()
+
+def _stage_process(stage, context, queue):
+    try:
+        queue.put((_timed_stage(stage, context), None))
+    except BaseException:
+        queue.put((None, traceback.format_exc()))
+
+def time_stage(stage, context):
+    '''
+    Run the setup of a stage in this process, then time the stage in a new (spawned)
+    process. The process isn't a pool worker, so the stage can start its own workers.
+
+    Output:
+        seconds, number of items, number of bytes, peak memory (MB)
+    '''
+    setup = STAGE_FUNCTIONS[stage][0]
+    if setup is not None:
+        setup(context)
+    spawn = multiprocessing.get_context('spawn')
+    queue = spawn.Queue()
+    process = spawn.Process(target=_stage_process, args=(stage, context, queue))
+    process.start()
+    timing, error = queue.get()
+    process.join()
+    if error is not None:
+        raise RuntimeError('Benchmark of stage {} failed:\n{}'.format(stage, error))
+    return timing
+
+def run_benchmarks(work_dir, sizes=('small', 'medium'), stages=STAGES, nprocesses=1, repeat=1,
+                   instrument='GMOS-S', seed=0):
+    '''
+    Time the stages of the reduction on synthetic nights of several sizes
+
+    Input:
+        work_dir: str
+            directory the synthetic data and the products are written to
+        sizes: list
+            names of the data sizes (keys of DATA_SIZES)
+        stages: list
+            stages to time (see STAGES), in the order they are run
+        nprocesses: int
+            number of processes (or threads) used by the stages
+        repeat: int
+            number of times each stage is timed. The fastest run is reported
+        instrument: str
+            'GMOS-N' or 'GMOS-S'
+        seed: int
+            seed of the synthetic data
+    Output:
+        results: list
+            a dictionary for each size and stage with the 'size', 'stage', 'seconds',
+            'items' (frames, or queries for select), 'megabytes' of input,
+            'items_per_s', 'mb_per_s', and 'peak_mb'
+    '''
+    results = []
+    for size in sizes:
+        night_dir = os.path.join(os.path.abspath(work_dir), size, 'night')
+        size_work_dir = os.path.join(os.path.abspath(work_dir), size, 'products')
+        if os.path.exists(night_dir):
+            shutil.rmtree(night_dir)
+        if not os.path.exists(size_work_dir):
+            os.makedirs(size_work_dir)
+        params = DATA_SIZES[size]
+        night = GMOS_synthetic.make_night(night_dir, instrument=instrument, mosaics=True, seed=seed,
+                                          nprocesses=nprocesses, **params)
+        context = {'night':night, 'night_dir':night_dir, 'work_dir':size_work_dir, 'nprocesses':nprocesses,
+                   'instrument':instrument, 'binning':params['binning'], 'date_obs':'2018-09-02'}
+        for stage in stages:
+            timings = [time_stage(stage, context) for i in range(repeat)]
+            seconds, nitems, nbytes, peak = min(timings, key=lambda timing: timing[0])
+            result = OrderedDict([('size', size), ('stage', stage), ('seconds', seconds), ('items', nitems),
+                                  ('megabytes', nbytes/2.**20), ('items_per_s', nitems/seconds),
+                                  ('mb_per_s', nbytes/2.**20/seconds), ('peak_mb', peak)])
+            print('{size:8s} {stage:10s} {seconds:8.2f} s {items_per_s:8.1f} items/s '
+                  '{mb_per_s:8.1f} MB/s {peak_mb:8.0f} MB peak'.format(**result))
+            results.append(result)
+    return results
+
+def write_results(results, filename):
+    with open(filename, 'w') as ofile:
+        json.dump(results, ofile, indent=1)
+
+def read_results(filename):
+    with open(filename, 'r') as ofile:
+        return json.load(ofile)
+
+def compare_results(results, baseline, tolerance=0.25):
+    '''
+    Find the stages which are slower (or use more memory) than in a baseline run
+
+    Input:
+        results: list
+            results of run_benchmarks
+        baseline: list or str
+            results of an earlier run, or the name of the JSON file they were written to
+        tolerance: float
+            fractional increase of the time or the peak memory which is reported
+    Output:
+        regressions: list
+            (size, stage, quantity, value, baseline value) tuples where quantity is
+            'seconds' or 'peak_mb'
+    '''
+    if isinstance(baseline, str):
+        baseline = read_results(baseline)
+    baseline = dict(((result['size'], result['stage']), result) for result in baseline)
+    regressions = []
+    for result in results:
+        reference = baseline.get((result['size'], result['stage']))
+        if reference is None:
+            continue
+        for quantity in ['seconds', 'peak_mb']:
+            if result[quantity] > (1 + tolerance)*reference[quantity]:
+                regressions.append((result['size'], result['stage'], quantity,
+                                    result[quantity], reference[quantity]))
+    return regressions
+
+if __name__ == "__main__":
+    '''
+    Run the small and medium benchmarks and compare them to the results of the last run
+    '''
+    WORK_DIR = '../benchmark'
+    BASELINE = os.path.join(WORK_DIR, 'benchmark_baseline.json')
+
+    results = run_benchmarks(WORK_DIR, sizes=['small', 'medium'], nprocesses=4)
+    if os.path.exists(BASELINE):
+        for size, stage, quantity, value, reference in compare_results(results, BASELINE):
+            print('REGRESSION {} {}: {} {:.2f} (baseline {:.2f})'.format(size, stage, quantity, value, reference))
+    write_results(results, os.path.join(WORK_DIR, 'benchmark_results.json'))
@@ -0,0 +1,166 @@
+'''
+Content-addressed cache of master calibration files.
+
+A master calibration is identified by a key computed from the sorted list of input
+frames, the task flags, and the instrument configuration. The key is written to the
+primary header of the master (keyword MCHASH) so that an existing master in a reduction
+directory can be reused when it was built from the same inputs. Masters can also be
+stored in a cache directory shared between reduction directories and epochs.
+'''
+import os
+import json
+import shutil
+import hashlib
+import time
+
+from astropy.io import fits
+
+KEY_KEYWORD = 'MCHASH'
+
+def cache_key(input_files, flags, config):
+    '''
+    Compute the key which identifies a master calibration
+
+    Input:
+        input_files: list
+            list of the frames combined into the master
+        flags: dict
+            task parameters used to create the master (e.g. bias_flags, flat_flags)
+        config: dict
+            instrument configuration (e.g. Instrument, CcdBin, RoI, Filter2) and the keys
+            of any master calibrations used to create this one
+    Output:
+        key: str
+            hexadecimal hash
+    '''
+    description = {'files':sorted(str(x) for x in input_files),
+                   'flags':dict((k, str(v)) for k, v in flags.items()),
+                   'config':dict((k, str(v)) for k, v in config.items())}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_key(filename):
+    '''
+    Return the cache key recorded in the header of a master calibration file or None
+    if the file does not exist or has no key
+    '''
+    if not os.path.exists(filename):
+        return None
+    return fits.getheader(filename, 0).get(KEY_KEYWORD)
+
+def write_key(filename, key):
+    fits.setval(filename, KEY_KEYWORD, value=key, comment='Calibration cache key', ext=0)
+
+class CalibrationCache(object):
+    '''
+    A directory of master calibrations named by their key. Masters which have not been
+    used for more than max_age days are removed and, if the total size of the cache
+    exceeds max_size bytes, the least recently used masters are removed. Several
+    processes can share a cache: a master removed by another process is a cache miss.
+    '''
+    def __init__(self, cache_dir, max_size=None, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.fits'.format(key))
+
+    def lookup(self, key):
+        '''
+        Return the name of the cached master with this key or None if it isn't in the
+        cache. The last-used time of the master is updated.
+        '''
+        filename = self.path(key)
+        try:
+            os.utime(filename, None)
+        except FileNotFoundError:
+            return None
+        return filename
+
+    def store(self, key, filename):
+        '''
+        Copy a master calibration into the cache. The copy is renamed into place so
+        that other processes never see a partially written file. The new master is
+        never evicted by the eviction which follows.
+        '''
+        tmp_filename = '{}.{}.tmp'.format(self.path(key), os.getpid())
+        shutil.copyfile(filename, tmp_filename)
+        os.rename(tmp_filename, self.path(key))
+        self.evict(keep=self.path(key))
+
+    def evict(self, keep=None):
+        '''
+        Apply the age and size limits of the cache. The master keep (a path in the
+        cache) counts towards the size of the cache but isn't removed.
+        '''
+        entries = []
+        for ifile in os.listdir(self.cache_dir):
+            if not ifile.endswith('.fits'):
+                continue
+            filename = os.path.join(self.cache_dir, ifile)
+            try:
+                fstat = os.stat(filename)
+            except FileNotFoundError: #removed by another process
+                continue
+            entries.append((fstat.st_mtime, fstat.st_size, filename))
+        entries.sort()
+        now = time.time()
+        total_size = sum(entry[1] for entry in entries)
+        for mtime, size, filename in entries:
+            if filename == keep:
+                continue
+            too_old = (self.max_age is not None) and (now - mtime > self.max_age*86400.)
+            too_big = (self.max_size is not None) and (total_size > self.max_size)
+            if too_old or too_big:
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+def reuse_master(master_filename, key, cache=None, overwrite=True):
+    '''
+    Check whether a master calibration with this key already exists. If the master in
+    the reduction directory was built with the same key it is kept, otherwise if the
+    cache has a master with this key it is copied to master_filename. An existing 
+    master_filename is only replaced by the cached master if overwrite is True and it
+    was created by this pipeline (it has a key).
+
+    Input:
+        master_filename: str
+            name of the master calibration file in the reduction directory
+        key: str
+            key returned by cache_key
+        cache: CalibrationCache
+            shared cache to check. If None, only master_filename is checked
+        overwrite: bool
+            whether an existing master_filename may be replaced
+    Output:
+        True if master_filename now contains a master with this key, otherwise False
+    '''
+    existing_key = read_key(master_filename)
+    if existing_key == key:
+        print('Reusing {} (inputs and parameters unchanged)'.format(master_filename))
+        return True
+    replaceable = (not os.path.exists(master_filename)) or (overwrite and existing_key is not None)
+    if (cache is not None) and replaceable:
+        cached_filename = cache.lookup(key)
+        if cached_filename is not None:
+            print('Copying {} from calibration cache {}'.format(master_filename, cache.cache_dir))
+            try:
+                shutil.copyfile(cached_filename, master_filename)
+            except FileNotFoundError: #evicted by another process since the lookup
+                return False
+            return True
+    return False
+
+def record_master(master_filename, key, cache=None):
+    '''
+    Record the key of a newly created master calibration in its header and, if a cache
+    is given, add it to the cache
+    '''
+    write_key(master_filename, key)
+    if cache is not None:
+        cache.store(key, master_filename)
@@ -0,0 +1,123 @@
+'''
+Read and write compressed GMOS FITS files without unpacking them on disk.
+
+Raw frames can be kept as the .fits.bz2 archives they are downloaded as (astropy reads
+them into memory) or as tile-compressed .fits.fz files. resolve_fits finds the file of a
+name with or without its extension, so the File column of the obslog (the name without
+its extensions) refers to any of them.
+
+Reduced products (MCbias, MCflat_*, rg*, mrg*, and co-adds) can be written as
+tile-compressed FITS under their usual .fits names: integer planes (DQ) are compressed
+losslessly and floating point planes (SCI and VAR) are quantized to quantize_level levels
+per noise sigma of each tile (or losslessly with quantize_level=None). Tile-compressed
+files are read by astropy (and so by the native backend) but not by the IRAF tasks.
+
+astropy reads a whole compressed extension (or a whole .bz2 file) into memory, so code
+which reads many frames a section at a time (GMOS_native_combine) first writes an
+uncompressed copy of each compressed frame with uncompressed_copy and memory maps it.
+'''
+import os
+import bz2
+import shutil
+import tempfile
+
+import numpy as np
+from astropy.io import fits
+
+#Extensions of the FITS files, in the order they are looked for
+FITS_EXTENSIONS = ['.fits', '.fits.fz', '.fits.bz2', '.fz', '.bz2']
+
+#Quantization levels per noise sigma of the compressed SCI and VAR planes
+QUANTIZE_LEVEL = 16.
+
+def strip_fits_extension(filename):
+    '''
+    Return filename without its .fits, .fz, and .bz2 extensions
+    '''
+    for ext in ['.bz2', '.fz', '.fits']:
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+    return filename
+
+def resolve_fits(filename):
+    '''
+    Return the name of the existing file of filename, trying the extensions of
+    FITS_EXTENSIONS if it doesn't exist as given. If there is no such file, the .fits
+    name is returned.
+    '''
+    if os.path.exists(filename):
+        return filename
+    root = strip_fits_extension(filename)
+    for ext in FITS_EXTENSIONS:
+        if os.path.exists(root + ext):
+            return root + ext
+    return root + '.fits'
+
+def output_name(filename, prefix):
+    '''
+    Name of the (uncompressed or tile-compressed) .fits file prefix + filename,
+    in the directory of filename
+    '''
+    return os.path.join(os.path.dirname(filename),
+                        prefix + strip_fits_extension(os.path.basename(filename)) + '.fits')
+
+def compress_hdu(hdu, quantize_level=QUANTIZE_LEVEL, compression_type='RICE_1'):
+    '''
+    Return a tile-compressed copy of an image extension. Integer data are compressed
+    losslessly; floating point data are quantized to quantize_level (or compressed
+    losslessly with GZIP_2 if quantize_level is None).
+    '''
+    data = hdu.data
+    if np.issubdtype(data.dtype, np.floating) and quantize_level is None:
+        return fits.CompImageHDU(data=data, header=hdu.header, compression_type='GZIP_2',
+                                 quantize_level=0.)
+    if np.issubdtype(data.dtype, np.floating):
+        return fits.CompImageHDU(data=data, header=hdu.header, compression_type=compression_type,
+                                 quantize_level=quantize_level)
+    return fits.CompImageHDU(data=data, header=hdu.header, compression_type=compression_type)
+
+def write_fits(hdulist, filename, compress=False, quantize_level=QUANTIZE_LEVEL):
+    '''
+    Write a list of HDUs (a primary HDU followed by image extensions) to filename,
+    tile-compressing the image extensions if compress is True (see compress_hdu)
+    '''
+    if compress:
+        hdulist = [hdulist[0]] + [compress_hdu(hdu, quantize_level)
+                                  if isinstance(hdu, fits.ImageHDU) and hdu.data is not None else hdu
+                                  for hdu in hdulist[1:]]
+    fits.HDUList(hdulist).writeto(filename, overwrite=True)
+
+def is_compressed(filename, hdulist=None):
+    '''
+    True if filename is a .bz2 file or (if the opened hdulist is given) has
+    tile-compressed extensions
+    '''
+    if filename.endswith('.bz2'):
+        return True
+    return (hdulist is not None) and any(isinstance(hdu, fits.CompImageHDU) for hdu in hdulist)
+
+def uncompressed_copy(filename, scratch_dir=None, buffer_size=2**22):
+    '''
+    Write an uncompressed copy of a .bz2 or tile-compressed FITS file to a temporary
+    .fits file in scratch_dir (default: the system temporary directory) and return its
+    name. The file is decompressed one block (or one extension) at a time. The caller
+    removes the copy.
+    '''
+    fd, copy_filename = tempfile.mkstemp(prefix='uncompressed_', suffix='.fits', dir=scratch_dir)
+    os.close(fd)
+    try:
+        if filename.endswith('.bz2'):
+            with bz2.open(filename, 'rb') as infile, open(copy_filename, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, buffer_size)
+        else:
+            with fits.open(filename) as hdulist:
+                fits.PrimaryHDU(header=hdulist[0].header).writeto(copy_filename, overwrite=True)
+                for hdu in hdulist[1:]:
+                    with fits.open(copy_filename, mode='append') as copy_hdulist:
+                        copy_hdulist.append(fits.ImageHDU(data=hdu.data, header=hdu.header))
+                    #Release the decompressed extension before the next one is read
+                    del hdu.data
+    except BaseException:
+        os.remove(copy_filename)
+        raise
+    return copy_filename
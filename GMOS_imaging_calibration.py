@@ -9,76 +9,167 @@ import os
 import glob
 import sys
 
-from astropy.time import Time
-import astropy.units as u
-
 import fileSelect
-from pyraf import iraf
-from pyraf.iraf import gemini, gemtools, gmos
+import GMOS_obslog
+import GMOS_calibration_cache
+import GMOS_compressed_io
+import GMOS_native_reduction
+import GMOS_native_combine
+import GMOS_native_coadd
+import GMOS_native_mosaic
+import GMOS_parallel
+import GMOS_iraf_pool
+import GMOS_instrumentation
+
+FILTERS = ['Ha', 'HaC', 'SII', 'r', 'i']
+
+MOSAIC_FLAGS = {
+    'fl_paste':'no',
+    'fl_fixpix':'no',
+    'fl_clean':'yes',
+    'geointer':'nearest',
+    'logfile':'gmosaicLog.txt',
+    'fl_vardq':'yes',
+    'fl_fulldq':'yes',
+    'verbose':'no'
+    }
+
+def _run_iraf_task(task_name, args=(), flags=None, iraf_pool=None, outputs=None):
+    '''
+    Run an IRAF task in the current directory, on iraf_pool (a GMOS_iraf_pool.IrafPool)
+    if one is given, otherwise in this process. PyRAF is only imported by this process
+    if it runs a task itself. If a workspace is set (see GMOS_parallel.workspace), tasks
+    with outputs run in a private directory of the workspace.
+    '''
+    if iraf_pool is not None:
+        return iraf_pool.run(task_name, args, flags, os.getcwd(), outputs)
+    return GMOS_iraf_pool.run_task(task_name, args, flags, os.getcwd(), outputs,
+                                   GMOS_parallel.get_workspace_dir())
 
-def create_master_bias(qd, dbFile, data_dir, master_bias='MCbias.fits', overwrite=True):
+@GMOS_instrumentation.instrument
+def create_master_bias(qd, dbFile, data_dir, master_bias='MCbias.fits', overwrite=True,
+                       max_lookback=365, cache_dir=None, cache_max_size=None, cache_max_age=None,
+                       backend='iraf', iraf_pool=None, compress=False):
+    '''
+    Combine the bias frames closest in time to qd['DateObs'] into a master bias.
+    backend='native' combines the frames with GMOS_native_combine instead of gbias.
+    With backend='native', compress=True writes the master bias tile-compressed (see
+    GMOS_compressed_io).
+    
+    The master bias is identified by the list of bias frames, the gbias parameters, and
+    the instrument configuration. If master_bias was already built from the same inputs 
+    it is reused. Otherwise an existing master_bias (including one which wasn't built by
+    this pipeline) is rebuilt if overwrite is True and kept if it is False. If cache_dir 
+    is given, masters are also looked up in and added to this (possibly shared) cache 
+    directory, which is limited to cache_max_size bytes and cache_max_age days.
+    
+    iraf_pool is a GMOS_iraf_pool.IrafPool to run the IRAF tasks on. If None, they are
+    run in this process.
+    '''
     cur_dir = os.getcwd()
-    #os.chdir(data_dir)
-    iraf.chdir(data_dir)
+    os.chdir(data_dir)
+    bias_files, qd['DateObs'] = GMOS_obslog.select_calibrations('bias', qd, dbFile, 
+                                        min_frames=7, max_lookback=max_lookback)
+    bias_flags = {'logfile':'biasLog.txt',
+                 'rawpath':'',
+                 'fl_vardq':'yes',
+                 'verbose':'no'}
+    if cache_dir is not None:
+        cache = GMOS_calibration_cache.CalibrationCache(cache_dir, max_size=cache_max_size, 
+                                                        max_age=cache_max_age)
+    else:
+        cache = None
+    config = dict((k, qd.get(k)) for k in ['Instrument', 'CcdBin', 'RoI'])
+    config['backend'] = backend
+    if compress:
+        config['compress'] = GMOS_compressed_io.QUANTIZE_LEVEL
+    key = GMOS_calibration_cache.cache_key(bias_files, bias_flags, config)
+    if GMOS_calibration_cache.reuse_master(master_bias, key, cache, overwrite=overwrite):
+        os.chdir(cur_dir)
+        return None
     if os.path.exists(master_bias):
+        #built from different inputs, or not by this pipeline (no MCHASH key)
         if overwrite is True:
-            remove = raw_input('Remove bias file? (y), n ')
-            if remove != 'n':
-                os.remove(master_bias)
-            else:
-                return None
+            os.remove(master_bias)
         else:
             print('Master bias, {} already exists and overwrite={}'.format(master_bias, overwrite))
+            os.chdir(cur_dir)
             return None
     print (" --Creating Bias MasterCal--")
-
-    SQL = fileSelect.createQuery('bias', qd)
-    bias_files = fileSelect.fileListQuery(dbFile, SQL, qd)
-    start_date = Time(qd['DateObs'].split(':')[0], out_subfmt='date')
-    end_date = qd['DateObs'].split(':')[1]
-    while len(bias_files) < 7:
-        start_date = start_date-1.0*u.day
-        qd['DateObs'] = '{}:{}'.format(start_date, end_date)
-        SQL = fileSelect.createQuery('bias', qd)
-        bias_files = fileSelect.fileListQuery(dbFile, SQL, qd)
         
-    gmos.gbias.unlearn()
-    bias_flags = {'logfile':'biasLog.txt',
-                 'rawpath':'',
-                 'fl_vardq':'yes',
-                 'verbose':'no'}
     print('{} bias frames used in Master Bias over date range {}'.format(len(bias_files), qd['DateObs']))
+    GMOS_instrumentation.add_fields(files=len(bias_files))
     if len(bias_files) < 10:
         print('******WARNING less than 10 bias files********')
     if len(bias_files) > 1:
-        gmos.gbias(','.join(str(x) for x in bias_files), master_bias, **bias_flags)
+        if backend == 'native':
+            GMOS_native_combine.make_master_bias(bias_files, master_bias, compress=compress)
+        else:
+            _run_iraf_task('gbias', [','.join(str(x) for x in bias_files), master_bias], 
+                           bias_flags, iraf_pool, outputs=[master_bias])
         
     # Clean up
     if not os.path.exists(master_bias): #Check that IRAF didn't error
         sys.exit('ERROR creating Master Bias: {}'.format(master_bias))
-    #Remove intermediate files
-    if qd['Instrument']=='GMOS-N': 
-        image_str = 'gN'
-    else:
-        image_str = 'gS'
-    image_str = '{}{}*.fits'.format(image_str, qd['DateObs'][0:4])
-    iraf.imdel(image_str)
-    flist = glob.glob('tmplist*')
-    for ifile in flist:
-        os.remove(ifile)
-    iraf.chdir(cur_dir)
+    GMOS_calibration_cache.record_master(master_bias, key, cache)
+    #Remove the intermediate files of gbias (left in the workspace, if one is used).
+    #The native backend doesn't write any
+    if (backend != 'native') and (GMOS_parallel.get_workspace_dir() is None):
+        if qd['Instrument']=='GMOS-N': 
+            image_str = 'gN'
+        else:
+            image_str = 'gS'
+        image_str = '{}{}*.fits'.format(image_str, qd['DateObs'][0:4])
+        _run_iraf_task('imdelete', [image_str], iraf_pool=iraf_pool)
+        flist = glob.glob('tmplist*')
+        for ifile in flist:
+            os.remove(ifile)
+    os.chdir(cur_dir)
         
-def create_master_twilight_flat(qd, dbFile, data_dir, overwrite=True):
+@GMOS_instrumentation.instrument
+def create_master_twilight_flat(qd, dbFile, data_dir, overwrite=True, max_lookback=365,
+                                cache_dir=None, cache_max_size=None, cache_max_age=None,
+                                backend='iraf', filters=None, nprocesses=1, iraf_pool=None,
+                                compress=False):
     '''
     despite the fact that it looks like this can be run from outside the
     raw directory, it can't be.
+    
+    At least 7 flats are selected for each filter, from up to max_lookback days before
+    the start of qd['DateObs']
+    
+    Each master flat is identified by the list of flat frames, the giflat parameters
+    (including the BPM), the instrument configuration, and the master bias. Flats which
+    were already built from the same inputs are reused, either from data_dir or from 
+    cache_dir, and other existing flats are rebuilt if overwrite is True (see 
+    create_master_bias).
+    
+    iraf_pool is a GMOS_iraf_pool.IrafPool to run the IRAF tasks on. It is not used
+    by the per-filter processes when nprocesses is greater than 1.
+    
+    backend='native' combines the frames with GMOS_native_combine instead of giflat.
+    compress is as in create_master_bias.
+    
+    filters is the list of filters to create flats for (default FILTERS). If nprocesses
+    is greater than 1, each filter is run in its own process and work directory (see
+    GMOS_parallel).
     '''
+    if filters is None:
+        filters = FILTERS
+    if nprocesses > 1:
+        jobs = []
+        for f in filters:
+            kwargs = {'qd':dict(qd), 'dbFile':dbFile, 'overwrite':overwrite, 
+                      'max_lookback':max_lookback, 'cache_dir':cache_dir, 
+                      'cache_max_size':cache_max_size, 'cache_max_age':cache_max_age,
+                      'backend':backend, 'filters':[f], 'compress':compress}
+            jobs.append((create_master_twilight_flat, kwargs, data_dir, 'flat_{}'.format(f)))
+        GMOS_parallel.map_isolated(jobs, nprocesses)
+        return None
     cur_dir = os.getcwd()
-    #os.chdir(data_dir)
-    iraf.chdir(data_dir)
+    os.chdir(data_dir)
     print (" --Creating Twilight Imaging Flat-Field MasterCal--")
     # Set the task parameters.
-    gmos.giflat.unlearn()
     flat_flags = {
         'fl_scale':'yes',
         'sctype':'mean',
@@ -91,71 +182,146 @@ def create_master_twilight_flat(qd, dbFile, data_dir, overwrite=True):
         flat_flags['bpm']=  'gmos$data/gmos-n_bpm_HAM_22_12amp_v1.fits'
     else:
         flat_flags['bpm'] = 'gmos$data/gmos-s_bpm_HAM_22_12amp_v1.fits'
-    filters = ['Ha', 'HaC', 'SII', 'r', 'i']
+    if cache_dir is not None:
+        cache = GMOS_calibration_cache.CalibrationCache(cache_dir, max_size=cache_max_size, 
+                                                        max_age=cache_max_age)
+    else:
+        cache = None
     original_dateobs = qd['DateObs']
     for f in filters:
-        # Select filter name using a substring of the official designation.
-        qd['Filter2'] = f + '_G%'
-        SQL = fileSelect.createQuery('twiFlat', qd)
-        flat_files = fileSelect.fileListQuery(dbFile, SQL, qd)
-        start_date = Time(qd['DateObs'].split(':')[0], out_subfmt='date')
-        end_date = qd['DateObs'].split(':')[1]
-        while (len(flat_files) < 7) & ((Time(end_date)-start_date) < 365*u.day):
-            start_date = start_date-1.0*u.day
-            qd['DateObs'] = '{}:{}'.format(start_date, end_date)
-            SQL = fileSelect.createQuery('twiFlat', qd)
-            flat_files = fileSelect.fileListQuery(dbFile, SQL, qd)
+        with GMOS_instrumentation.stage('create_master_twilight_flat_filter', module=__name__, filter=f):
+            # Select filter name using a substring of the official designation.
+            qd['Filter2'] = f + '_G%'
+            flat_files, qd['DateObs'] = GMOS_obslog.select_calibrations('twiFlat', qd, dbFile, 
+                                                min_frames=7, max_lookback=max_lookback)
         
-        mc_name = 'MCflat_{}.fits'.format(f)
-        if os.path.exists(mc_name):
-            if overwrite is True:
-                remove = raw_input('Remove flat file {}? (y), n '.format(mc_name))
-                if remove == 'y':
+            mc_name = 'MCflat_{}.fits'.format(f)
+            config = dict((k, qd.get(k)) for k in ['Instrument', 'CcdBin', 'RoI', 'Filter2'])
+            config['bias'] = GMOS_calibration_cache.read_key('MCbias.fits')
+            config['backend'] = backend
+            if compress:
+                config['compress'] = GMOS_compressed_io.QUANTIZE_LEVEL
+            key = GMOS_calibration_cache.cache_key(flat_files, flat_flags, config)
+            if (len(flat_files) > 0) and \
+               GMOS_calibration_cache.reuse_master(mc_name, key, cache, overwrite=overwrite):
+                qd['DateObs'] = original_dateobs
+                continue
+            if os.path.exists(mc_name):
+                #built from different inputs, or not by this pipeline (no MCHASH key)
+                if overwrite is True:
                     os.remove(mc_name)
                 else:
+                    print('Master flat, {} already exists and overwrite={}'.format(mc_name, overwrite))
+                    os.chdir(cur_dir)
                     return None
-            else:
-                print('Master flat, {} already exists and overwrite={}'.format(mc_name, overwrite))
-                return None
-        if len(flat_files) > 0:
-            print("  Building twilight flat MasterCal for: {} with {} flat frames from date range {}".format(f, len(flat_files), qd['DateObs']))
-            gmos.giflat(','.join(str(x) for x in flat_files), mc_name, 
-                         bias='MCbias', **flat_flags)
-        qd['DateObs'] = original_dateobs
+            if len(flat_files) > 0:
+                print("  Building twilight flat MasterCal for: {} with {} flat frames from date range {}".format(f, len(flat_files), qd['DateObs']))
+                GMOS_instrumentation.add_fields(files=len(flat_files))
+                if backend == 'native':
+                    GMOS_native_combine.make_master_flat(flat_files, mc_name, bias='MCbias', 
+                            bpm=GMOS_native_reduction.resolve_iraf_path(flat_flags['bpm']), 
+                            compress=compress)
+                else:
+                    flags = dict(flat_flags, bias='MCbias')
+                    _run_iraf_task('giflat', [','.join(str(x) for x in flat_files), mc_name], 
+                                   flags, iraf_pool, outputs=[mc_name])
+                if os.path.exists(mc_name):
+                    GMOS_calibration_cache.record_master(mc_name, key, cache)
+            qd['DateObs'] = original_dateobs
     # Clean up
     if not os.path.exists(mc_name):
         sys.exit('ERROR creating Master Flat Field: {}'.format(mc_name))
-    if qd['Instrument']=='GMOS-N':
-        image_str = 'gN'
-    else:
-        image_str = 'gS'
-    image_str = '{}{}*.fits'.format(image_str, qd['DateObs'][0:4])
-    for f in filters:
-        del_str = f+image_str
-        iraf.imdel(del_str)
-    flist = glob.glob('tmpfile*')
-    for ifile in flist:
-        os.remove(ifile)
-    iraf.chdir(cur_dir)
-    #os.chdir(cur_dir)
+    #Remove the intermediate files of giflat, as for create_master_bias
+    if (backend != 'native') and (GMOS_parallel.get_workspace_dir() is None):
+        if qd['Instrument']=='GMOS-N':
+            image_str = 'gN'
+        else:
+            image_str = 'gS'
+        image_str = '{}{}*.fits'.format(image_str, qd['DateObs'][0:4])
+        for f in filters:
+            del_str = f+image_str
+            _run_iraf_task('imdelete', [del_str], iraf_pool=iraf_pool)
+        flist = glob.glob('tmpfile*')
+        for ifile in flist:
+            os.remove(ifile)
+    os.chdir(cur_dir)
     
-def calibrate_science_images(qd, dbFile, data_dir, biasfilename='MCbias', overwrite=True):
+@GMOS_instrumentation.instrument
+def calibrate_science_images(qd, dbFile, data_dir, biasfilename='MCbias', overwrite=True,
+                             backend='iraf', filters=None, nprocesses=1, fl_mosaic=True,
+                             iraf_pool=None, compress=False):
     '''
     despite the fact that it looks like this can be run from outside the
     raw directory, it can't be.
     
+    backend='native' reduces the images in-process with GMOS_native_reduction instead of
+    gireduce, and mosaics them with GMOS_native_mosaic instead of gmosaic. The bad pixel
+    mask is then read from the directory in the GMOS_DATA_DIR environment variable.
+    The raw images can then be .fits.bz2 or tile-compressed files, and compress=True
+    writes the rg and mrg images tile-compressed (see GMOS_compressed_io).
+    
+    filters is the list of filters to reduce (default FILTERS). If nprocesses is greater
+    than 1, the images of each filter are reduced in their own process and work directory
+    and then each image is mosaicked in its own process (see GMOS_parallel). 
+    fl_mosaic=False skips the gmosaic step. iraf_pool is as in create_master_twilight_flat.
+    
     
     #Bad pixel maps live in /Users/bostroem/anaconda/envs/geminiconda/iraf_extern/gemini/gmos/data
     #You can find this directory with pyraf; cd gmos; cd data; pwd
     '''
     print ("=== Processing Science Images ===")
-    cur_dir = os.getcwd()
-    iraf.chdir(data_dir)
     prefix = 'rg'
+    if filters is None:
+        filters = FILTERS
+    if nprocesses > 1:
+        jobs = []
+        for f in filters:
+            kwargs = {'qd':dict(qd), 'dbFile':dbFile, 'biasfilename':biasfilename, 
+                      'overwrite':overwrite, 'backend':backend, 'filters':[f], 
+                      'fl_mosaic':False, 'compress':compress}
+            jobs.append((calibrate_science_images, kwargs, data_dir, 'science_{}'.format(f)))
+        GMOS_parallel.map_isolated(jobs, nprocesses)
+        if fl_mosaic:
+            sciFiles = []
+            for f in filters:
+                qd['Filter2'] = f + '_G%'
+                sciFiles.extend(fileSelect.fileListQuery(os.path.join(data_dir, dbFile), 
+                                                         fileSelect.createQuery('sciImg', qd), qd))
+            mosaic_images([prefix+str(x) for x in sciFiles], data_dir, nprocesses=nprocesses,
+                          backend=backend, compress=compress)
+        return None
+    cur_dir = os.getcwd()
+    os.chdir(data_dir)
 
+    # Reduce the science images, then mosaic the extensions in a loop
+    for f in filters:
+        with GMOS_instrumentation.stage('calibrate_science_images_filter', module=__name__, filter=f):
+            print("    Processing science images for: %s" % (f))
+            qd['Filter2'] = f + '_G%'
+            flatFile = 'MCflat_' + f
+            sciFiles = fileSelect.fileListQuery(dbFile, fileSelect.createQuery('sciImg', qd), qd)
+            GMOS_instrumentation.add_fields(files=len(sciFiles))
+            if len(sciFiles) > 0:
+                reduce_science_images(sciFiles, qd['Instrument'], flatFile, biasfilename=biasfilename,
+                                      backend=backend, iraf_pool=iraf_pool, prefix=prefix,
+                                      compress=compress)
+                #Combine multi-extension images into one image
+                if fl_mosaic:
+                    mosaic_images([prefix+str(x) for x in sciFiles], os.curdir, iraf_pool=iraf_pool,
+                                  backend=backend, compress=compress)
+    os.chdir(cur_dir)
+
+@GMOS_instrumentation.instrument
+def reduce_science_images(file_list, instrument, flat_file, biasfilename='MCbias', backend='iraf',
+                          iraf_pool=None, prefix='rg', compress=False):
+    '''
+    Reduce raw science images in the current directory with gireduce (or 
+    GMOS_native_reduction if backend='native'). The output files are prefix + filename.
+    compress is as in calibrate_science_images.
+    '''
+    GMOS_instrumentation.add_fields(files=len(file_list))
     # Set task parameters.
     # Employ the imaging Static BPM for this set of detectors.
-    gmos.gireduce.unlearn()
     sciFlags = {
         'fl_over':'yes', #Overscan subtraction
         'fl_trim':'yes', #Overscan region trimmed
@@ -167,46 +333,79 @@ def calibrate_science_images(qd, dbFile, data_dir, biasfilename='MCbias', overwr
         'fl_vardq':'yes', #Propagate VAR and DQ extensions
         'verbose':'no'
         }
-    if qd['Instrument'] == 'GMOS-N':
+    if instrument == 'GMOS-N':
        sciFlags['bpm'] =  'gmos$data/gmos-n_bpm_HAM_22_12amp_v1.fits'
     else:
         sciFlags['bpm'] = 'gmos$data/gmos-s_bpm_HAM_22_12amp_v1.fits'
+    if backend == 'native':
+        GMOS_native_reduction.reduce_frames(file_list, prefix=prefix, bias=biasfilename, 
+                flat=flat_file, bpm=GMOS_native_reduction.resolve_iraf_path(sciFlags['bpm']),
+                compress=compress)
+    else:
+        flags = dict(sciFlags, bias=biasfilename, flat1=flat_file)
+        _run_iraf_task('gireduce', [','.join(str(x) for x in file_list)], flags, 
+                       iraf_pool, outputs=[prefix+str(x) for x in file_list])
 
-    gemtools.gemextn.unlearn()    # disarms a bug in gmosaic
-    gmos.gmosaic.unlearn()
-    mosaicFlags = {
-        'fl_paste':'no',
-        'fl_fixpix':'no',
-        'fl_clean':'yes',
-        'geointer':'nearest',
-        'logfile':'gmosaicLog.txt',
-        'fl_vardq':'yes',
-        'fl_fulldq':'yes',
-        'verbose':'no'
-        }
-    # Reduce the science images, then mosaic the extensions in a loop
-    filters = ['Ha', 'HaC', 'SII', 'r', 'i']
-    for f in filters:
-        print("    Processing science images for: %s" % (f))
-        qd['Filter2'] = f + '_G%'
-        flatFile = 'MCflat_' + f
-        sciFiles = fileSelect.fileListQuery(dbFile, fileSelect.createQuery('sciImg', qd), qd)
-        if len(sciFiles) > 0:
-            gmos.gireduce (','.join(str(x) for x in sciFiles), bias=biasfilename, 
-                           flat1=flatFile, **sciFlags)
-            #Combine multi-extension images into one image
-            for file in sciFiles:
-                gmos.gmosaic (prefix+file, **mosaicFlags)
-    iraf.chdir(cur_dir)
+@GMOS_instrumentation.instrument
+def mosaic_images(file_list, data_dir, nprocesses=1, iraf_pool=None, backend='iraf',
+                  compress=False):
+    '''
+    Mosaic the extensions of reduced images into one image with gmosaic. If nprocesses 
+    is greater than 1, each image is mosaicked in its own process and work directory.
+    Otherwise, if iraf_pool is given, the images are sent to all of its workers at once.
+    backend='native' mosaics the images with GMOS_native_mosaic (in nprocesses processes)
+    instead of gmosaic. compress is as in calibrate_science_images.
+    '''
+    GMOS_instrumentation.add_fields(files=len(file_list))
+    if backend == 'native':
+        GMOS_native_mosaic.mosaic_frames([os.path.join(data_dir, str(ifile)) for ifile in file_list],
+                                         nprocesses=nprocesses, compress=compress)
+        return None
+    if nprocesses > 1:
+        jobs = [(mosaic_images, {'file_list':[ifile]}, data_dir, 'mosaic_{}'.format(ifile)) 
+                for ifile in file_list]
+        GMOS_parallel.map_isolated(jobs, nprocesses)
+        return None
+    cur_dir = os.getcwd()
+    os.chdir(data_dir)
+    if iraf_pool is not None:
+        pending = [iraf_pool.submit('gmosaic', [ifile], MOSAIC_FLAGS, outputs=['m'+ifile]) 
+                   for ifile in file_list]
+        errors = [result['error'] for result in [job.get() for job in pending] 
+                  if result['error'] is not None]
+        os.chdir(cur_dir)
+        if len(errors) > 0:
+            raise RuntimeError('gmosaic failed:\n{}'.format('\n'.join(errors)))
+        return None
+    for ifile in file_list:
+        _run_iraf_task('gmosaic', [ifile], MOSAIC_FLAGS, outputs=['m'+ifile])
+    os.chdir(cur_dir)
     
-def calibrate_standard_images(qd, dbFile, std_name, biasfilename='MCbias', overwrite=True):
+@GMOS_instrumentation.instrument
+def calibrate_standard_images(qd, dbFile, std_name, biasfilename='MCbias', overwrite=True,
+                              backend='iraf', data_dir='./', filters=None, nprocesses=1,
+                              iraf_pool=None, compress=False):
+    '''
+    Reduce and mosaic the images of the standard star std_name. filters, nprocesses,
+    iraf_pool, and compress are as in calibrate_science_images.
+    '''
     print ("=== Processing Science Images ===")
     prefix = 'rg'
+    if filters is None:
+        filters = FILTERS
+    if nprocesses > 1:
+        jobs = []
+        for f in filters:
+            kwargs = {'qd':dict(qd), 'dbFile':dbFile, 'std_name':std_name, 
+                      'biasfilename':biasfilename, 'overwrite':overwrite, 
+                      'backend':backend, 'filters':[f], 'compress':compress}
+            jobs.append((calibrate_standard_images, kwargs, data_dir, 'standard_{}'.format(f)))
+        GMOS_parallel.map_isolated(jobs, nprocesses)
+        return None
     cur_dir = os.getcwd()
-    iraf.chdir(data_dir)
+    os.chdir(data_dir)
     # Set task parameters.
     # Employ the imaging Static BPM for this set of detectors.
-    gmos.gireduce.unlearn()
     sciFlags = {
         'fl_over':'yes',
         'fl_trim':'yes',
@@ -219,84 +418,127 @@ def calibrate_standard_images(qd, dbFile, std_name, biasfilename='MCbias', overw
         #####'bpm':'bpm_gmos-s_EEV_v1_2x2_img_MEF.fits',
         'verbose':'no'
         }
-    gemtools.gemextn.unlearn()    # disarms a bug in gmosaic
-    gmos.gmosaic.unlearn()
-    mosaicFlags = {
-        'fl_paste':'no',
-        'fl_fixpix':'no',
-        'fl_clean':'yes',
-        'geointer':'nearest',
-        'logfile':'gmosaicLog.txt',
-        'fl_vardq':'yes',
-        'fl_fulldq':'yes',
-        'verbose':'no'
-        }
     # Reduce the science images, then mosaic the extensions in a loop
-    filters = ['Ha', 'HaC', 'SII', 'r', 'i']
     for f in filters:
-        print("    Processing science images for: %s" % (f))
-        qd['Filter2'] = f + '_G%'
-        flatFile = 'MCflat_' + f
-        sql_query = '''SELECT file FROM obslog WHERE Object='{}' AND Filter2 LIKE '{}%' '''.format(std_name, f)
-        sciFiles = run_query(sql_query, dbFile)
-        sciFiles = [x[0] for x in sciFiles]
-        if len(sciFiles) > 0:
-            gmos.gireduce (','.join(str(x) for x in sciFiles), bias=biasfilename, 
-                           flat1=flatFile, **sciFlags)
-            for file in sciFiles:
-                gmos.gmosaic (prefix+file, **mosaicFlags)
-    iraf.chdir(cur_dir)
+        with GMOS_instrumentation.stage('calibrate_standard_images_filter', module=__name__, filter=f):
+            print("    Processing science images for: %s" % (f))
+            qd['Filter2'] = f + '_G%'
+            flatFile = 'MCflat_' + f
+            std_qd = dict(qd, Object=std_name)
+            sql_query = '''SELECT File FROM obslog WHERE use_me=1 AND Object=:Object 
+                           AND Filter2 LIKE :Filter2'''
+            sciFiles = fileSelect.fileListQuery(dbFile, sql_query, std_qd)
+            GMOS_instrumentation.add_fields(files=len(sciFiles))
+            if len(sciFiles) > 0:
+                if backend == 'native':
+                    GMOS_native_reduction.reduce_frames(sciFiles, prefix=prefix, bias=biasfilename, 
+                                                        flat=flatFile, compress=compress)
+                else:
+                    flags = dict(sciFlags, bias=biasfilename, flat1=flatFile)
+                    _run_iraf_task('gireduce', [','.join(str(x) for x in sciFiles)], flags, 
+                                   iraf_pool, outputs=[prefix+str(x) for x in sciFiles])
+                mosaic_images([prefix+str(x) for x in sciFiles], os.curdir, iraf_pool=iraf_pool,
+                              backend=backend, compress=compress)
+    os.chdir(cur_dir)
 
 
 
 
-def create_coadd_img(qd, targets, dbFile, data_dir, prefix='mrg', overwrite=True):
+@GMOS_instrumentation.instrument
+def create_coadd_img(qd, targets, dbFile, data_dir, prefix='mrg', overwrite=True,
+                     filters=None, nprocesses=1, iraf_pool=None, backend='iraf', compress=False):
     '''
     despite the fact that it looks like this can be run from outside the
     raw directory, it can't be.
     
-    Caveats:
+    Caveats (of imcoadd, backend='iraf'):
     * It takes a lot of patience and trial-and-error tweaking of parameters 
         to get good results
     * There is little control over sky background
     * The output image is no bigger than the first (reference) image, 
         rather than the union of the image footprints
     
+    filters is the list of filters to co-add (default FILTERS). If nprocesses is greater
+    than 1, each filter is co-added in its own process and work directory. iraf_pool is as
+    in create_master_twilight_flat.
+    
+    backend='native' co-adds the images with GMOS_native_coadd onto the union of their
+    footprints, without intermediate files. nprocesses is then the number of processes
+    combining each image, and compress=True writes the co-added images tile-compressed.
     '''
     ## Co-add the images, per position and filter.
     print (" -- Begin image co-addition --")
+    if filters is None:
+        filters = FILTERS
+    if nprocesses > 1 and backend != 'native':
+        jobs = []
+        for f in filters:
+            kwargs = {'qd':dict(qd), 'targets':targets, 'dbFile':dbFile, 'prefix':prefix, 
+                      'overwrite':overwrite, 'filters':[f]}
+            jobs.append((create_coadd_img, kwargs, data_dir, 'coadd_{}'.format(f)))
+        GMOS_parallel.map_isolated(jobs, nprocesses)
+        return None
     cur_dir = os.getcwd()
-    iraf.chdir(data_dir)
+    os.chdir(data_dir)
+
+    for f in filters:
+        with GMOS_instrumentation.stage('create_coadd_img_filter', module=__name__, filter=f):
+            print("  - Co-addding science images in filter: {}".format(f))
+            qd['Filter2'] = f + '_G%'
+            for t in targets:
+                qd['Object'] = t + '%'
+                print("  - Co-addding science images for position: {}".format(t))
+                outImage = t + '_' + f + '.fits'
+                coAddFiles = fileSelect.fileListQuery(dbFile, fileSelect.createQuery('sciImg', qd), qd)
+                if len(coAddFiles) > 1:
+                    coadd_images([prefix+str(x) for x in coAddFiles], outImage, iraf_pool=iraf_pool, 
+                                 clean_up=False, backend=backend, nprocesses=nprocesses,
+                                 compress=compress)
 
+    if backend != 'native':
+        clean_coadd_files(iraf_pool)
+    #iraf.imdelete ("mrgS*.fits")
+
+    print ("=== Finished Calibration Processing ===")
+    os.chdir(cur_dir)
+    
+@GMOS_instrumentation.instrument
+def coadd_images(file_list, out_image, iraf_pool=None, clean_up=True, backend='iraf',
+                 nprocesses=1, compress=False):
+    '''
+    Co-add mosaicked images in the current directory into out_image with imcoadd. If
+    clean_up is True, the intermediate files of imcoadd are removed afterwards.
+    
+    backend='native' uses GMOS_native_coadd.coadd_frames (with nprocesses processes)
+    instead of imcoadd, writing out_image tile-compressed if compress is True.
+    '''
+    GMOS_instrumentation.add_fields(files=len(file_list))
+    if backend == 'native':
+        GMOS_native_coadd.coadd_frames(file_list, out_image, nprocesses=nprocesses, compress=compress)
+        return None
     # Use primarily the default task parameters.
-    gemtools.imcoadd.unlearn()
     coaddFlags = {
         'fwhm':3,
         'datamax':6.e4,
         'geointer':'nearest',
         'logfile':'imcoaddLog.txt'
         }
-    
-    filters = ['Ha', 'HaC', 'SII', 'r', 'i']
-    for f in filters:
-        print "  - Co-addding science images in filter: {}".format(f)
-        qd['Filter2'] = f + '_G%'
-        for t in targets:
-            qd['Object'] = t + '%'
-            print "  - Co-addding science images for position: {}".format(t)
-            outImage = t + '_' + f + '.fits'
-            coAddFiles = fileSelect.fileListQuery(dbFile, fileSelect.createQuery('sciImg', qd), qd)
-            if len(coAddFiles) > 1:
-                gemtools.imcoadd(','.join(prefix+str(x) for x in coAddFiles),
-                    outimage=outImage, **coaddFlags)
+    flags = dict(coaddFlags, outimage=out_image)
+    _run_iraf_task('imcoadd', [','.join(str(x) for x in file_list)], flags, iraf_pool, 
+                   outputs=[out_image])
+    if clean_up:
+        clean_coadd_files(iraf_pool)
 
-    iraf.delete ("*_trn*,*_pos,*_cen")
-    iraf.imdelete ("*badpix.pl,*_med.fits,*_mag.fits")
-    #iraf.imdelete ("mrgS*.fits")
+def clean_coadd_files(iraf_pool=None):
+    '''
+    Remove the intermediate files imcoadd leaves in the current directory. There are
+    none if imcoadd ran in a workspace (see GMOS_parallel.workspace).
+    '''
+    if GMOS_parallel.get_workspace_dir() is not None:
+        return None
+    _run_iraf_task('delete', ["*_trn*,*_pos,*_cen"], iraf_pool=iraf_pool)
+    _run_iraf_task('imdelete', ["*badpix.pl,*_med.fits,*_mag.fits"], iraf_pool=iraf_pool)
 
-    print ("=== Finished Calibration Processing ===")
-    iraf.chdir(cur_dir)
-    
 if __name__ == "__main__":
     '''
     An example of running the script on the first imaging observations of SN2017eaw
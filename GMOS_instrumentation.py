@@ -0,0 +1,229 @@
+'''
+Stage level timing and resource records of the reduction, written as JSON lines.
+
+Functions decorated with instrument and blocks run in a stage context (e.g. each filter,
+and each IRAF task) append one JSON line to the run log when they finish:
+
+    {"stage": "create_master_twilight_flat", "module": "GMOS_imaging_calibration",
+     "filter": "r", "parent": "create_master_twilight_flat", "depth": 1, "status": "ok",
+     "start": 1536000000.0, "wall": 12.3, "cpu_user": 10.1, "cpu_system": 0.8,
+     "cpu_children": 0.0, "peak_rss_mb": 812.5, "bytes_read": 251658240,
+     "bytes_written": 83886080, "files": 7, "pid": 1234, "host": "node01"}
+
+cpu_children is the CPU time of child processes which finished during the stage (e.g.
+the IRAF executables), peak_rss_mb the peak resident memory of the process so far, and
+bytes_read and bytes_written the bytes passed to read and write calls by the process
+(from /proc/self/io, None where it isn't available; pages of memory mapped files, e.g.
+the FITS files opened by the native backend, aren't counted). files is the number of files the
+stage processed, where the stage reports it (see add_fields). CPU times and bytes are
+those of the whole process, so they include stages running concurrently in other threads
+(e.g. GMOS_pipeline nodes).
+
+Instrumentation is configured with configure or with the environment variables
+GMOS_RUN_LOG (the run log file), GMOS_PROFILE (comma separated stage name patterns, or
+'all'), and GMOS_PROFILE_DIR (where the cProfile statistics of the profiled stages are
+written), so that worker processes (GMOS_parallel, GMOS_iraf_pool, Pool workers) write
+to the same run log. Nothing is measured or written unless a run log or profiling is
+configured.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import fnmatch
+import cProfile
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+RUN_LOG_VARIABLE = 'GMOS_RUN_LOG'
+PROFILE_VARIABLE = 'GMOS_PROFILE'
+PROFILE_DIR_VARIABLE = 'GMOS_PROFILE_DIR'
+
+#Stack of the records of the running stages of each thread
+_local = threading.local()
+
+def configure(run_log=None, profile=None, profile_dir=None):
+    '''
+    Set the run log and the profiled stages of this process and of the processes it starts
+
+    Input:
+        run_log: str
+            JSON lines file the stage records are appended to. If None, records aren't written
+        profile: list
+            names (or fnmatch patterns) of the stages to run under cProfile, or 'all'
+        profile_dir: str
+            directory of the profile statistics (default: the directory of run_log, or
+            the current directory)
+    '''
+    for variable, value in [(RUN_LOG_VARIABLE, run_log), (PROFILE_DIR_VARIABLE, profile_dir)]:
+        if value is None:
+            os.environ.pop(variable, None)
+        else:
+            os.environ[variable] = os.path.abspath(value)
+    if profile is None:
+        os.environ.pop(PROFILE_VARIABLE, None)
+    else:
+        os.environ[PROFILE_VARIABLE] = profile if isinstance(profile, str) else ','.join(profile)
+
+def _profiled(stage_name):
+    patterns = os.environ.get(PROFILE_VARIABLE)
+    if not patterns:
+        return False
+    return any((pattern == 'all') or fnmatch.fnmatch(stage_name, pattern)
+               for pattern in patterns.split(','))
+
+def _io_counters():
+    '''
+    Return the bytes read and written by this process (rchar and wchar of /proc/self/io)
+    '''
+    try:
+        with open('/proc/self/io', 'r') as ofile:
+            counters = dict(line.split(':') for line in ofile.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+def _peak_rss_mb():
+    #ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1./2**20 if sys.platform == 'darwin' else 1./2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def add_fields(**fields):
+    '''
+    Add fields (e.g. files=number of files processed) to the record of the innermost
+    running stage of this thread. Does nothing outside a stage or when instrumentation
+    isn't configured.
+    '''
+    stack = _stack()
+    if len(stack) > 0:
+        stack[-1].update(fields)
+
+def _write_record(record):
+    line = json.dumps(record, sort_keys=True, default=str) + '\n'
+    #A single write to a file opened for appending, so that processes writing to the
+    #same run log don't interleave their lines
+    fd = os.open(os.environ[RUN_LOG_VARIABLE], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+@contextmanager
+def stage(stage_name, module=None, **fields):
+    '''
+    Record the resources used by a block of code as a stage named stage_name with the
+    extra fields (e.g. filter='r', task='gireduce') in its record. If the stage matches
+    the profiled stages, the block is run under cProfile (unless another profiled stage
+    is already running in this thread) and the name of the statistics file is recorded.
+    '''
+    run_log = os.environ.get(RUN_LOG_VARIABLE)
+    profile = _profiled(stage_name) and not any('profile' in record for record in _stack())
+    if (run_log is None) and not profile:
+        yield
+        return
+    stack = _stack()
+    record = {'stage':stage_name, 'module':module, 'parent':stack[-1]['stage'] if len(stack) > 0 else None,
+              'depth':len(stack), 'pid':os.getpid(), 'host':socket.gethostname(), 'start':time.time()}
+    record.update(fields)
+    if profile:
+        profile_dir = os.environ.get(PROFILE_DIR_VARIABLE,
+                                     os.path.dirname(run_log) if run_log is not None else os.getcwd())
+        record['profile'] = os.path.join(profile_dir, '{}_{}_{:.0f}.prof'.format(stage_name, os.getpid(),
+                                                                             record['start']*1000))
+        profiler = cProfile.Profile()
+    stack.append(record)
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_read, start_written = _io_counters()
+    start_wall = time.time()
+    record['status'] = 'ok'
+    if profile:
+        try:
+            profiler.enable()
+        except ValueError: #another profiler is active (in another thread)
+            profile = False
+            del record['profile']
+    try:
+        yield
+    except BaseException as error:
+        record['status'] = 'error'
+        record['error'] = '{}: {}'.format(type(error).__name__, error)
+        raise
+    finally:
+        if profile:
+            profiler.disable()
+            profiler.dump_stats(record['profile'])
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_read, end_written = _io_counters()
+        stack.pop()
+        record['wall'] = time.time() - start_wall
+        record['cpu_user'] = end_self.ru_utime - start_self.ru_utime
+        record['cpu_system'] = end_self.ru_stime - start_self.ru_stime
+        record['cpu_children'] = (end_children.ru_utime + end_children.ru_stime -
+                                  start_children.ru_utime - start_children.ru_stime)
+        record['peak_rss_mb'] = _peak_rss_mb()
+        record['bytes_read'] = None if start_read is None else end_read - start_read
+        record['bytes_written'] = None if start_written is None else end_written - start_written
+        if run_log is not None:
+            _write_record(record)
+
+def instrument(func=None, stage_name=None):
+    '''
+    Decorator which runs a function as a stage (see stage) named after the function
+    '''
+    if func is None:
+        return functools.partial(instrument, stage_name=stage_name)
+    name = stage_name if stage_name is not None else func.__name__
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name, module=func.__module__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def read_run_log(filename):
+    '''
+    Read the records of a run log
+    '''
+    with open(filename, 'r') as ofile:
+        return [json.loads(line) for line in ofile if line.strip()]
+
+def summarize(records, keys=('stage',)):
+    '''
+    Total the records of a run log by the fields in keys
+
+    Input:
+        records: list
+            records returned by read_run_log
+        keys: list
+            fields the records are grouped by, e.g. ('stage', 'filter') or ('task',)
+    Output:
+        summary: list
+            a dictionary for each group with the values of keys, the number of records
+            'count', the total 'wall', 'cpu' (user, system, and children), 'bytes_read',
+            'bytes_written', and 'files', the largest 'peak_rss_mb', and 'errors'
+    '''
+    groups = {}
+    for record in records:
+        group_key = tuple(record.get(key) for key in keys)
+        if group_key not in groups:
+            groups[group_key] = dict(zip(keys, group_key))
+            groups[group_key].update({'count':0, 'wall':0., 'cpu':0., 'bytes_read':0, 'bytes_written':0,
+                                      'files':0, 'peak_rss_mb':0., 'errors':0})
+        group = groups[group_key]
+        group['count'] += 1
+        group['wall'] += record['wall']
+        group['cpu'] += record['cpu_user'] + record['cpu_system'] + record['cpu_children']
+        for field in ['bytes_read', 'bytes_written', 'files']:
+            group[field] += record.get(field) or 0
+        group['peak_rss_mb'] = max(group['peak_rss_mb'], record['peak_rss_mb'])
+        group['errors'] += record['status'] != 'ok'
+    return sorted(groups.values(), key=lambda group: -group['wall'])
@@ -0,0 +1,214 @@
+'''
+Long-lived pool of PyRAF worker processes.
+
+Importing PyRAF and loading the gemini, gemtools, and gmos packages takes several seconds,
+so instead of loading them in every script (or every worker process) they are loaded once
+per worker of an IrafPool. Jobs (a task name, its positional arguments, and its flag
+dictionary) are sent to the workers over the pool's queue and each job returns the
+output files it created and the lines it added to the task log. Each job writes its own
+log, which is appended to the task's logfile when the job ends, so that the logs of
+concurrent jobs of the same task are not interleaved.
+
+run_task runs a job in the current process and is used when no pool is given.
+'''
+import os
+import shutil
+import tempfile
+import itertools
+import traceback
+from multiprocessing import Pool, util
+
+import GMOS_parallel
+import GMOS_instrumentation
+
+#IRAF package each task is loaded from
+TASK_PACKAGES = {'gbias':'gmos',
+                 'giflat':'gmos',
+                 'gireduce':'gmos',
+                 'gmosaic':'gmos',
+                 'imcoadd':'gemtools',
+                 'gemextn':'gemtools',
+                 'imdelete':'iraf',
+                 'delete':'iraf'}
+
+#Tasks whose parameters must also be reset before running a task
+#(gemextn parameters left by earlier tasks break gmosaic)
+UNLEARN_FIRST = {'gmosaic':['gemextn']}
+
+_packages = {}
+
+#Numbers the private logfiles of the jobs run by this process
+_job_numbers = itertools.count()
+
+def load_packages():
+    '''
+    Import PyRAF and the Gemini IRAF packages the first time they are needed in this
+    process and return a dictionary of package name: package
+    '''
+    if len(_packages) == 0:
+        from pyraf import iraf
+        from pyraf.iraf import gemini, gemtools, gmos
+        _packages.update({'iraf':iraf, 'gemini':gemini, 'gemtools':gemtools, 'gmos':gmos})
+    return _packages
+
+def _task(task_name):
+    return getattr(load_packages()[TASK_PACKAGES[task_name]], task_name)
+
+def _read_log(logfile):
+    if (logfile is None) or (not os.path.exists(logfile)):
+        return ''
+    with open(logfile, 'r') as ofile:
+        return ofile.read()
+
+def _job_logfile(logfile):
+    '''
+    Name of the private logfile of a job whose task logs to logfile
+    '''
+    root, ext = os.path.splitext(os.path.basename(logfile))
+    return '{}_{}_{}{}'.format(root, os.getpid(), next(_job_numbers), ext)
+
+def _output_files(outputs):
+    #IRAF image names may be given without their .fits extension
+    return set(outputs) | set('{}.fits'.format(ifile) for ifile in outputs)
+
+def run_task(task_name, args=(), flags=None, directory=None, outputs=None, workspace_dir=None):
+    '''
+    Run an IRAF task in this process with its default parameters except for flags
+
+    Input:
+        task_name: str
+            name of the task (a key of TASK_PACKAGES)
+        args: list
+            positional arguments of the task (e.g. input and output images)
+        flags: dict
+            task parameters
+        directory: str
+            directory the task is run in. If None, the current directory is used.
+            IRAF has its own current directory, which is set to this directory
+        outputs: list
+            names of the files the task is expected to create
+        workspace_dir: str
+            if given (e.g. /dev/shm), a task with outputs is run in a private directory
+            of workspace_dir with links to the files of directory. Only the outputs are
+            moved to directory; all other files the task writes are removed with the
+            private directory
+    Output:
+        result: dict
+            'outputs': the files of outputs which exist after running the task
+            'log': the text the task logged. The task logs to a private logfile, which
+            is appended to flags['logfile'] (relative to directory) in one write
+    '''
+    if flags is None:
+        flags = {}
+    if directory is None:
+        directory = os.getcwd()
+    if outputs is None:
+        outputs = []
+    directory = os.path.abspath(directory)
+    iraf = load_packages()['iraf']
+    logfile = flags.get('logfile')
+    job_log_path = None
+    if logfile is not None:
+        job_logfile = _job_logfile(logfile)
+        flags = dict(flags, logfile=job_logfile)
+    workdir = None
+    if (workspace_dir is not None) and (len(outputs) > 0):
+        workdir = tempfile.mkdtemp(prefix='{}_'.format(task_name), dir=workspace_dir)
+    try:
+        if workdir is not None:
+            GMOS_parallel._link_inputs(directory, workdir, exclude=_output_files(outputs) | set([logfile]))
+        task_dir = directory if workdir is None else workdir
+        job_log_path = None if logfile is None else os.path.join(task_dir, job_logfile)
+        iraf.chdir(task_dir)
+        with GMOS_instrumentation.stage(task_name, module='iraf', task=task_name, files=len(outputs)):
+            for other_task in UNLEARN_FIRST.get(task_name, []):
+                _task(other_task).unlearn()
+            task = _task(task_name)
+            task.unlearn()
+            task(*args, **flags)
+        log = _read_log(job_log_path)
+        if workdir is not None:
+            for ifile in _output_files(outputs):
+                if os.path.isfile(os.path.join(workdir, ifile)):
+                    GMOS_parallel.move_file(os.path.join(workdir, ifile), os.path.join(directory, ifile))
+    finally:
+        #The log of a failed task is kept too
+        if (job_log_path is not None) and os.path.exists(job_log_path):
+            with open(os.path.join(directory, logfile), 'a') as merged_log:
+                merged_log.write(_read_log(job_log_path))
+            os.remove(job_log_path)
+        if workdir is not None:
+            iraf.chdir(directory)
+            shutil.rmtree(workdir, ignore_errors=True)
+    created = [ifile for ifile in outputs
+               if os.path.exists(os.path.join(directory, ifile)) or
+               os.path.exists(os.path.join(directory, '{}.fits'.format(ifile)))]
+    return {'outputs':created, 'log':log}
+
+def _init_worker(scratch_dir):
+    '''
+    Give the worker its own uparm and tmp directories and load the IRAF packages
+    '''
+    workdir = tempfile.mkdtemp(prefix='iraf_worker_', dir=scratch_dir)
+    util.Finalize(None, shutil.rmtree, args=(workdir, True), exitpriority=10)
+    GMOS_parallel.set_iraf_scratch(workdir)
+    load_packages()
+
+def _run_job(job):
+    task_name, args, flags, directory, outputs, workspace_dir = job
+    try:
+        result = run_task(task_name, args, flags, directory, outputs, workspace_dir)
+        result['error'] = None
+    except BaseException: #IRAF tasks can exit the interpreter
+        result = {'outputs':[], 'log':'', 'error':traceback.format_exc()}
+    return result
+
+class IrafPool(object):
+    '''
+    A pool of nprocesses worker processes which each load PyRAF and the Gemini
+    packages once and then run IRAF tasks sent with submit or run. Each worker
+    has its own uparm and tmp directory in scratch_dir (default: the system
+    temporary directory).
+
+    Use as a context manager:
+        with IrafPool(4) as pool:
+            create_master_bias(qd, dbFile, data_dir, iraf_pool=pool)
+    '''
+    def __init__(self, nprocesses=1, scratch_dir=None):
+        self.pool = Pool(nprocesses, initializer=_init_worker, initargs=(scratch_dir,))
+
+    def submit(self, task_name, args=(), flags=None, directory=None, outputs=None):
+        '''
+        Queue a task (see run_task) and return a multiprocessing AsyncResult.
+        directory defaults to the current directory of the calling process, and the
+        task runs in the workspace of the calling process (see GMOS_parallel.workspace).
+        '''
+        if directory is None:
+            directory = os.getcwd()
+        job = (task_name, list(args), flags, os.path.abspath(directory), outputs,
+               GMOS_parallel.get_workspace_dir())
+        return self.pool.apply_async(_run_job, (job,))
+
+    def run(self, task_name, args=(), flags=None, directory=None, outputs=None):
+        '''
+        Run a task on a worker and wait for it to finish. Raises a RuntimeError if
+        the task failed.
+        '''
+        result = self.submit(task_name, args, flags, directory, outputs).get()
+        if result['error'] is not None:
+            raise RuntimeError('IRAF task {} failed:\n{}'.format(task_name, result['error']))
+        return result
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
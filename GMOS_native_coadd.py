@@ -0,0 +1,337 @@
+'''
+In-process replacement for imcoadd for the mosaicked (mrg*) images.
+
+The output grid is a tangent plane projection with the orientation and pixel scale of
+the first image and a footprint covering the union of all of the images. Each image is
+reprojected onto the output grid with bilinear interpolation and the images are combined
+with an inverse-variance weighted mean, ignoring pixels flagged in the DQ plane. The
+output is built one tile of rows at a time and the input images are memory mapped, so
+only the rows of each image which overlap the current tile are read and the memory used
+does not grow with the number of images.
+
+The transformation from output to input pixels is computed exactly (with the full WCS
+of the input image) on a coarse grid and interpolated between the grid points.
+'''
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import GMOS_compressed_io
+import GMOS_native_reduction as reduction
+
+class MosaicFrame(object):
+    '''
+    Memory-mapped SCI, VAR, and DQ planes and the WCS of a mosaicked image (one SCI
+    extension, as written by gmosaic). The VAR and DQ planes are None if the image
+    doesn't have them.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.ofile = fits.open(filename, memmap=True, do_not_scale_image_data=True)
+        planes = {}
+        for hdu in self.ofile[1:]:
+            extname = hdu.header.get('EXTNAME', 'SCI')
+            if (hdu.header.get('NAXIS', 0) == 2) and (extname not in planes):
+                planes[extname] = hdu
+        self.header = planes['SCI'].header
+        self.wcs = WCS(self.header)
+        self.sci = planes['SCI']
+        self.var = planes.get('VAR')
+        self.dq = planes.get('DQ')
+        self.shape = self.sci.data.shape
+
+    def border(self, step=64):
+        '''
+        0-indexed pixel coordinates (x, y) of points along the edge of the image
+        '''
+        nrows, ncolumns = self.shape
+        xs = np.unique(np.append(np.arange(0, ncolumns, step), ncolumns-1))
+        ys = np.unique(np.append(np.arange(0, nrows, step), nrows-1))
+        x = np.concatenate([xs, xs, np.zeros_like(ys), np.full_like(ys, ncolumns-1)])
+        y = np.concatenate([np.zeros_like(xs), np.full_like(xs, nrows-1), ys, ys])
+        return x.astype(float), y.astype(float)
+
+    def read_rows(self, start, stop, dtype=np.float32):
+        '''
+        Read rows start:stop of the SCI, VAR, and DQ planes
+        '''
+        sci = reduction.scale_array(self.sci.data[start:stop], self.sci.header, dtype)
+        if self.var is not None:
+            var = reduction.scale_array(self.var.data[start:stop], self.var.header, dtype)
+        else:
+            var = np.ones_like(sci)
+        if self.dq is not None:
+            dq = reduction.scale_array(self.dq.data[start:stop], self.dq.header, np.uint16)
+        else:
+            dq = np.zeros(sci.shape, dtype=np.uint16)
+        return sci, var, dq
+
+    def close(self):
+        self.ofile.close()
+
+def union_grid(frames, reference=0):
+    '''
+    Compute the output grid which covers all of the frames
+
+    Input:
+        frames: list
+            list of MosaicFrame
+        reference: int
+            index of the frame whose tangent point, orientation, and pixel scale are used
+    Output:
+        wcs: astropy.wcs.WCS
+            linear TAN WCS of the output grid
+        shape: tuple
+            (rows, columns) of the output grid
+    '''
+    ref_wcs = frames[reference].wcs
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = ref_wcs.wcs.crval
+    wcs.wcs.crpix = ref_wcs.wcs.crpix
+    wcs.wcs.cd = ref_wcs.pixel_scale_matrix
+    xmin, ymin, xmax, ymax = np.inf, np.inf, -np.inf, -np.inf
+    for frame in frames:
+        x, y = frame.border()
+        ra, dec = frame.wcs.all_pix2world(x, y, 0)
+        xout, yout = wcs.wcs_world2pix(ra, dec, 0)
+        xmin, xmax = min(xmin, xout.min()), max(xmax, xout.max())
+        ymin, ymax = min(ymin, yout.min()), max(ymax, yout.max())
+    x0, y0 = np.floor(xmin), np.floor(ymin)
+    wcs.wcs.crpix = wcs.wcs.crpix - np.array([x0, y0])
+    shape = (int(np.ceil(ymax) - y0) + 1, int(np.ceil(xmax) - x0) + 1)
+    return wcs, shape
+
+def _bilinear(planes, x, y):
+    '''
+    Bilinear interpolation of a list of 2D arrays at the 0-indexed pixel coordinates
+    x, y (arrays of the same shape). Each pixel covers +/-0.5 pixels around its
+    center; points within half a pixel of the edge take the value of the edge pixels
+    and points outside of the arrays are NaN.
+
+    Output:
+        values: list
+            interpolated arrays, one for each floating point plane (None for integer
+            planes such as DQ, which can't be interpolated)
+        weights: list
+            interpolation weights of the four neighbouring pixels
+        corners: list
+            values of the four neighbouring pixels of each plane
+        inside: array
+            True for points inside of the arrays
+    '''
+    nrows, ncolumns = planes[0].shape
+    inside = (x >= -0.5) & (x < ncolumns-0.5) & (y >= -0.5) & (y < nrows-0.5)
+    x = np.where(inside, np.clip(x, 0, ncolumns-1), 0)
+    y = np.where(inside, np.clip(y, 0, nrows-1), 0)
+    x0 = np.clip(np.floor(x).astype(np.intp), 0, max(ncolumns-2, 0))
+    y0 = np.clip(np.floor(y).astype(np.intp), 0, max(nrows-2, 0))
+    fx = x - x0
+    fy = y - y0
+    x1 = np.minimum(x0 + 1, ncolumns-1)
+    y1 = np.minimum(y0 + 1, nrows-1)
+    weights = [(1-fx)*(1-fy), fx*(1-fy), (1-fx)*fy, fx*fy]
+    #Indices into the flattened arrays (np.take is much faster than 2D fancy indexing)
+    indices = [y0*ncolumns + x0, y0*ncolumns + x1, y1*ncolumns + x0, y1*ncolumns + x1]
+    values = []
+    corners = []
+    for plane in planes:
+        flat_plane = np.ascontiguousarray(plane).ravel()
+        plane_corners = [flat_plane.take(index) for index in indices]
+        corners.append(plane_corners)
+        if plane.dtype.kind == 'f':
+            value = sum(w*c for w, c in zip(weights, plane_corners))
+            values.append(np.where(inside, value, np.nan))
+        else:
+            values.append(None)
+    return values, weights, corners, inside
+
+def _pixel_map(frame, wcs, start, stop, columns, step=16):
+    '''
+    Pixel coordinates in frame of the output pixels in rows start:stop and columns
+    columns (a slice), computed exactly every step pixels and interpolated in between
+    '''
+    rows = np.arange(start, stop)
+    cols = np.arange(columns.start, columns.stop)
+    coarse_rows = np.unique(np.append(rows[::step], rows[-1]))
+    coarse_cols = np.unique(np.append(cols[::step], cols[-1]))
+    xg, yg = np.meshgrid(coarse_cols, coarse_rows)
+    ra, dec = wcs.wcs_pix2world(xg.ravel(), yg.ravel(), 0)
+    xin, yin = frame.wcs.all_world2pix(ra, dec, 0)
+    xin = xin.reshape(xg.shape)
+    yin = yin.reshape(xg.shape)
+    #The grid is regular, so interpolate along the columns and then along the rows
+    ix = np.interp(cols, coarse_cols, np.arange(len(coarse_cols)))
+    iy = np.interp(rows, coarse_rows, np.arange(len(coarse_rows)))
+    x0 = np.minimum(np.floor(ix).astype(np.intp), len(coarse_cols)-1)
+    y0 = np.minimum(np.floor(iy).astype(np.intp), len(coarse_rows)-1)
+    x1 = np.minimum(x0 + 1, len(coarse_cols)-1)
+    y1 = np.minimum(y0 + 1, len(coarse_rows)-1)
+    fx = ix - x0
+    fy = (iy - y0)[:, None]
+    maps = []
+    for coarse in [xin, yin]:
+        along_columns = coarse[:, x0]*(1-fx) + coarse[:, x1]*fx
+        maps.append(along_columns[y0]*(1-fy) + along_columns[y1]*fy)
+    return maps[0], maps[1]
+
+def _frame_bounds(frame, wcs, shape):
+    '''
+    Range of output rows and columns covered by frame
+    '''
+    x, y = frame.border()
+    ra, dec = frame.wcs.all_pix2world(x, y, 0)
+    xout, yout = wcs.wcs_world2pix(ra, dec, 0)
+    row_range = (max(int(np.floor(yout.min()-0.5)), 0), min(int(np.ceil(yout.max()+0.5))+1, shape[0]))
+    column_range = (max(int(np.floor(xout.min()-0.5)), 0), min(int(np.ceil(xout.max()+0.5))+1, shape[1]))
+    return row_range, column_range
+
+def accumulate_tile(frames, wcs, shape, start, stop, scales=None, bounds=None, dtype=np.float32):
+    '''
+    Reproject the frames onto rows start:stop of the output grid and combine them
+
+    Input:
+        frames: list
+            list of MosaicFrame
+        wcs, shape:
+            output grid (see union_grid)
+        start, stop: int
+            rows of the output grid
+        scales: array
+            each frame is divided by its scale. If None, frames are not scaled
+        bounds: list
+            output rows and columns covered by each frame (see _frame_bounds). Frames
+            which don't overlap the tile are skipped
+        dtype: numpy dtype
+            data type of the tiles read from the frames
+    Output:
+        sci, var, dq: array
+            inverse-variance weighted mean, its variance, and the DQ plane of the tile.
+            Pixels without good data in any frame are 0 and flagged DQ_NODATA
+    '''
+    ncolumns = shape[1]
+    weighted_sum = np.zeros((stop-start, ncolumns), dtype=np.float64)
+    weight_sum = np.zeros((stop-start, ncolumns), dtype=np.float64)
+    for iframe, frame in enumerate(frames):
+        if bounds is None:
+            row_range, column_range = _frame_bounds(frame, wcs, shape)
+        else:
+            row_range, column_range = bounds[iframe]
+        tile_start, tile_stop = max(start, row_range[0]), min(stop, row_range[1])
+        if (tile_start >= tile_stop) or (column_range[0] >= column_range[1]):
+            continue
+        columns = slice(column_range[0], column_range[1])
+        xin, yin = _pixel_map(frame, wcs, tile_start, tile_stop, columns)
+        #Only read the rows of the frame which are needed for this tile
+        finite = np.isfinite(yin)
+        if not np.any(finite):
+            continue
+        first_row = min(max(int(np.floor(yin[finite].min())), 0), frame.shape[0])
+        last_row = max(min(int(np.ceil(yin[finite].max()))+1, frame.shape[0]), 0)
+        if first_row >= last_row:
+            continue
+        sci, var, dq = frame.read_rows(first_row, last_row, dtype=dtype)
+        if scales is not None:
+            sci = sci/scales[iframe]
+            var = var/scales[iframe]**2
+        (sci_out, var_out, dq_out), weights, corners, inside = _bilinear([sci, var, dq], xin, yin - first_row)
+        bad = np.zeros(sci_out.shape, dtype=bool)
+        for weight, dq_corner in zip(weights, corners[2]):
+            bad |= (weight > 0) & (dq_corner != 0)
+        good = inside & ~bad & (var_out > 0) & np.isfinite(sci_out)
+        weight = np.where(good, 1./np.where(good, var_out, 1), 0)
+        out_rows = slice(tile_start - start, tile_stop - start)
+        weighted_sum[out_rows, columns] += weight*np.where(good, sci_out, 0)
+        weight_sum[out_rows, columns] += weight
+    covered = weight_sum > 0
+    sci = np.where(covered, weighted_sum/np.where(covered, weight_sum, 1), 0)
+    var = np.where(covered, 1./np.where(covered, weight_sum, 1), 0)
+    dq = np.where(covered, 0, reduction.DQ_NODATA).astype(np.uint16)
+    return sci.astype(np.float32), var.astype(np.float32), dq
+
+#Frames and grid of a worker process, set by _init_worker
+_worker = {}
+
+def _init_worker(file_list, header, shape, scales):
+    _worker['frames'] = [MosaicFrame(ifile) for ifile in file_list]
+    _worker['wcs'] = WCS(header)
+    _worker['shape'] = shape
+    _worker['scales'] = scales
+    _worker['bounds'] = [_frame_bounds(frame, _worker['wcs'], shape) for frame in _worker['frames']]
+
+def _accumulate_worker_tile(rows):
+    start, stop = rows
+    return start, accumulate_tile(_worker['frames'], _worker['wcs'], _worker['shape'], start, stop,
+                                  scales=_worker['scales'], bounds=_worker['bounds'])
+
+def coadd_frames(file_list, output_filename, reference=0, normalize_exptime=True,
+                 tile_rows=256, nprocesses=1, compress=False,
+                 quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL):
+    '''
+    Co-add mosaicked images onto the union of their footprints (the equivalent of
+    imcoadd, without its intermediate files)
+
+    Input:
+        file_list: list
+            mosaicked images (with or without the .fits extension)
+        output_filename: str
+            name of the co-added image
+        reference: int
+            index of the image whose tangent point, orientation, and pixel scale are
+            used for the output grid
+        normalize_exptime: bool
+            if True, each image is scaled to the exposure time of the reference image
+            (whose EXPTIME is kept in the output header)
+        tile_rows: int
+            number of output rows combined at a time
+        nprocesses: int
+            number of worker processes combining tiles. Each worker memory maps the images
+        compress, quantize_level:
+            write the co-added image tile-compressed (see GMOS_compressed_io.write_fits)
+    Output:
+        the co-added image is written to output_filename with SCI, VAR, and DQ extensions
+    '''
+    file_list = [GMOS_compressed_io.resolve_fits(str(ifile)) for ifile in file_list]
+    frames = [MosaicFrame(ifile) for ifile in file_list]
+    try:
+        wcs, shape = union_grid(frames, reference=reference)
+        primary_header = frames[reference].ofile[0].header.copy()
+        if normalize_exptime:
+            exptimes = np.array([frame.ofile[0].header.get('EXPTIME', 1.) for frame in frames], dtype=float)
+            scales = exptimes/exptimes[reference]
+        else:
+            scales = None
+        sci = np.zeros(shape, dtype=np.float32)
+        var = np.zeros(shape, dtype=np.float32)
+        dq = np.zeros(shape, dtype=np.uint16)
+        tiles = [(start, min(start + tile_rows, shape[0])) for start in range(0, shape[0], tile_rows)]
+        if nprocesses > 1:
+            pool = Pool(nprocesses, initializer=_init_worker,
+                        initargs=(file_list, wcs.to_header(), shape, scales))
+            try:
+                for start, (tile_sci, tile_var, tile_dq) in pool.imap_unordered(_accumulate_worker_tile, tiles):
+                    stop = start + tile_sci.shape[0]
+                    sci[start:stop], var[start:stop], dq[start:stop] = tile_sci, tile_var, tile_dq
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            bounds = [_frame_bounds(frame, wcs, shape) for frame in frames]
+            for start, stop in tiles:
+                sci[start:stop], var[start:stop], dq[start:stop] = \
+                    accumulate_tile(frames, wcs, shape, start, stop, scales=scales, bounds=bounds)
+    finally:
+        for frame in frames:
+            frame.close()
+    primary_header['NCOMBINE'] = (len(file_list), 'Number of images co-added')
+    for ifile, filename in enumerate(file_list):
+        primary_header['IMCMB{:03d}'.format(ifile+1)] = filename
+    hdulist = [fits.PrimaryHDU(header=primary_header)]
+    for extname, plane in [('SCI', sci), ('VAR', var), ('DQ', dq)]:
+        hdu = fits.ImageHDU(data=plane, header=wcs.to_header())
+        hdu.header['EXTNAME'] = extname
+        hdu.header['EXTVER'] = 1
+        hdulist.append(hdu)
+    GMOS_compressed_io.write_fits(hdulist, output_filename, compress, quantize_level)
@@ -0,0 +1,368 @@
+'''
+Out-of-core sigma-clipped combination of GMOS frames into master calibrations.
+
+Frames are read from memory-mapped files one tile of rows at a time (for all amplifiers
+and all input frames), so the memory used is set by max_memory and not by the number of
+frames combined. Compressed frames (.fits.bz2 or tile-compressed) are first decompressed
+to a temporary file in a scratch directory, which is memory mapped in the same way. Raw
+frames are overscan subtracted, trimmed and (for flats) bias subtracted as each tile is
+read. The VAR and DQ planes are propagated to the master.
+'''
+import os
+import warnings
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from astropy.io import fits
+
+import GMOS_compressed_io
+import GMOS_parallel
+import GMOS_native_reduction as reduction
+
+class FrameReader(object):
+    '''
+    Memory-mapped access to tiles of rows of the trimmed amplifiers of one frame.
+
+    Raw frames (with a BIASSEC keyword) are overscan subtracted with the same model as
+    GMOS_native_reduction.reduce_frame; the overscan fit only reads the overscan columns.
+    Their VAR plane is computed from the gain and read noise and their DQ plane flags
+    saturated pixels. Reduced frames (SCI, VAR, DQ extensions) are read as they are.
+
+    Compressed frames are decompressed to a file in scratch_dir (default: the system
+    temporary directory), which is removed by close (or if the frame can't be read).
+    '''
+    def __init__(self, filename, overscan_order=1, nbiascontam=4, saturation=None, scratch_dir=None):
+        self.filename = filename
+        self.scratch_filename = None
+        self.ofile = None
+        if not filename.endswith('.bz2'):
+            self.ofile = fits.open(filename, memmap=True, do_not_scale_image_data=True)
+        try:
+            if GMOS_compressed_io.is_compressed(filename, self.ofile):
+                if self.ofile is not None:
+                    self.ofile.close()
+                    self.ofile = None
+                self.scratch_filename = GMOS_compressed_io.uncompressed_copy(filename, scratch_dir)
+                self.ofile = fits.open(self.scratch_filename, memmap=True, do_not_scale_image_data=True)
+            self._read_layout(overscan_order, nbiascontam, saturation)
+        except BaseException:
+            self.close()
+            raise
+
+    def _read_layout(self, overscan_order, nbiascontam, saturation):
+        exts = reduction.science_extensions(self.ofile)
+        self.headers = [ext.header for ext in exts]
+        #Access the data once so that the memory maps exist before any threads read them
+        self.sci = [ext.data for ext in exts]
+        self.is_raw = 'BIASSEC' in self.headers[0]
+        if self.is_raw:
+            biassecs, self.datasecs = reduction.amplifier_sections(self.headers, nbiascontam=nbiascontam)
+            nrows = self.sci[0].shape[0]
+            levels = [np.median(reduction.scale_array(data[biassec], header), axis=1)
+                      for data, header, biassec in zip(self.sci, self.headers, biassecs)]
+            fit_rows = np.arange(nrows)[biassecs[0][0]]
+            self.overscan = reduction.overscan_model(levels, fit_rows, nrows, order=overscan_order)
+            self.gain = np.array([header.get('GAIN', 1.) for header in self.headers])[:, None, None]
+            self.rdnoise = np.array([header.get('RDNOISE', 0.) for header in self.headers])[:, None, None]
+            if saturation is None:
+                saturation = self.headers[0].get('SATLEVEL', 65535.)
+            self.saturation = saturation
+            self.var = None
+            self.dq = None
+        else:
+            self.datasecs = [(slice(0, data.shape[0]), slice(0, data.shape[1])) for data in self.sci]
+            self.var = [(hdu.data, hdu.header) for hdu in self.ofile[1:] if hdu.header.get('EXTNAME') == 'VAR']
+            self.dq = [(hdu.data, hdu.header) for hdu in self.ofile[1:] if hdu.header.get('EXTNAME') == 'DQ']
+        rows, columns = self.datasecs[0]
+        self.shape = (len(self.sci), rows.stop - rows.start, columns.stop - columns.start)
+
+    def read(self, start, stop, step=1, dtype=np.float32):
+        '''
+        Read rows start:stop:step (in trimmed coordinates) of every amplifier
+
+        Output:
+            sci, var, dq: array
+                (amplifier, row, column) arrays
+        '''
+        sci = []
+        var = []
+        dq = []
+        for iamp, (data, header, datasec) in enumerate(zip(self.sci, self.headers, self.datasecs)):
+            rows = slice(datasec[0].start + start, datasec[0].start + stop, step)
+            amp = reduction.scale_array(data[rows, datasec[1]], header, dtype)
+            if self.is_raw:
+                saturated = amp >= self.saturation
+                amp -= self.overscan[iamp, rows][:, None].astype(dtype)
+                gain = self.gain[iamp]
+                var.append(np.clip(amp, 0, None)/gain + (self.rdnoise[iamp]/gain)**2)
+                dq.append(np.where(saturated, reduction.DQ_SATURATED, 0).astype(np.uint16))
+            else:
+                if len(self.var) > 0:
+                    var_data, var_header = self.var[iamp]
+                    var.append(reduction.scale_array(var_data[rows], var_header, dtype))
+                else:
+                    var.append(np.zeros_like(amp))
+                if len(self.dq) > 0:
+                    dq_data, dq_header = self.dq[iamp]
+                    dq.append(reduction.scale_array(dq_data[rows], dq_header, np.uint16))
+                else:
+                    dq.append(np.zeros(amp.shape, dtype=np.uint16))
+            sci.append(amp)
+        sci = np.array(sci, dtype=dtype)
+        var = np.array(var, dtype=dtype)
+        dq = np.array(dq, dtype=np.uint16)
+        return sci, var, dq
+
+    def sample_mean(self, step=16, bias=None):
+        '''
+        Sigma-clipped mean of the good pixels of every step-th row. bias is the
+        (sci, var, dq) of the same rows of a master bias (read with the same step),
+        which is subtracted first.
+        '''
+        sci, var, dq = self.read(0, self.shape[1], step=step)
+        if bias is not None:
+            sci -= bias[0]
+            dq |= bias[2]
+        mean, median, std = reduction.clipped_stats(sci[dq == 0])
+        return mean
+
+    def close(self):
+        if self.ofile is not None:
+            self.ofile.close()
+        if self.scratch_filename is not None:
+            os.remove(self.scratch_filename)
+            self.scratch_filename = None
+
+def clipped_combine(sci, var, dq, method='mean', sigma=3.0, iters=3):
+    '''
+    Combine a stack of frames along the first axis, rejecting pixels flagged in the DQ
+    plane and pixels more than sigma standard deviations from the median
+
+    Input:
+        sci, var, dq: array
+            (frame, ...) arrays
+        method: str
+            'mean' or 'median'
+        sigma: float
+            rejection threshold
+        iters: int
+            maximum number of rejection iterations
+    Output:
+        sci, var, dq: array
+            combined arrays. Pixels for which every frame was rejected are the mean of
+            all frames and are flagged with the DQ bits set in every frame (or DQ_NODATA
+            if the frames were rejected by the clipping)
+    '''
+    data = np.where(dq == 0, sci, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for i in range(iters):
+            center = np.nanmedian(data, axis=0)
+            std = np.nanstd(data, axis=0)
+            reject = np.abs(data - center) > sigma*std
+            if not np.any(reject):
+                break
+            data[reject] = np.nan
+        good = np.isfinite(data)
+        ngood = good.sum(axis=0)
+        if method == 'median':
+            combined = np.nanmedian(data, axis=0)
+        else:
+            combined = np.nanmean(data, axis=0)
+    combined_var = np.where(good, var, 0).sum(axis=0)/np.clip(ngood, 1, None)**2
+    if method == 'median':
+        combined_var *= np.pi/2.
+    combined_dq = np.bitwise_and.reduce(dq, axis=0)
+    nodata = ngood == 0
+    if np.any(nodata):
+        nframes = sci.shape[0]
+        combined[nodata] = sci.mean(axis=0)[nodata]
+        combined_var[nodata] = var.sum(axis=0)[nodata]/nframes**2
+        combined_dq[nodata & (combined_dq == 0)] = reduction.DQ_NODATA
+    return combined.astype(sci.dtype), combined_var.astype(sci.dtype), combined_dq
+
+def combine_frames(readers, method='mean', sigma=3.0, iters=3, scales=None, bias=None,
+                   dtype=np.float32, max_memory=2**28, nthreads=1):
+    '''
+    Combine frames tile by tile
+
+    Input:
+        readers: list
+            list of FrameReader, one for each input frame
+        method, sigma, iters:
+            parameters of clipped_combine
+        scales: array
+            each frame is divided by its scale before combining. If None, frames are
+            not scaled
+        bias: FrameReader
+            master bias subtracted from every frame (before scaling). Each tile of the
+            bias is read once and subtracted from the tiles of all frames
+        dtype: numpy dtype
+            data type of the tiles (the accumulator)
+        max_memory: int
+            approximate maximum number of bytes used by the tiles
+        nthreads: int
+            number of tiles combined in parallel (the memory of each tile is reduced
+            so that max_memory is still respected)
+    Output:
+        sci, var, dq: array
+            (amplifier, row, column) arrays of the combined frame
+    '''
+    namps, nrows, ncolumns = readers[0].shape
+    for reader in readers + ([bias] if bias is not None else []):
+        if reader.shape != readers[0].shape:
+            raise ValueError('{} has shape {}, not {}'.format(reader.filename, reader.shape, readers[0].shape))
+    sci = np.zeros(readers[0].shape, dtype=dtype)
+    var = np.zeros(readers[0].shape, dtype=dtype)
+    dq = np.zeros(readers[0].shape, dtype=np.uint16)
+    #sci, var, the clipping copy and masks for every frame (and the bias)
+    nframes = len(readers) + (1 if bias is not None else 0)
+    bytes_per_row = nframes*namps*ncolumns*(4*np.dtype(dtype).itemsize + 4)
+    tile_rows = int(max(1, min(nrows, max_memory//(nthreads*bytes_per_row))))
+
+    def combine_tile(start):
+        stop = min(start + tile_rows, nrows)
+        tile_sci = np.empty((len(readers), namps, stop-start, ncolumns), dtype=dtype)
+        tile_var = np.empty_like(tile_sci)
+        tile_dq = np.empty(tile_sci.shape, dtype=np.uint16)
+        for iframe, reader in enumerate(readers):
+            tile_sci[iframe], tile_var[iframe], tile_dq[iframe] = reader.read(start, stop, dtype=dtype)
+        if bias is not None:
+            bias_sci, bias_var, bias_dq = bias.read(start, stop, dtype=dtype)
+            tile_sci -= bias_sci
+            tile_var += bias_var
+            tile_dq |= bias_dq
+        if scales is not None:
+            frame_scales = np.asarray(scales)[:, None, None, None]
+            tile_sci /= frame_scales
+            tile_var /= frame_scales**2
+        sci[:, start:stop], var[:, start:stop], dq[:, start:stop] = \
+            clipped_combine(tile_sci, tile_var, tile_dq, method=method, sigma=sigma, iters=iters)
+
+    tiles = range(0, nrows, tile_rows)
+    if nthreads > 1:
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(combine_tile, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start in tiles:
+            combine_tile(start)
+    return sci, var, dq
+
+def _fits_names(file_list):
+    return [GMOS_compressed_io.resolve_fits(str(ifile)) for ifile in file_list]
+
+def _primary_header(readers, file_list):
+    primary_header = readers[0].ofile[0].header.copy()
+    primary_header['NCOMBINE'] = (len(file_list), 'Number of frames combined')
+    for ifile, filename in enumerate(file_list):
+        primary_header['IMCMB{:03d}'.format(ifile+1)] = filename
+    return primary_header
+
+def _scratch_dir(scratch_dir):
+    if scratch_dir is None:
+        return GMOS_parallel.get_workspace_dir()
+    return scratch_dir
+
+def make_master_bias(file_list, output_filename, method='mean', sigma=3.0, iters=3,
+                     dtype=np.float32, max_memory=2**28, nthreads=1, overscan_order=1,
+                     compress=False, quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL,
+                     scratch_dir=None):
+    '''
+    Create a master bias (the equivalent of gbias) from raw bias frames. Each frame is
+    overscan subtracted and trimmed, then the frames are combined with sigma clipping.
+
+    Input:
+        file_list: list
+            raw bias frames (with or without the .fits extension)
+        output_filename: str
+            name of the master bias
+        method, sigma, iters:
+            combination method ('mean' or 'median'), rejection threshold and iterations
+        dtype: numpy dtype
+            data type of the accumulator
+        max_memory: int
+            approximate maximum number of bytes used by the tiles of input data
+        nthreads: int
+            number of threads combining tiles in parallel
+        overscan_order: int
+            order of the polynomial fit to the overscan
+        compress, quantize_level:
+            write the master bias tile-compressed (see GMOS_compressed_io.write_fits)
+        scratch_dir: str
+            directory of the uncompressed copies of compressed input frames (default: the
+            IRAF workspace, see GMOS_parallel.get_workspace_dir, if it is set, otherwise
+            the system temporary directory)
+    Output:
+        the master bias (with SCI, VAR, DQ extensions) is written to output_filename
+    '''
+    file_list = _fits_names(file_list)
+    scratch_dir = _scratch_dir(scratch_dir)
+    readers = []
+    try:
+        for ifile in file_list:
+            readers.append(FrameReader(ifile, overscan_order=overscan_order, scratch_dir=scratch_dir))
+        sci, var, dq = combine_frames(readers, method=method, sigma=sigma, iters=iters,
+                                      dtype=dtype, max_memory=max_memory, nthreads=nthreads)
+        reduction.write_planes(output_filename, _primary_header(readers, file_list),
+                               readers[0].headers, sci, var, dq, compress=compress,
+                               quantize_level=quantize_level)
+    finally:
+        for reader in readers:
+            reader.close()
+
+def make_master_flat(file_list, output_filename, bias=None, bpm=None, method='mean', sigma=3.0,
+                     iters=3, dtype=np.float32, max_memory=2**28, nthreads=1, overscan_order=1,
+                     compress=False, quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL,
+                     scratch_dir=None):
+    '''
+    Create a normalized master flat (the equivalent of giflat with fl_scale=yes and
+    sctype=mean) from raw flat frames. Each frame is overscan subtracted, trimmed, bias
+    subtracted, and divided by its mean before being combined with sigma clipping. The
+    master flat is normalized to a mean of 1.
+
+    Input:
+        file_list: list
+            raw flat frames (with or without the .fits extension)
+        output_filename: str
+            name of the master flat
+        bias: str
+            master bias (trimmed, with SCI, VAR, DQ planes)
+        bpm: str
+            static bad pixel mask, flagged in the DQ plane of the master flat
+        method, sigma, iters, dtype, max_memory, nthreads, overscan_order, compress, quantize_level,
+        scratch_dir:
+            see make_master_bias
+    Output:
+        the master flat (with SCI, VAR, DQ extensions) is written to output_filename
+    '''
+    file_list = _fits_names(file_list)
+    scratch_dir = _scratch_dir(scratch_dir)
+    bias_reader = None
+    readers = []
+    try:
+        if bias is not None:
+            bias_reader = FrameReader(_fits_names([bias])[0], scratch_dir=scratch_dir)
+        for ifile in file_list:
+            readers.append(FrameReader(ifile, overscan_order=overscan_order, scratch_dir=scratch_dir))
+        bias_sample = bias_reader.read(0, bias_reader.shape[1], step=16) if bias_reader is not None else None
+        scales = np.array([reader.sample_mean(step=16, bias=bias_sample) for reader in readers])
+        sci, var, dq = combine_frames(readers, method=method, sigma=sigma, iters=iters, scales=scales,
+                                      bias=bias_reader, dtype=dtype, max_memory=max_memory,
+                                      nthreads=nthreads)
+        if bpm is not None:
+            dq |= reduction._load_bpm(bpm, readers[0].datasecs, readers[0].sci[0].shape, sci.shape[1:])
+        mean, median, std = reduction.clipped_stats(sci[dq == 0][::16])
+        sci /= mean
+        var /= mean**2
+        reduction.write_planes(output_filename, _primary_header(readers, file_list),
+                               readers[0].headers, sci, var, dq, compress=compress,
+                               quantize_level=quantize_level)
+    finally:
+        for reader in readers:
+            reader.close()
+        if bias_reader is not None:
+            bias_reader.close()
@@ -0,0 +1,254 @@
+'''
+In-process NumPy equivalent of gmosaic (geointer='nearest', fl_paste='no', fl_vardq='yes',
+fl_fulldq='yes') for GMOS 12 amplifier (Hamamatsu) imaging data.
+
+The amplifiers of each CCD are placed side by side, and the outer CCDs are shifted and
+rotated relative to the middle CCD (MOSAIC_GEOMETRY), with the gaps between the CCDs
+between them. With nearest neighbour interpolation every output pixel comes from one
+input pixel, so the whole transformation is an index map: the positions of the output
+pixels which have data and the positions (in the stacked amplifiers) of the input pixels
+they come from. Index maps are computed once per instrument, binning, region of interest
+and amplifier shape and kept for the following frames, and each plane (SCI, VAR, and
+DQ) of a frame is then mosaicked with a single fancy-indexing operation. Pixels without
+data (the gaps and the edges uncovered by the shifts and rotations) are flagged as no
+data in the DQ plane.
+
+The output has the same name (m + filename) and layout as the gmosaic output: a primary
+header followed by single SCI, VAR, and DQ extensions with the WCS of the middle CCD.
+'''
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+import GMOS_compressed_io
+import GMOS_native_reduction
+import GMOS_obslog
+
+#Unbinned width of a CCD
+CCD_COLUMNS = 2048
+NCCDS = 3
+
+#Gap between the CCDs (unbinned pixels) and the (x shift, y shift (unbinned pixels),
+#rotation (degrees, counterclockwise)) of each CCD relative to the middle CCD. These are
+#the nominal values for the Hamamatsu detectors; pass geometry to mosaic_frame to use
+#the values of the gmosaic geometry file of an installed Gemini package.
+MOSAIC_GEOMETRY = {'GMOS-N':{'gap':67, 'transforms':[(-1.2, 0.71, -0.01), (0., 0., 0.), (0., -0.94, -0.02)]},
+                   'GMOS-S':{'gap':61, 'transforms':[(-1.49, -0.22, 0.011), (0., 0., 0.), (4.31, 2.04, 0.012)]}}
+
+#Index maps are computed once per process for each key of _map_key
+_index_maps = {}
+
+def _binning(header):
+    xbin, ybin = [int(x) for x in str(header.get('CCDSUM', '1 1')).split()]
+    return xbin, ybin
+
+def amplifier_positions(headers, amp_columns):
+    '''
+    Return the (CCD number, first column in the CCD) of each amplifier, from the DETSEC
+    keyword or, if the headers don't have one, from the order of the extensions
+    (4 amplifiers per CCD, left to right)
+    '''
+    positions = []
+    for iamp, header in enumerate(headers):
+        if 'DETSEC' in header:
+            xbin, ybin = _binning(header)
+            rows, columns = GMOS_native_reduction.parse_section(header['DETSEC'])
+            positions.append((columns.start//CCD_COLUMNS, (columns.start % CCD_COLUMNS)//xbin))
+        else:
+            namps_ccd = len(headers)//NCCDS
+            positions.append((iamp//namps_ccd, (iamp % namps_ccd)*amp_columns))
+    return positions
+
+def index_map(amp_shape, positions, binning, geometry):
+    '''
+    Compute the index map of the mosaic
+
+    Input:
+        amp_shape: tuple
+            (rows, columns) of the trimmed amplifiers
+        positions: list
+            (CCD number, first column in the CCD) of each amplifier (see amplifier_positions)
+        binning: tuple
+            (x, y) binning
+        geometry: dict
+            'gap' and 'transforms' of the detector (see MOSAIC_GEOMETRY)
+    Output:
+        index_map: dict
+            'shape': shape of the mosaic, 'target': flat indices of the mosaic pixels
+            which have data, 'source': flat indices (in the (amplifier, row, column)
+            stack of the amplifiers) of the pixels they come from, and 'ccd_x0': the
+            first column of each CCD in the mosaic
+    '''
+    nrows, amp_columns = amp_shape
+    xbin, ybin = binning
+    ccd_columns = CCD_COLUMNS//xbin
+    gap = int(round(geometry['gap']/float(xbin)))
+    shape = (nrows, NCCDS*ccd_columns + (NCCDS-1)*gap)
+    #Look up the amplifier of each column of each CCD
+    amp_lookup = np.full((NCCDS, ccd_columns), -1, dtype=np.int64)
+    amp_start = np.array([start for iccd, start in positions], dtype=np.int64)
+    for iamp, (iccd, start) in enumerate(positions):
+        amp_lookup[iccd, start:start+amp_columns] = iamp
+    targets = []
+    sources = []
+    ccd_x0 = []
+    for iccd, (xshift, yshift, rotation) in enumerate(geometry['transforms']):
+        x0 = iccd*(ccd_columns + gap)
+        ccd_x0.append(x0)
+        #Output pixels which can receive data from this CCD (rotations are small)
+        margin = int(np.ceil(abs(xshift)/xbin)) + 2
+        xlow, xhigh = max(x0 - margin, 0), min(x0 + ccd_columns + margin, shape[1])
+        yout, xout = np.mgrid[0:nrows, xlow:xhigh]
+        #Invert the shift and the rotation about the center of the CCD
+        center_x, center_y = (ccd_columns - 1)/2., (nrows - 1)/2.
+        dx = xout - x0 - xshift/xbin - center_x
+        dy = yout - yshift/ybin - center_y
+        theta = np.radians(rotation)
+        xin = np.rint(center_x + dx*np.cos(theta) + dy*np.sin(theta)).astype(np.int64)
+        yin = np.rint(center_y - dx*np.sin(theta) + dy*np.cos(theta)).astype(np.int64)
+        inside = (xin >= 0) & (xin < ccd_columns) & (yin >= 0) & (yin < nrows)
+        #Only the pixels closest to this CCD, so that the margins of neighbouring CCDs
+        #don't overwrite each other
+        inside &= (xout >= x0 - gap//2) & (xout < x0 + ccd_columns + gap - gap//2)
+        amp = amp_lookup[iccd, np.clip(xin, 0, ccd_columns-1)]
+        inside &= amp >= 0
+        amp, xin, yin = amp[inside], xin[inside], yin[inside]
+        targets.append((yout*shape[1] + xout)[inside])
+        sources.append((amp*nrows + yin)*amp_columns + xin - amp_start[amp])
+    return {'shape':shape, 'target':np.concatenate(targets), 'source':np.concatenate(sources),
+            'ccd_x0':ccd_x0}
+
+def _map_key(instrument, binning, roi, amp_shape, positions):
+    return (instrument, binning, roi, amp_shape, tuple(positions))
+
+def get_index_map(instrument, binning, roi, amp_shape, positions, geometry=None):
+    '''
+    Return the index map of the mosaic (see index_map), computing it only the first
+    time it is needed in this process. A geometry other than MOSAIC_GEOMETRY isn't cached.
+    '''
+    if geometry is not None:
+        return index_map(amp_shape, positions, binning, geometry)
+    key = _map_key(instrument, binning, roi, amp_shape, positions)
+    if key not in _index_maps:
+        _index_maps[key] = index_map(amp_shape, positions, binning, MOSAIC_GEOMETRY[instrument])
+    return _index_maps[key]
+
+def apply_index_map(planes, imap, fill_value=0, dtype=np.float32):
+    '''
+    Mosaic an (amplifier, row, column) array with an index map. Pixels without data are
+    set to fill_value.
+    '''
+    mosaic = np.full(imap['shape'], fill_value, dtype=dtype)
+    mosaic.ravel()[imap['target']] = np.asarray(planes, dtype=dtype).ravel()[imap['source']]
+    return mosaic
+
+def _mosaic_header(header, imap, ref_position):
+    '''
+    Header of the mosaic extensions: the header of the first amplifier of the middle CCD
+    with its WCS moved to the position of the amplifier in the mosaic
+    '''
+    header = header.copy()
+    iccd, start = ref_position
+    for keyword in ['BIASSEC', 'TRIMSEC', 'DETSEC', 'CCDSEC', 'AMPNAME', 'EXTNAME', 'EXTVER']:
+        if keyword in header:
+            del header[keyword]
+    if 'CRPIX1' in header:
+        header['CRPIX1'] = header['CRPIX1'] + imap['ccd_x0'][iccd] + start
+    header['DATASEC'] = '[1:{},1:{}]'.format(imap['shape'][1], imap['shape'][0])
+    return header
+
+def mosaic_frame(filename, output_filename, geometry=None, compress=False,
+                 quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL):
+    '''
+    Mosaic the amplifiers of a reduced (trimmed) frame
+
+    Input:
+        filename: str
+            reduced frame with SCI (and optionally VAR and DQ) extensions for each amplifier
+        output_filename: str
+            name of the mosaic
+        geometry: dict
+            'gap' and 'transforms' of the detector. If None, MOSAIC_GEOMETRY of the
+            instrument is used
+        compress, quantize_level:
+            write the mosaic tile-compressed (see GMOS_compressed_io.write_fits)
+    Output:
+        the mosaic is written to output_filename with SCI, VAR, and DQ extensions
+    '''
+    sci, var, dq = GMOS_native_reduction.read_planes(filename)
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as ofile:
+        primary_header = ofile[0].header.copy()
+        headers = [hdu.header.copy() for hdu in GMOS_native_reduction.science_extensions(ofile)]
+    if len(headers) != NCCDS*4:
+        raise ValueError('{} has {} amplifiers, only 12 amplifier data can be mosaicked'.format(
+                         filename, len(headers)))
+    binning = _binning(headers[0])
+    positions = amplifier_positions(headers, sci.shape[2])
+    imap = get_index_map(primary_header['INSTRUME'].strip(), binning, GMOS_obslog._roi_name(primary_header),
+                         sci.shape[1:], positions, geometry)
+    planes = [('SCI', apply_index_map(sci, imap))]
+    if var is not None:
+        planes.append(('VAR', apply_index_map(var, imap)))
+    if dq is not None:
+        planes.append(('DQ', apply_index_map(dq, imap, GMOS_native_reduction.DQ_NODATA, np.uint16)))
+    else:
+        planes.append(('DQ', apply_index_map(np.zeros(sci.shape, dtype=np.uint16), imap,
+                                             GMOS_native_reduction.DQ_NODATA, np.uint16)))
+    iref = positions.index((1, 0)) if (1, 0) in positions else 4
+    header = _mosaic_header(headers[iref], imap, positions[iref])
+    #imcoadd checks for the time stamp written by gmosaic
+    if 'GMOSAIC' not in primary_header:
+        primary_header['GMOSAIC'] = (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+                                     'GMOS_native_mosaic time stamp')
+    primary_header['NSCIEXT'] = 1
+    hdulist = [fits.PrimaryHDU(header=primary_header)]
+    for extname, plane in planes:
+        hdu = fits.ImageHDU(data=plane, header=header.copy())
+        hdu.header['EXTNAME'] = extname
+        hdu.header['EXTVER'] = 1
+        hdulist.append(hdu)
+    GMOS_compressed_io.write_fits(hdulist, output_filename, compress, quantize_level)
+    return output_filename
+
+def _mosaic_one(args):
+    filename, output_filename, kwargs = args
+    return mosaic_frame(filename, output_filename, **kwargs)
+
+def mosaic_frames(file_list, prefix='m', nprocesses=1, geometry=None, compress=False,
+                  quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL):
+    '''
+    Mosaic a list of reduced frames with mosaic_frame. The output files are named
+    prefix + filename, as for gmosaic.
+
+    Input:
+        file_list: list
+            list of reduced files (with or without the .fits extension)
+        prefix: str
+            prefix of the output files
+        nprocesses: int
+            number of worker processes. Each worker computes the index maps it needs once
+        geometry: dict
+            'gap' and 'transforms' of the detector (see mosaic_frame)
+        compress, quantize_level:
+            write the mosaics tile-compressed (see GMOS_compressed_io.write_fits)
+    Output:
+        output_list: list
+            names of the mosaicked files
+    '''
+    jobs = []
+    for ifile in file_list:
+        ifile = GMOS_native_reduction._fits_name(str(ifile))
+        output_filename = GMOS_compressed_io.output_name(ifile, prefix)
+        jobs.append((ifile, output_filename, dict(geometry=geometry, compress=compress,
+                                                  quantize_level=quantize_level)))
+    if nprocesses == 1:
+        return [_mosaic_one(job) for job in jobs]
+    pool = Pool(nprocesses)
+    try:
+        output_list = pool.map(_mosaic_one, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return output_list
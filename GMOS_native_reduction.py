@@ -0,0 +1,429 @@
+'''
+In-process NumPy equivalent of gireduce for GMOS 12 amplifier (Hamamatsu) imaging data.
+
+Overscan fitting and subtraction, trimming, bias subtraction, flat division and the
+propagation of the VAR and DQ planes (including the static bad pixel mask) are done on
+all 12 amplifiers at once as (amplifier, row, column) arrays. The output has the same
+name (prefix + filename) and layout as the gireduce output: a primary header followed by
+SCI, VAR, DQ extensions for each amplifier.
+
+DQ bits follow the Gemini convention: 1 bad pixel, 4 saturated, 16 no data
+'''
+import os
+import re
+import time
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+import GMOS_compressed_io
+
+DQ_BAD = 1
+DQ_SATURATED = 4
+DQ_NODATA = 16
+
+SECTION_RE = re.compile(r'\[\s*(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)\s*\]')
+
+#Master calibrations are read once per process and kept for the following frames
+_calibration_cache = {}
+
+def parse_section(section):
+    '''
+    Convert an IRAF image section (e.g. '[33:288,1:2112]', 1-indexed, inclusive) into
+    a (row slice, column slice) tuple
+    '''
+    match = SECTION_RE.match(section)
+    if match is None:
+        raise ValueError('Cannot parse image section {}'.format(section))
+    x1, x2, y1, y2 = [int(x) for x in match.groups()]
+    return slice(y1-1, y2), slice(x1-1, x2)
+
+def resolve_iraf_path(path, gmos_data_dir=None):
+    '''
+    Translate an IRAF path in gmos$data/ (e.g. the static bad pixel masks) into a
+    path on disk. The gmos data directory is taken from gmos_data_dir or from the
+    GMOS_DATA_DIR environment variable.
+    '''
+    if path is None or not path.startswith('gmos$data/'):
+        return path
+    if gmos_data_dir is None:
+        gmos_data_dir = os.environ.get('GMOS_DATA_DIR')
+    if gmos_data_dir is None:
+        raise IOError('Set GMOS_DATA_DIR to the gmos/data directory to use {}'.format(path))
+    return os.path.join(gmos_data_dir, path[len('gmos$data/'):])
+
+def clipped_stats(data, sigma=3.0, iters=5, axis=None):
+    '''
+    Iteratively sigma-clipped mean, median, and standard deviation. NaNs are ignored.
+
+    Input:
+        data: array
+            values to compute the statistics of
+        sigma: float
+            clipping threshold in standard deviations from the median
+        iters: int
+            number of clipping iterations
+        axis: int or tuple
+            axis (or axes) along which the statistics are computed. If None, the
+            statistics of the whole array are computed
+    Output:
+        mean, median, std
+    '''
+    data = np.array(data, dtype=np.float64)
+    for i in range(iters):
+        median = np.nanmedian(data, axis=axis, keepdims=True)
+        std = np.nanstd(data, axis=axis, keepdims=True)
+        clip = np.abs(data - median) > sigma*std
+        if not np.any(clip):
+            break
+        data[clip] = np.nan
+    mean = np.nanmean(data, axis=axis)
+    median = np.nanmedian(data, axis=axis)
+    std = np.nanstd(data, axis=axis)
+    return mean, median, std
+
+def science_extensions(hdulist):
+    '''
+    Return the image extensions of a raw or reduced file. For files with VAR and DQ
+    planes, only the SCI extensions are returned
+    '''
+    return [hdu for hdu in hdulist[1:] if (hdu.header.get('EXTNAME', 'SCI') == 'SCI') and
+                                          (hdu.header.get('NAXIS', 0) == 2)]
+
+def scale_array(data, header, dtype=np.float32):
+    '''
+    Apply the BSCALE and BZERO keywords in header to (a section of) unscaled image data
+    '''
+    data = np.asarray(data, dtype=dtype)
+    bscale = header.get('BSCALE', 1)
+    bzero = header.get('BZERO', 0)
+    if bscale != 1:
+        data = data*bscale
+    if bzero != 0:
+        data = data + np.asarray(bzero).astype(dtype)
+    return data
+
+def scaled_data(hdu, dtype=np.float32):
+    '''
+    Return the data of an image extension opened with do_not_scale_image_data=True
+    with BSCALE and BZERO applied. Scaled integer data can't be memory mapped by 
+    astropy, so files are opened unscaled and scaled here.
+    '''
+    return scale_array(hdu.data, hdu.header, dtype)
+
+class ScaledPlane(object):
+    '''
+    Scaled view of an image extension opened with do_not_scale_image_data=True. Indexing
+    scales only the section read (e.g. a cutout around a source); the whole plane is scaled
+    (once) only when it is converted to an array with np.asarray.
+    '''
+    def __init__(self, hdu, dtype=np.float32):
+        self.hdu = hdu
+        self.dtype = dtype
+        self.shape = hdu.data.shape
+        self.ndim = len(self.shape)
+        self._scaled = None
+
+    def __getitem__(self, key):
+        if self._scaled is not None:
+            return self._scaled[key]
+        return scale_array(self.hdu.data[key], self.hdu.header, self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        if self._scaled is None:
+            self._scaled = scaled_data(self.hdu, self.dtype)
+        if dtype is None:
+            return self._scaled
+        return self._scaled.astype(dtype)
+
+def read_planes(filename):
+    '''
+    Read the SCI, VAR, and DQ planes of a reduced (trimmed) file as (amplifier, row,
+    column) arrays. If the file has no VAR or DQ extensions these are returned as None.
+    '''
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as ofile:
+        planes = {}
+        for extname, dtype in [('SCI', np.float32), ('VAR', np.float32), ('DQ', np.uint16)]:
+            exts = [scaled_data(hdu, dtype) for hdu in ofile[1:] if hdu.header.get('EXTNAME') == extname]
+            planes[extname] = np.array(exts) if len(exts) > 0 else None
+        if planes['SCI'] is None:
+            planes['SCI'] = np.array([scaled_data(hdu) for hdu in science_extensions(ofile)])
+    return planes['SCI'], planes['VAR'], planes['DQ']
+
+def _load_calibration(filename):
+    if filename is None:
+        return None
+    filename = GMOS_compressed_io.resolve_fits(filename)
+    mtime = os.path.getmtime(filename)
+    if filename not in _calibration_cache or _calibration_cache[filename][0] != mtime:
+        _calibration_cache[filename] = (mtime, read_planes(filename))
+    return _calibration_cache[filename][1]
+
+def _load_bpm(filename, datasecs, raw_shape, trimmed_shape):
+    '''
+    Read a static bad pixel mask with one extension per amplifier, trimming it to the
+    data section if it has the size of the untrimmed amplifier
+    '''
+    if filename is None:
+        return None
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as ofile:
+        exts = [scaled_data(hdu) for hdu in ofile[1:] if hdu.header.get('NAXIS', 0) == 2]
+        if exts[0].shape == raw_shape:
+            exts = [ext[datasec] for ext, datasec in zip(exts, datasecs)]
+        bpm = np.array(exts)
+    if bpm.shape[1:] != trimmed_shape:
+        raise ValueError('BPM {} does not match the shape of the data {}'.format(filename, trimmed_shape))
+    return np.where(bpm > 0, DQ_BAD, 0).astype(np.uint16)
+
+def amplifier_sections(headers, nbiascontam=4):
+    '''
+    Find the overscan and data sections of each amplifier
+
+    Input:
+        headers: list
+            headers of the amplifier extensions
+        nbiascontam: int
+            number of overscan columns next to the data section which are not used
+            in the overscan fit
+    Output:
+        biassecs, datasecs: list
+            lists of (row slice, column slice) tuples
+    '''
+    biassecs = []
+    datasecs = []
+    for header in headers:
+        biassec = parse_section(header['BIASSEC'])
+        datasec = parse_section(header['DATASEC'])
+        if biassec[1].start > datasec[1].start: #overscan to the right of the data
+            columns = slice(biassec[1].start + nbiascontam, biassec[1].stop)
+        else:
+            columns = slice(biassec[1].start, biassec[1].stop - nbiascontam)
+        biassecs.append((biassec[0], columns))
+        datasecs.append(datasec)
+    return biassecs, datasecs
+
+def overscan_model(levels, fit_rows, nrows, order=1):
+    '''
+    Fit polynomials in the row number to the overscan levels of all amplifiers in a
+    single least squares call
+
+    Input:
+        levels: array
+            (amplifier, row) array of the median overscan level of each row in fit_rows
+        fit_rows: array
+            row numbers of the levels
+        nrows: int
+            number of rows of the amplifiers
+        order: int
+            order of the polynomial
+    Output:
+        overscan: array
+            (amplifier, row) array of the fit overscan level for all nrows rows
+    '''
+    coeffs = np.polynomial.polynomial.polyfit(fit_rows, np.asarray(levels).T, order)
+    return np.polynomial.polynomial.polyval(np.arange(nrows), coeffs)
+
+def fit_overscan(data, biassecs, order=1):
+    '''
+    Fit the overscan level of every amplifier as a polynomial in the row number. The
+    median of each overscan row is fit for all amplifiers in a single least squares call.
+
+    Input:
+        data: array
+            (amplifier, row, column) array of raw data
+        biassecs: list
+            (row slice, column slice) of the overscan region of each amplifier
+        order: int
+            order of the polynomial
+    Output:
+        overscan: array
+            (amplifier, row) array of the fit overscan level
+    '''
+    levels = np.array([np.median(amp[biassec], axis=1) for amp, biassec in zip(data, biassecs)])
+    fit_rows = np.arange(data.shape[1])[biassecs[0][0]]
+    return overscan_model(levels, fit_rows, data.shape[1], order=order)
+
+def write_planes(output_filename, primary_header, headers, sci, var, dq, trimmed=True,
+                 compress=False, quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL):
+    '''
+    Write (amplifier, row, column) SCI, VAR, and DQ arrays as a MEF file with SCI, VAR,
+    and DQ extensions for each amplifier (the gireduce layout).
+
+    Input:
+        output_filename: str
+            name of the output file
+        primary_header: astropy.io.fits.Header
+            primary header of the output file
+        headers: list
+            headers of the amplifier extensions
+        sci, var, dq: array
+            (amplifier, row, column) arrays
+        trimmed: bool
+            if True and the headers are from raw data, the data section keywords are
+            updated for the trimmed data
+        compress, quantize_level:
+            write the extensions tile-compressed (see GMOS_compressed_io.write_fits)
+    Output:
+        the file is written to output_filename
+    '''
+    primary_header = primary_header.copy()
+    #gmosaic and imcoadd check for the timestamps written by gprepare and gireduce
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+    for keyword in ['GPREPARE', 'GIREDUCE']:
+        if keyword not in primary_header:
+            primary_header[keyword] = (timestamp, 'GMOS_native_reduction time stamp')
+    primary_header['NSCIEXT'] = len(headers)
+    hdulist = [fits.PrimaryHDU(header=primary_header)]
+    for iamp, header in enumerate(headers):
+        header = header.copy()
+        if trimmed and ('BIASSEC' in header):
+            #Move the WCS reference pixel with the data section, as a section copy in IRAF does
+            rows, columns = parse_section(header['DATASEC'])
+            if 'CRPIX1' in header:
+                header['CRPIX1'] = header['CRPIX1'] - columns.start
+            if 'CRPIX2' in header:
+                header['CRPIX2'] = header['CRPIX2'] - rows.start
+            header['TRIMSEC'] = header['DATASEC']
+            header['DATASEC'] = '[1:{},1:{}]'.format(sci.shape[2], sci.shape[1])
+            del header['BIASSEC']
+        for keyword in ['BZERO', 'BSCALE']:
+            if keyword in header:
+                del header[keyword]
+        for extname, plane in [('SCI', sci[iamp]), ('VAR', var[iamp]), ('DQ', dq[iamp])]:
+            hdu = fits.ImageHDU(data=plane, header=header.copy())
+            hdu.header['EXTNAME'] = extname
+            hdu.header['EXTVER'] = iamp + 1
+            hdulist.append(hdu)
+    GMOS_compressed_io.write_fits(hdulist, output_filename, compress, quantize_level)
+
+def reduce_frame(filename, output_filename, bias=None, flat=None, bpm=None,
+                 overscan_order=1, nbiascontam=4, fl_over=True, fl_trim=True,
+                 saturation=None, compress=False, quantize_level=GMOS_compressed_io.QUANTIZE_LEVEL):
+    '''
+    Overscan subtract, trim, bias subtract, and flat field a raw GMOS image and create
+    the VAR and DQ planes (equivalent to gireduce with fl_over, fl_trim, fl_bias, fl_flat
+    and fl_vardq set to yes).
+
+    Input:
+        filename: str
+            raw GMOS file (.fits, .fits.bz2, or tile-compressed)
+        output_filename: str
+            name of the reduced file
+        bias: str
+            master bias (trimmed, with SCI, VAR, DQ planes). If None, no bias is subtracted
+        flat: str
+            master flat (trimmed, with SCI, VAR, DQ planes). If None, no flat is applied
+        bpm: str
+            static bad pixel mask with one extension per amplifier. If None, only
+            saturated pixels are flagged
+        overscan_order: int
+            order of the polynomial fit to the overscan
+        nbiascontam: int
+            number of overscan columns next to the data which are not used
+        fl_over, fl_trim: bool
+            subtract the overscan, trim the overscan region. Bias and flat correction
+            require fl_trim
+        saturation: float
+            saturation level in raw ADU. If None, the SATLEVEL keyword is used, or 65535
+        compress, quantize_level:
+            write the reduced file tile-compressed (see GMOS_compressed_io.write_fits)
+    Output:
+        the reduced file is written to output_filename
+    '''
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as raw:
+        primary_header = raw[0].header.copy()
+        exts = science_extensions(raw)
+        headers = [ext.header.copy() for ext in exts]
+        data = np.array([scaled_data(ext) for ext in exts])
+    if saturation is None:
+        saturation = headers[0].get('SATLEVEL', 65535.)
+    saturated = data >= saturation
+    gain = np.array([header.get('GAIN', 1.) for header in headers], dtype=np.float32)[:, None, None]
+    rdnoise = np.array([header.get('RDNOISE', 0.) for header in headers], dtype=np.float32)[:, None, None]
+
+    biassecs, datasecs = amplifier_sections(headers, nbiascontam=nbiascontam)
+    if fl_over:
+        data -= fit_overscan(data, biassecs, order=overscan_order)[:, :, None].astype(np.float32)
+    raw_shape = data.shape[1:]
+    if fl_trim:
+        data = np.array([amp[datasec] for amp, datasec in zip(data, datasecs)])
+        saturated = np.array([amp[datasec] for amp, datasec in zip(saturated, datasecs)])
+
+    var = np.clip(data, 0, None)/gain + (rdnoise/gain)**2
+    dq = np.where(saturated, DQ_SATURATED, 0).astype(np.uint16)
+    bpm_data = _load_bpm(bpm, datasecs, raw_shape, data.shape[1:])
+    if bpm_data is not None:
+        dq |= bpm_data
+    if bias is not None:
+        bias_sci, bias_var, bias_dq = _load_calibration(bias)
+        data -= bias_sci
+        if bias_var is not None:
+            var += bias_var
+        if bias_dq is not None:
+            dq |= bias_dq
+    if flat is not None:
+        flat_sci, flat_var, flat_dq = _load_calibration(flat)
+        good_flat = flat_sci > 0
+        safe_flat = np.where(good_flat, flat_sci, 1.)
+        data /= safe_flat
+        var /= safe_flat**2
+        if flat_var is not None:
+            var += data**2 * flat_var/safe_flat**2
+        if flat_dq is not None:
+            dq |= flat_dq
+        dq[~good_flat] |= DQ_BAD
+
+    write_planes(output_filename, primary_header, headers, data, var, dq, trimmed=fl_trim,
+                 compress=compress, quantize_level=quantize_level)
+
+def _fits_name(filename):
+    return GMOS_compressed_io.resolve_fits(filename)
+
+def _reduce_one(args):
+    filename, output_filename, kwargs = args
+    reduce_frame(filename, output_filename, **kwargs)
+    return output_filename
+
+def reduce_frames(file_list, prefix='rg', bias=None, flat=None, bpm=None, nprocesses=1,
+                  output_dir=None, **kwargs):
+    '''
+    Reduce a list of raw frames with reduce_frame. The output files are named
+    prefix + filename, as for gireduce.
+
+    Input:
+        file_list: list
+            list of raw files (with or without the .fits extension; .fits.bz2 and .fits.fz
+            files are read directly)
+        prefix: str
+            prefix of the output files
+        bias, flat, bpm:
+            master bias, master flat and static bad pixel mask (see reduce_frame)
+        nprocesses: int
+            number of worker processes. The master calibrations are read once by each
+            worker
+        output_dir: str
+            directory of the output files. If None, each output file is written in the
+            directory of its raw file
+        kwargs:
+            other parameters passed to reduce_frame
+    Output:
+        output_list: list
+            names of the reduced files
+    '''
+    jobs = []
+    for ifile in file_list:
+        ifile = _fits_name(str(ifile))
+        output_filename = GMOS_compressed_io.output_name(ifile, prefix)
+        if output_dir is not None:
+            output_filename = os.path.join(output_dir, os.path.basename(output_filename))
+        jobs.append((ifile, output_filename, dict(bias=bias, flat=flat, bpm=bpm, **kwargs)))
+    if nprocesses == 1:
+        return [_reduce_one(job) for job in jobs]
+    pool = Pool(nprocesses)
+    try:
+        output_list = pool.map(_reduce_one, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return output_list
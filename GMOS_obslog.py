@@ -0,0 +1,439 @@
+'''
+Native replacement for the Gemini obslog.py script.
+
+Builds and incrementally updates the obslog table of the observation database used by
+fileSelect.py. Headers are parsed on a pool of worker processes and files are only
+re-indexed if their size or modification time has changed since the last run.
+
+In the same pass, each new file is read once to compute per amplifier statistics
+(clipped mean and standard deviation, saturated fraction, and overscan level), which are
+stored in the obslog_amps table. select_calibrations uses them to reject bad bias and
+flat frames before they are combined.
+'''
+import os
+import bz2
+import glob
+import sqlite3
+import datetime
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+
+import GMOS_compressed_io
+import GMOS_native_reduction
+
+FITS_BLOCK = 2880 #bytes
+
+#Number of pixels per amplifier sampled for the clipped mean and standard deviation
+STAT_SAMPLES = 100000
+
+#Columns of the obslog table, in the order used by obslog.py, and the header keyword
+#each one is read from. Keywords are read from the primary header, then from the first
+#extension if they are not in the primary header.
+OBSLOG_COLUMNS = [('use_me', 'INTEGER', None),
+                  ('File', 'TEXT', None),
+                  ('ObsID', 'TEXT', 'OBSID'),
+                  ('Instrument', 'TEXT', 'INSTRUME'),
+                  ('ObsClass', 'TEXT', 'OBSCLASS'),
+                  ('ObsType', 'TEXT', 'OBSTYPE'),
+                  ('Object', 'TEXT', 'OBJECT'),
+                  ('DateObs', 'TEXT', 'DATE-OBS'),
+                  ('TimeObs', 'TEXT', 'TIME-OBS'),
+                  ('RA', 'REAL', 'RA'),
+                  ('Dec', 'REAL', 'DEC'),
+                  ('Texp', 'REAL', 'EXPTIME'),
+                  ('Airmass', 'REAL', 'AIRMASS'),
+                  ('Filter1', 'TEXT', 'FILTER1'),
+                  ('Filter2', 'TEXT', 'FILTER2'),
+                  ('Disperser', 'TEXT', 'GRATING'),
+                  ('AperMask', 'TEXT', 'MASKNAME'),
+                  ('CentWave', 'REAL', 'CENTWAVE'),
+                  ('CcdBin', 'TEXT', 'CCDSUM'),
+                  ('RoI', 'TEXT', None)]
+
+def _data_size(header):
+    '''
+    Number of bytes (padded to a whole number of FITS blocks) of the data unit
+    following header
+    '''
+    naxis = header.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    nelements = 1
+    for iaxis in range(1, naxis+1):
+        nelements *= header['NAXIS{}'.format(iaxis)]
+    nbytes = abs(header['BITPIX'])//8 * header.get('GCOUNT', 1) * \
+             (header.get('PCOUNT', 0) + nelements)
+    return ((nbytes + FITS_BLOCK - 1)//FITS_BLOCK)*FITS_BLOCK
+
+def read_headers(filename):
+    '''
+    Read the primary header and the header of the first extension of a FITS file
+    without reading any pixel data. .bz2 archives are decompressed up to the end of the
+    first extension header only.
+
+    Input:
+        filename: str
+            name of the FITS file
+    Output:
+        primary_header, extension_header: astropy.io.fits.Header
+            extension_header is an empty Header if the file has no extensions
+    '''
+    opener = bz2.open if filename.endswith('.bz2') else open
+    with opener(filename, 'rb') as ofile:
+        primary_header = fits.Header.fromfile(ofile)
+        ofile.seek(_data_size(primary_header), os.SEEK_CUR)
+        try:
+            extension_header = fits.Header.fromfile(ofile)
+        except EOFError:
+            extension_header = fits.Header()
+    return primary_header, extension_header
+
+def _roi_name(primary_header):
+    '''
+    Name of the detector region of interest, following the obslog.py convention
+    '''
+    nroi = primary_header.get('DETNROI', 1)
+    xsize = primary_header.get('DETRO1XS', 0)
+    ysize = primary_header.get('DETRO1YS', 0)
+    if nroi == 1 and xsize >= 6144 and ysize >= 4176:
+        return 'Full'
+    elif nroi == 1 and xsize >= 6144 and ysize == 1024:
+        return 'CentSp'
+    elif nroi == 1 and ysize == 1024:
+        return 'CentSt'
+    return 'Custom'
+
+def file_key(filename):
+    '''
+    Name of a file as it is stored in the File column: the basename without
+    the .fits (or .fits.bz2, .fits.fz) extension
+    '''
+    return GMOS_compressed_io.strip_fits_extension(os.path.basename(filename))
+
+def header_row(filename):
+    '''
+    Create the obslog row for a file from its headers
+
+    Input:
+        filename: str
+            name of the FITS file
+    Output:
+        row: dict
+            dictionary of obslog column name: value
+    '''
+    primary_header, extension_header = read_headers(filename)
+    row = {'use_me':1, 'File':file_key(filename), 'RoI':_roi_name(primary_header)}
+    for colname, coltype, keyword in OBSLOG_COLUMNS:
+        if keyword is None:
+            continue
+        value = primary_header.get(keyword, extension_header.get(keyword))
+        if isinstance(value, str):
+            value = value.strip()
+        row[colname] = value
+    return row
+
+def frame_statistics(filename, max_samples=STAT_SAMPLES):
+    '''
+    Compute the statistics of each amplifier of a raw frame
+
+    Input:
+        filename: str
+            name of the raw FITS file
+        max_samples: int
+            the clipped mean and standard deviation of the data section are computed
+            from a strided sample of about max_samples pixels
+    Output:
+        amps: list
+            (amplifier number, clipped mean, clipped standard deviation, fraction of
+            saturated pixels, median overscan level) tuples. The overscan level is None
+            if the extension has no BIASSEC
+    '''
+    amps = []
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as ofile:
+        exts = GMOS_native_reduction.science_extensions(ofile)
+        for iamp, ext in enumerate(exts, 1):
+            header = ext.header
+            saturation = header.get('SATLEVEL', 65535.)
+            data = GMOS_native_reduction.scaled_data(ext)
+            overscan = None
+            if ('BIASSEC' in header) and ('DATASEC' in header):
+                biassecs, datasecs = GMOS_native_reduction.amplifier_sections([header])
+                overscan = float(np.median(data[biassecs[0]]))
+                data = data[datasecs[0]]
+            saturated = np.count_nonzero(data >= saturation)/float(data.size)
+            stride = max(1, int(np.ceil(np.sqrt(data.size/float(max_samples)))))
+            mean, median, std = GMOS_native_reduction.clipped_stats(data[::stride, ::stride])
+            amps.append((iamp, float(mean), float(std), saturated, overscan))
+    return amps
+
+def _index_one(job):
+    '''
+    Read the header row and (if statistics is True) the amplifier statistics of a file.
+    A file whose statistics can't be computed is still indexed from its header.
+    '''
+    filename, statistics = job
+    try:
+        row = header_row(filename)
+    except Exception as err:
+        return filename, None, None, str(err), None
+    amps = None
+    if statistics:
+        try:
+            amps = frame_statistics(filename)
+        except Exception as err:
+            return filename, row, None, None, str(err)
+    return filename, row, amps, None, None
+
+def _create_tables(conn):
+    '''
+    Create the obslog table (if it doesn't exist) and the table which tracks which
+    version of each file was indexed. Columns missing from an obslog table created by
+    an older version of obslog.py are added.
+    '''
+    cols = ', '.join('{} {}'.format(colname, coltype) for colname, coltype, keyword in OBSLOG_COLUMNS)
+    conn.execute('CREATE TABLE IF NOT EXISTS obslog ({})'.format(cols))
+    existing = [row[1] for row in conn.execute('PRAGMA table_info(obslog)')]
+    for colname, coltype, keyword in OBSLOG_COLUMNS:
+        if colname not in existing:
+            conn.execute('ALTER TABLE obslog ADD COLUMN {} {}'.format(colname, coltype))
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS obslog_file ON obslog (File)')
+    create_indexes(conn)
+    conn.execute('''CREATE TABLE IF NOT EXISTS obslog_files
+                    (File TEXT PRIMARY KEY, Path TEXT, Size INTEGER, MTime REAL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS obslog_amps
+                    (File TEXT, Amp INTEGER, Mean REAL, Std REAL, SatFraction REAL, Overscan REAL,
+                     PRIMARY KEY (File, Amp))''')
+
+def index_observations(directory, database_filename='obsLog.sqlite3', pattern='[NS]2*.fits*',
+                       nprocesses=None, statistics=True):
+    '''
+    Create or update the obslog table of the observation database for all of the raw
+    files in a directory. Only files which are new or whose size or modification time
+    changed since the last run are read (as well as files without statistics, if
+    statistics is True). Rows of files which have been removed from the directory are
+    deleted. The use_me flag of existing rows is not changed.
+
+    Input:
+        directory: str
+            directory with the raw data (the reduction directory)
+        database_filename: str
+            name of the sqlite3 database. If it is not an absolute path it is
+            created in directory
+        pattern: str
+            glob pattern of the files to index. Only .fits, .fits.bz2, and .fits.fz files
+            matching it are indexed
+        nprocesses: int
+            number of worker processes used to parse headers. If None, the number of
+            CPUs is used
+        statistics: bool
+            if True, compute the per amplifier statistics of each file (see
+            frame_statistics) and store them in the obslog_amps table. If False, only
+            the headers are read
+    Output:
+        summary: dict
+            dictionary with the number of files 'indexed', 'unchanged', and 'removed',
+            'failed': a list of (filename, error message) tuples for files whose
+            headers could not be read, and 'statistics_failed': a list of (filename,
+            error message) tuples for files which were indexed without statistics
+            (they are read again by the next run)
+    '''
+    database_filename = os.path.join(directory, database_filename)
+    summary = {'indexed':0, 'unchanged':0, 'removed':0, 'failed':[], 'statistics_failed':[]}
+    conn = sqlite3.connect(database_filename)
+    try:
+        _create_tables(conn)
+        indexed = dict((row[0], (row[1], row[2])) for row in
+                       conn.execute('SELECT File, Size, MTime FROM obslog_files'))
+        #Rows of files which are no longer in the directory are deleted, whether or not
+        #they have statistics
+        all_indexed = list(indexed)
+        if statistics:
+            with_stats = set(row[0] for row in conn.execute('SELECT DISTINCT File FROM obslog_amps'))
+            indexed = dict((ikey, value) for ikey, value in indexed.items() if ikey in with_stats)
+        flist = sorted(ifile for ifile in glob.glob(os.path.join(directory, pattern))
+                       if ifile.endswith(tuple(GMOS_compressed_io.FITS_EXTENSIONS)))
+        to_index = []
+        current = {}
+        for ifile in flist:
+            fstat = os.stat(ifile)
+            current[file_key(ifile)] = (fstat.st_size, fstat.st_mtime)
+            if indexed.get(file_key(ifile)) == current[file_key(ifile)]:
+                summary['unchanged'] += 1
+            else:
+                to_index.append(ifile)
+        removed = [ikey for ikey in all_indexed if ikey not in current]
+
+        colnames = [colname for colname, coltype, keyword in OBSLOG_COLUMNS]
+        upsert = '''INSERT INTO obslog ({}) VALUES ({})
+                    ON CONFLICT (File) DO UPDATE SET {}'''.format(
+                    ', '.join(colnames), ', '.join(['?']*len(colnames)),
+                    ', '.join('{0}=excluded.{0}'.format(colname) for colname in colnames
+                              if colname not in ['use_me', 'File']))
+        rows = []
+        file_rows = []
+        amp_rows = []
+        if len(to_index) > 0:
+            pool = Pool(nprocesses)
+            try:
+                jobs = [(ifile, statistics) for ifile in to_index]
+                for ifile, row, amps, err, stats_err in pool.imap_unordered(_index_one, jobs, chunksize=16):
+                    if err is not None:
+                        summary['failed'].append((ifile, err))
+                        continue
+                    if stats_err is not None:
+                        summary['statistics_failed'].append((ifile, stats_err))
+                    rows.append([row.get(colname) for colname in colnames])
+                    file_rows.append((row['File'], ifile) + current[row['File']])
+                    if amps is not None:
+                        amp_rows.extend((row['File'],) + amp for amp in amps)
+            finally:
+                pool.close()
+                pool.join()
+        with conn:
+            conn.executemany(upsert, rows)
+            conn.executemany('INSERT OR REPLACE INTO obslog_files VALUES (?, ?, ?, ?)', file_rows)
+            if statistics:
+                conn.executemany('DELETE FROM obslog_amps WHERE File=?', [(file_row[0],) for file_row in file_rows])
+                conn.executemany('INSERT INTO obslog_amps VALUES (?, ?, ?, ?, ?, ?)', amp_rows)
+            for table_name in ['obslog', 'obslog_files', 'obslog_amps']:
+                conn.executemany('DELETE FROM {} WHERE File=?'.format(table_name), [(ikey,) for ikey in removed])
+        summary['indexed'] = len(rows)
+        summary['removed'] = len(removed)
+    finally:
+        conn.close()
+    return summary
+
+#Selection criteria of each type of calibration, following fileSelect.createQuery
+CALIBRATION_CRITERIA = {'bias':"ObsType='BIAS'",
+                        'twiFlat':"ObsType='OBJECT' AND Object='Twilight'"}
+
+#Limits on the obslog_amps statistics of calibration frames. A frame is rejected if any
+#amplifier has more than max_saturated of its pixels saturated, a signal (clipped mean -
+#overscan) below min_signal or above max_signal, or a standard deviation above
+#max_noise_ratio times the average of the same amplifier in the other candidate frames.
+#Limits which are None are not applied.
+CALIBRATION_LIMITS = {'bias':{'max_saturated':0.001, 'min_signal':None, 'max_signal':100.,
+                              'max_noise_ratio':2.},
+                      'twiFlat':{'max_saturated':0.01, 'min_signal':1000., 'max_signal':None,
+                                 'max_noise_ratio':None}}
+
+def create_indexes(conn):
+    '''
+    Create the indexes used by the calibration and science selection queries. They are
+    created with the obslog table by index_observations.
+    '''
+    conn.execute('''CREATE INDEX IF NOT EXISTS obslog_calib ON obslog 
+                    (ObsType, Instrument, CcdBin, RoI, DateObs)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS obslog_object ON obslog 
+                    (Object, Filter2, DateObs)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS obslog_science ON obslog 
+                    (ObsClass, Filter2, DateObs)''')
+
+def _rejection_query(where, params, limits):
+    '''
+    Query of the files matching the where clauses whose statistics are outside of limits
+    (see CALIBRATION_LIMITS)
+    '''
+    cuts = []
+    cut_params = []
+    for limit, cut in [('max_saturated', 'SatFraction > ?'), ('min_signal', 'Signal < ?'),
+                       ('max_signal', 'Signal > ?'), ('max_noise_ratio', 'Std > ? * OtherStd')]:
+        if limits.get(limit) is not None:
+            cuts.append(cut)
+            cut_params.append(limits[limit])
+    if len(cuts) == 0:
+        return None, []
+    sql = '''SELECT DISTINCT File FROM
+               (SELECT obslog_amps.File, SatFraction, Mean - Overscan AS Signal, Std,
+                       (SUM(Std) OVER amp - Std)/(COUNT(*) OVER amp - 1) AS OtherStd
+                FROM obslog_amps JOIN obslog ON obslog_amps.File = obslog.File
+                WHERE {}
+                WINDOW amp AS (PARTITION BY Amp))
+             WHERE {}'''.format(' AND '.join(where), ' OR '.join(cuts))
+    return sql, list(params) + cut_params
+
+def select_calibrations(cal_type, qd, db_file, min_frames=7, max_lookback=365, limits=None):
+    '''
+    Select the calibration frames taken closest in time to the science observations with
+    a single query. This is equivalent to widening the start of the date range one day 
+    at a time until at least min_frames frames are found, but without re-running a 
+    query for each day.
+
+    Frames whose per amplifier statistics (computed by index_observations) are outside
+    of the limits are rejected in the same query, before the closest frames are chosen.
+    
+    Input:
+        cal_type: str
+            type of calibration: 'bias' or 'twiFlat'
+        qd: dict
+            query dictionary as used by fileSelect. The keys Instrument, CcdBin, RoI and
+            DateObs ('start:end' or '*') are used, as well as Filter2 for flats
+        db_file: str
+            name of the observation database
+        min_frames: int
+            minimum number of frames to select. All of the frames from the earliest 
+            day selected are included, so more frames may be returned
+        max_lookback: float
+            maximum number of days before the start of the date range to search
+        limits: dict
+            limits of the statistics of good frames (see CALIBRATION_LIMITS, the
+            default). Pass an empty dictionary to keep all frames
+    Output:
+        files: list
+            list of file names (as stored in the obslog File column), ordered from
+            closest to furthest in time from the date range
+        date_range: str
+            the date range ('start:end') which contains all of the selected files
+    '''
+    where = ['use_me=1', CALIBRATION_CRITERIA[cal_type]]
+    params = []
+    for colname in ['Instrument', 'CcdBin', 'RoI']:
+        if colname in qd:
+            where.append('{}=?'.format(colname))
+            params.append(qd[colname])
+    if cal_type == 'twiFlat':
+        where.append('Filter2 LIKE ?')
+        params.append(qd['Filter2'])
+    if qd.get('DateObs', '*') == '*':
+        start_date, end_date = None, None
+        distance = '0'
+    else:
+        start_date, end_date = qd['DateObs'].split(':')
+        where.append('DateObs <= ?')
+        params.append(end_date)
+        #Compared as a date string (not with julianday) so that the DateObs index is used
+        earliest_date = datetime.datetime.strptime(start_date, '%Y-%m-%d') - \
+            datetime.timedelta(days=int(max_lookback))
+        where.append('DateObs >= ?')
+        params.append(earliest_date.strftime('%Y-%m-%d'))
+        distance = "MAX(julianday(?) - julianday(DateObs), 0)"
+    if limits is None:
+        limits = CALIBRATION_LIMITS[cal_type]
+    conn = sqlite3.connect(db_file)
+    try:
+        has_stats = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='obslog_amps'").fetchone()
+        rejection_sql, rejection_params = _rejection_query(where, params, limits)
+        if (has_stats is not None) and (rejection_sql is not None):
+            rejected = [row[0] for row in conn.execute(rejection_sql, rejection_params)]
+            if len(rejected) > 0:
+                print('Rejected {} frames with bad statistics: {}'.format(cal_type, ', '.join(sorted(rejected))))
+            where.append('File NOT IN ({})'.format(rejection_sql))
+            params.extend(rejection_params)
+        if start_date is not None:
+            params.insert(0, start_date)
+        sql = '''SELECT File, DateObs, {} AS distance FROM obslog WHERE {} 
+                 ORDER BY distance, DateObs DESC, File'''.format(distance, ' AND '.join(where))
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    if start_date is None:
+        return [row[0] for row in rows], '*'
+    if len(rows) > min_frames:
+        #Keep every frame taken on the same day as the last frame needed
+        last_distance = rows[min_frames-1][2]
+        rows = [row for row in rows if row[2] <= last_distance]
+    if len(rows) > 0:
+        start_date = min(start_date, min(row[1] for row in rows))
+    return [row[0] for row in rows], '{}:{}'.format(start_date, end_date)
@@ -0,0 +1,185 @@
+'''
+Run independent parts of the IRAF reduction (one filter, or one frame) in separate
+worker processes.
+
+The IRAF tasks all work in the current directory and share log files, uparm parameter
+files, and tmplist*/tmpfile* scratch names, so they can't run concurrently in the same
+directory. Each job runs in a fresh process in its own private work directory (inside
+the reduction directory) containing links to the files of the reduction directory and
+its own uparm directory. When the job is done, the files it created are moved into the
+reduction directory, its IRAF logs are appended to the logs of the reduction directory,
+and the work directory is removed.
+
+If a workspace directory on a fast local volume (e.g. /dev/shm or a local disk) is set
+with workspace (or the GMOS_IRAF_WORKSPACE environment variable), the work directories
+are created there instead of in the reduction directory, and GMOS_iraf_pool runs each
+IRAF task in a private directory of the workspace (see GMOS_iraf_pool.run_task), so that
+the intermediate files of the tasks are never written to the reduction directory.
+'''
+import os
+import shutil
+import tempfile
+import traceback
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+#Scratch files which are never moved back into the reduction directory
+SCRATCH_PREFIXES = ('tmp', 'uparm')
+
+WORKSPACE_VARIABLE = 'GMOS_IRAF_WORKSPACE'
+
+def get_workspace_dir():
+    '''
+    Return the workspace directory of the IRAF tasks, or None if they run in the
+    reduction directory
+    '''
+    return os.environ.get(WORKSPACE_VARIABLE) or None
+
+@contextmanager
+def workspace(workspace_dir):
+    '''
+    Run the IRAF tasks started in this block (and by processes started in it) in private
+    directories of workspace_dir. If workspace_dir is None, the current setting is kept.
+    '''
+    if workspace_dir is None:
+        yield
+        return
+    previous = os.environ.get(WORKSPACE_VARIABLE)
+    if not os.path.exists(workspace_dir):
+        os.makedirs(workspace_dir)
+    os.environ[WORKSPACE_VARIABLE] = os.path.abspath(workspace_dir)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop(WORKSPACE_VARIABLE, None)
+        else:
+            os.environ[WORKSPACE_VARIABLE] = previous
+
+def move_file(src, dest):
+    '''
+    Move src to dest, replacing dest. Across file systems src is copied next to dest
+    first, so that dest is never left partly written.
+    '''
+    try:
+        os.replace(src, dest)
+    except OSError:
+        tmp_dest = '{}.part{}'.format(dest, os.getpid())
+        try:
+            shutil.copyfile(src, tmp_dest)
+            os.replace(tmp_dest, dest)
+        except BaseException:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+            raise
+        os.remove(src)
+
+def _link_inputs(data_dir, workdir, exclude=()):
+    '''
+    Link the files of data_dir into workdir, except for logs and scratch files which 
+    each job writes for itself, and the files of exclude
+    '''
+    for ifile in os.listdir(data_dir):
+        src = os.path.join(os.path.abspath(data_dir), ifile)
+        if os.path.isfile(src) and not (ifile.endswith('Log.txt') or ifile.startswith(SCRATCH_PREFIXES)
+                                        or ifile in exclude):
+            os.symlink(src, os.path.join(workdir, ifile))
+
+def _merge_outputs(workdir, data_dir):
+    '''
+    Move the files created in workdir to data_dir. Log files (*Log.txt) are appended to
+    the log of the same name in data_dir.
+    '''
+    products = []
+    for ifile in sorted(os.listdir(workdir)):
+        filename = os.path.join(workdir, ifile)
+        if os.path.islink(filename) or not os.path.isfile(filename) or ifile.startswith(SCRATCH_PREFIXES):
+            continue
+        if ifile.endswith('Log.txt'):
+            with open(filename, 'r') as log, open(os.path.join(data_dir, ifile), 'a') as merged_log:
+                shutil.copyfileobj(log, merged_log)
+        else:
+            move_file(filename, os.path.join(data_dir, ifile))
+            products.append(ifile)
+    return products
+
+def set_iraf_scratch(workdir):
+    '''
+    Point the IRAF uparm and tmp directories of this process at workdir
+    '''
+    uparm = os.path.join(workdir, 'uparm')
+    if not os.path.exists(uparm):
+        os.mkdir(uparm)
+    os.environ['uparm'] = uparm + '/'
+    os.environ['tmp'] = workdir + '/'
+    from pyraf import iraf
+    iraf.set(uparm=uparm + '/', tmp=workdir + '/')
+
+def run_isolated(job):
+    '''
+    Run func(**kwargs) with kwargs['data_dir'] set to a private work directory. Unless
+    kwargs['backend'] is 'native', the IRAF uparm and tmp directories of the job are
+    also set to the work directory (which imports PyRAF).
+
+    Input:
+        job: tuple
+            (func, kwargs, data_dir, label): a module level function, its keyword
+            arguments, the reduction directory, and a name for the job
+    Output:
+        label: str
+            the label of the job
+        products: list
+            names of the files moved into the reduction directory
+        error: str
+            traceback if the job failed, otherwise None
+    '''
+    func, kwargs, data_dir, label = job
+    data_dir = os.path.abspath(data_dir)
+    workdir = tempfile.mkdtemp(prefix='worker_{}_'.format(label), dir=get_workspace_dir() or data_dir)
+    cur_dir = os.getcwd()
+    try:
+        _link_inputs(data_dir, workdir)
+        if kwargs.get('backend', 'iraf') != 'native':
+            set_iraf_scratch(workdir)
+        kwargs = dict(kwargs)
+        kwargs['data_dir'] = workdir
+        func(**kwargs)
+        os.chdir(cur_dir)
+        return label, _merge_outputs(workdir, data_dir), None
+    except BaseException: #including the sys.exit calls of the reduction functions
+        return label, [], traceback.format_exc()
+    finally:
+        os.chdir(cur_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def map_isolated(jobs, nprocesses):
+    '''
+    Run jobs with run_isolated on a pool of processes. Each job gets a new process so
+    that no IRAF state is shared between jobs.
+
+    Input:
+        jobs: list
+            list of (func, kwargs, data_dir, label) tuples
+        nprocesses: int
+            number of jobs run at the same time
+    Output:
+        products: dict
+            dictionary of label: list of files created by the job. If any job fails,
+            the tracebacks are printed and a RuntimeError is raised after all jobs finish
+    '''
+    pool = Pool(nprocesses, maxtasksperchild=1)
+    try:
+        results = pool.map(run_isolated, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    products = {}
+    failed = []
+    for label, job_products, error in results:
+        products[label] = job_products
+        if error is not None:
+            print('ERROR in {}:\n{}'.format(label, error))
+            failed.append(label)
+    if len(failed) > 0:
+        raise RuntimeError('Parallel jobs failed: {}'.format(', '.join(failed)))
+    return products
@@ -1,37 +1,262 @@
 import os
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from matplotlib import pyplot as plt
 import numpy as np
 
-import photutils as pu
+from photutils.aperture import CircularAperture, CircularAnnulus, aperture_photometry
+from photutils.detection import DAOStarFinder
+from scipy.spatial import cKDTree
 from astropy.wcs import WCS
 from astropy.stats import sigma_clipped_stats
 from astropy import table
 from astropy.io import fits
 
 import visualization as vis
+import GMOS_native_reduction
+import GMOS_instrumentation
 
+#Fields of the curve of growth array returned by curve_of_growth
+COG_DTYPE = [('radius', 'f4'),
+             ('flux', 'f8'), #background subtracted
+             ('flux_err', 'f8'),
+             ('area', 'f4'), #pixels
+             ('bkg', 'f8'), #mean background per pixel
+             ('nbad', 'i4')] #pixels in the aperture flagged in the DQ plane
+
+def _pixel_fractions(xcen, ycen, xlow, ylow, shape, radii, subpixels):
+    '''
+    Fraction of each pixel of a cutout inside each of the apertures of radius radii
+    centered on xcen, ycen, from the radial distance of subpixels x subpixels points
+    in each pixel. Returns an (npixels, nradii) array.
+    '''
+    nrows, ncolumns = shape
+    offsets = (np.arange(subpixels) + 0.5)/subpixels - 0.5
+    sub_y = (np.arange(nrows)[:, None] + ylow + offsets[None, :]).ravel()
+    sub_x = (np.arange(ncolumns)[:, None] + xlow + offsets[None, :]).ravel()
+    r = np.sqrt((sub_x[None, :] - xcen)**2 + (sub_y[:, None] - ycen)**2)
+    #Pixel index of each subpixel
+    pixel = (np.repeat(np.arange(nrows), subpixels)[:, None]*ncolumns + 
+             np.repeat(np.arange(ncolumns), subpixels)[None, :])
+    #Index of the smallest aperture each subpixel is in (len(radii) if it's in none)
+    radial_bin = np.searchsorted(radii, r, side='right')
+    nbins = len(radii) + 1
+    counts = np.bincount((pixel*nbins + radial_bin).ravel(), minlength=nrows*ncolumns*nbins)
+    counts = counts.reshape(nrows*ncolumns, nbins)
+    return np.cumsum(counts[:, :-1], axis=1)/float(subpixels**2)
+
+def curve_of_growth(data, positions, radii=np.arange(2, 15), bkg_r_in=16., bkg_r_out=20., 
+                    var=None, dq=None, subpixels=5):
+    '''
+    Background subtracted aperture photometry of many sources in many circular
+    apertures. For each source, the fraction of each pixel of a cutout inside every
+    aperture is computed once (by sub-sampling the pixels) and all of the aperture
+    sums and their variances are derived from it.
+    
+    Input:
+        data: array
+            image
+        positions: array
+            (nsources, 2) array of 0-indexed x, y pixel positions (or a single x, y)
+        radii: array
+            aperture radii in pixels, in increasing order
+        bkg_r_in, bkg_r_out: float
+            radii of the background annulus. The background is the mean of the
+            pixels in the annulus which aren't flagged in dq
+        var: array
+            variance of data. If None, flux_err is only the error of the background
+        dq: array
+            data quality plane. Flagged pixels are excluded from the background and
+            counted in nbad
+        subpixels: int
+            number of subpixels along each axis of a pixel
+    Output:
+        cog: structured array
+            (nsources, nradii) array with the fields of COG_DTYPE
+    '''
+    positions = np.atleast_2d(np.asarray(positions, dtype=float))
+    radii = np.asarray(radii, dtype=float)
+    if np.any(np.diff(radii) < 0):
+        raise ValueError('Aperture radii must be in increasing order: {}'.format(radii))
+    if bkg_r_in >= bkg_r_out:
+        raise ValueError('bkg_r_in ({}) must be smaller than bkg_r_out ({})'.format(bkg_r_in, bkg_r_out))
+    #The apertures and the background annulus can overlap, so the fractions are computed
+    #for the sorted boundaries and put back in the order of radii, bkg_r_in, bkg_r_out
+    boundaries = np.concatenate([radii, [bkg_r_in, bkg_r_out]])
+    order = np.argsort(boundaries, kind='stable')
+    unsort = np.argsort(order)
+    cog = np.zeros((len(positions), len(radii)), dtype=COG_DTYPE)
+    cog['radius'] = radii
+    size = int(np.ceil(max(bkg_r_out, radii.max()))) + 1
+    for isource, (xcen, ycen) in enumerate(positions):
+        xlow, xhigh = max(int(np.floor(xcen)) - size, 0), min(int(np.ceil(xcen)) + size + 1, data.shape[1])
+        ylow, yhigh = max(int(np.floor(ycen)) - size, 0), min(int(np.ceil(ycen)) + size + 1, data.shape[0])
+        cutout = np.asarray(data[ylow:yhigh, xlow:xhigh], dtype=float).ravel()
+        cutout_shape = (yhigh-ylow, xhigh-xlow)
+        fractions = _pixel_fractions(xcen, ycen, xlow, ylow, cutout_shape, 
+                                     boundaries[order], subpixels)[:, unsort]
+        aperture_fractions = fractions[:, :len(radii)]
+        annulus_fractions = fractions[:, -1] - fractions[:, -2]
+        if dq is not None:
+            bad = np.asarray(dq[ylow:yhigh, xlow:xhigh]).ravel() != 0
+        else:
+            bad = np.zeros(cutout.shape, dtype=bool)
+        if var is not None:
+            cutout_var = np.asarray(var[ylow:yhigh, xlow:xhigh], dtype=float).ravel()
+        else:
+            cutout_var = np.zeros(cutout.shape)
+        annulus_fractions = np.where(bad, 0, annulus_fractions)
+        bkg_area = annulus_fractions.sum()
+        bkg = np.dot(annulus_fractions, cutout)/bkg_area
+        bkg_var = np.dot(annulus_fractions**2, cutout_var)/bkg_area**2
+        area = aperture_fractions.sum(axis=0)
+        cog['flux'][isource] = np.dot(cutout, aperture_fractions) - bkg*area
+        cog['flux_err'][isource] = np.sqrt(np.dot(cutout_var, aperture_fractions**2) + area**2*bkg_var)
+        cog['area'][isource] = area
+        cog['bkg'][isource] = bkg
+        cog['nbad'][isource] = np.dot(bad.astype(int), (aperture_fractions > 0).astype(int))
+    return cog
+
+class PhotometrySession(object):
+    '''
+    Photometry of one image. The file is opened once (memory mapped) and the primary
+    header, the header, WCS and data of the science extension are read at most once
+    and shared by the centroiding, the aperture photometry, and the header values
+    used for the zero point. The data and the VAR and DQ planes are
+    GMOS_native_reduction.ScaledPlane views, so cutouts only scale the pixels they
+    read. Use as a context manager (or call close) so that the file is closed:
+    
+        with PhotometrySession(filename) as session:
+            xcen, ycen = session.find_obj_center(plot=False)
+            phot_table, apertures = session.aperture_photometry(xcen, ycen)
+            airmass = session.get('airmass')
+    '''
+    def __init__(self, filename, ext=1):
+        self.filename = filename
+        self.ext = ext
+        #Scaled (e.g. integer DQ) data can't be memory mapped, so BZERO and BSCALE are applied here
+        self.ofile = fits.open(filename, memmap=True, do_not_scale_image_data=True)
+        self.primary_header = self.ofile[0].header
+        self.header = self.ofile[ext].header
+        self._wcs = None
+        self._planes = {}
+        
+    @property
+    def wcs(self):
+        if self._wcs is None:
+            self._wcs = WCS(self.header)
+        return self._wcs
+    
+    @property
+    def data(self):
+        return self._plane(self.ext, np.float32)
+    
+    def plane(self, extname):
+        '''
+        Data of the extension extname (e.g. 'VAR' or 'DQ'), or None if the file 
+        doesn't have it
+        '''
+        if extname not in self.ofile:
+            return None
+        dtype = np.uint16 if extname == 'DQ' else np.float32
+        return self._plane(extname, dtype)
+    
+    def _plane(self, ext, dtype):
+        if ext not in self._planes:
+            self._planes[ext] = GMOS_native_reduction.ScaledPlane(self.ofile[ext], dtype)
+        return self._planes[ext]
+    
+    def get(self, keyword, default=None):
+        '''
+        Value of a keyword of the primary header
+        '''
+        return self.primary_header.get(keyword, default)
+    
+    def world_to_pixel(self, ra, dec):
+        return self.wcs.all_world2pix(ra, dec, 1)
+    
+    def find_obj_center(self, x=None, y=None, plot=True, fig_dir='./'):
+        '''
+        Find the source closest to x, y (or to the RA and DEC of the primary header)
+        '''
+        if (x is None) and (y is None):
+            x, y = self.world_to_pixel(self.get('ra'), self.get('dec'))
+        xlow, xhigh = int(x-50), int(x+50)
+        ylow, yhigh = int(y-50), int(y+50)
+        stamp = self.data[ylow:yhigh, xlow:xhigh]
+        mean, median, std = sigma_clipped_stats(stamp, sigma=3.0, maxiters=5)  
+        daofind = DAOStarFinder(fwhm=4, threshold=5*std)
+        sources = daofind(stamp)
+        x_sources = sources['x_centroid']+xlow
+        y_sources = sources['y_centroid']+ylow
+
+        nearest = np.argmin(np.sqrt((x_sources-x)**2 + (y_sources-y)**2))
+        xcen, ycen = x_sources[nearest], y_sources[nearest]
+        if plot is True:
+            plot_obj_center(self.ofile, xcen, ycen, x_sources, y_sources, stamp, 
+                            xlow, xhigh, ylow, yhigh, fig_dir=fig_dir)
+        return xcen, ycen
+    
+    def aperture_photometry(self, xcen, ycen, aperture_radii=np.arange(2, 15), bkg_r_in=16., bkg_r_out=20):
+        '''
+        Background subtracted photometry in circular apertures of radius aperture_radii 
+        centered on xcen, ycen
+        '''
+        apertures = [CircularAperture((xcen, ycen), r=r) for r in aperture_radii]
+        annulus_apertures = CircularAnnulus((xcen, ycen), r_in=bkg_r_in, r_out=bkg_r_out)
+        apertures.append(annulus_apertures)
+        phot_table = aperture_photometry(np.asarray(self.data), apertures )
+        bkg_colname = phot_table.colnames[-1]
+        bkg_mean = phot_table[bkg_colname] / annulus_apertures.area
+        for aper, icol in zip(apertures, phot_table.colnames[3:]):
+            bkg_sum = bkg_mean*aper.area
+            phot_table.add_column(phot_table[icol]-bkg_sum, name='{}_bkg_sub'.format(icol))
+        return phot_table, apertures
+    
+    def detect_sources(self, fwhm=4, threshold=5, sample_step=8):
+        '''
+        Detect the sources of the whole image (see detect_sources) and return their
+        0-indexed pixel positions and RA and DEC
+        '''
+        x, y = detect_sources(self.data, fwhm=fwhm, threshold=threshold, dq=self.plane('DQ'),
+                              sample_step=sample_step)
+        ra, dec = self.wcs.all_pix2world(x, y, 0)
+        return x, y, ra, dec
+    
+    def curve_of_growth(self, positions, radii=np.arange(2, 15), bkg_r_in=16., bkg_r_out=20., 
+                        subpixels=5):
+        '''
+        Photometry of many sources in many apertures with the errors from the VAR plane
+        (see the curve_of_growth function)
+        '''
+        return curve_of_growth(self.data, positions, radii=radii, bkg_r_in=bkg_r_in, 
+                               bkg_r_out=bkg_r_out, var=self.plane('VAR'), dq=self.plane('DQ'),
+                               subpixels=subpixels)
+    
+    def close(self):
+        self._planes = {}
+        self.ofile.close()
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+def iter_sessions(file_list, file_dir='./'):
+    '''
+    Yield (filename, PhotometrySession) for each file of file_list in file_dir, closing
+    each file before the next one is opened
+    '''
+    for ifile in file_list:
+        with PhotometrySession(os.path.join(file_dir, ifile)) as session:
+            yield ifile, session
+
+@GMOS_instrumentation.instrument
 def find_obj_center(filename, x=None, y=None, plot=True, fig_dir='./'):
-    ofile = fits.open(filename)
-    if (x is None) and (y is None):
-        ra = ofile[0].header['ra']
-        dec = ofile[0].header['dec']
-        x, y = WCS(ofile[1].header).all_world2pix(ra, dec, 1)
-    xlow, xhigh = int(x-50), int(x+50)
-    ylow, yhigh = int(y-50), int(y+50)
-    stamp = ofile[1].data[ylow:yhigh, xlow:xhigh]
-    mean, median, std = sigma_clipped_stats(stamp, sigma=3.0, iters=5)  
-    daofind = pu.DAOStarFinder(fwhm=4, threshold=5*std)
-    sources = daofind(stamp)
-    x_sources = sources['xcentroid']+xlow
-    y_sources = sources['ycentroid']+ylow
-
-    nearest = np.argmin(np.sqrt((x_sources-x)**2 + (y_sources-y)**2))
-    xcen, ycen = x_sources[nearest], y_sources[nearest]
-    if plot is True:
-        plot_obj_center(ofile, xcen, ycen, x_sources, y_sources, stamp, 
-                        xlow, xhigh, ylow, yhigh, fig_dir=fig_dir)
-    return xcen, ycen
+    with PhotometrySession(filename) as session:
+        return session.find_obj_center(x=x, y=y, plot=plot, fig_dir=fig_dir)
     
 def plot_obj_center(ofile, xcen, ycen, x_sources, y_sources, stamp, xlow, xhigh, ylow, yhigh,
                     fig_dir='./'):
@@ -51,45 +276,286 @@ def plot_obj_center(ofile, xcen, ycen, x_sources, y_sources, stamp, xlow, xhigh,
     ax2.plot(xcen, ycen, '*', mfc='c', mec='b')
     plt.savefig(os.path.join(fig_dir, '{}_id_confirm.pdf'.format(ofile[0].header['object'])))
     
+@GMOS_instrumentation.instrument
 def perform_aperture_photometry(xcen, ycen, filename, aperture_radii = np.arange(2, 15), bkg_r_in=16., bkg_r_out=20):
-    ofile = fits.open(filename)
-    apertures = [pu.CircularAperture((xcen, ycen), r=r) for r in aperture_radii]
-    annulus_apertures = pu.CircularAnnulus((xcen, ycen), r_in=bkg_r_in, r_out=bkg_r_out)
-    apertures.append(annulus_apertures)
-    phot_table = pu.aperture_photometry(ofile[1].data, apertures )
-    bkg_colname = phot_table.colnames[-1]
-    bkg_mean = phot_table[bkg_colname] / annulus_apertures.area()
-    for aper, icol in zip(apertures, phot_table.colnames[3:]):
-        bkg_sum = bkg_mean*aper.area()
-        phot_table.add_column(phot_table[icol]-bkg_sum, name='{}_bkg_sub'.format(icol))
-    return phot_table, apertures
+    with PhotometrySession(filename) as session:
+        return session.aperture_photometry(xcen, ycen, aperture_radii=aperture_radii, 
+                                           bkg_r_in=bkg_r_in, bkg_r_out=bkg_r_out)
 
-def find_std_zeropoint(file_dir, file_list, k, m_std, use_aperture, 
-                       x=None, y=None, plot=True, fig_dir='./'):
-    phot_tab_std = None
-    for ifile in file_list: 
-        filename = os.path.join(file_dir, ifile)
-        xcen, ycen = find_obj_center(filename, x=x, y=y, plot=plot, fig_dir=fig_dir)
-        aperture = np.arange(2, 20, 2)
-        phot_tab_std_tmp, apertures_std = perform_aperture_photometry(xcen, ycen, filename, aperture_radii=aperture)
-        airmass = fits.getval(filename, 'airmass', 0)
-        phot_tab_std_tmp.add_column(table.Column(data=[ifile], name='filename'))
-        phot_tab_std_tmp.add_column(table.Column(data=[airmass], name='airmass'))
-        aper_indx = np.where(aperture==use_aperture)[0][0]
-        N = phot_tab_std_tmp['aperture_sum_{}_bkg_sub'.format(aper_indx)]
-        t = fits.getval(filename, 'exptime', 0)
-        m_inst = 28 - 2.5*np.log10(N/t) - k*(airmass-1)
-        phot_tab_std_tmp.add_column(table.Column(data=[m_inst], name='m_inst_{}'.format(aper_indx)))
-        if phot_tab_std:
-            phot_tab_std = table.vstack((phot_tab_std, phot_tab_std_tmp))
+def _measure_std_frame(job):
+    filename, x, y, aperture_radii, bkg_r_in, bkg_r_out = job
+    with PhotometrySession(filename) as session:
+        xcen, ycen = session.find_obj_center(x=x, y=y, plot=False)
+        cog = session.curve_of_growth([xcen, ycen], radii=aperture_radii, 
+                                      bkg_r_in=bkg_r_in, bkg_r_out=bkg_r_out)[0]
+        return {'xcen':xcen, 'ycen':ycen, 'airmass':session.get('airmass'), 
+                'exptime':session.get('exptime'), 'filter':session.get('filter2'),
+                'flux':cog['flux'], 'flux_err':cog['flux_err']}
+
+@GMOS_instrumentation.instrument
+def measure_std_frames(file_list, file_dir='./', x=None, y=None, aperture_radii=np.arange(2, 20, 2), 
+                       bkg_r_in=16., bkg_r_out=20., nprocesses=1):
+    '''
+    Find the standard star in each frame and measure its flux in every aperture. Frames
+    are measured in parallel on a pool of processes and the output table is built once
+    from the collected columns.
+    
+    Input:
+        file_list: list
+            names of the standard star images in file_dir
+        file_dir: str
+            directory of the images
+        x, y: float
+            approximate position of the star. If None, the RA and DEC of the primary
+            header are used
+        aperture_radii: array
+            aperture radii in pixels
+        bkg_r_in, bkg_r_out: float
+            radii of the background annulus
+        nprocesses: int
+            number of worker processes
+    Output:
+        phot_table: astropy.table.Table
+            one row per frame with the columns filename, xcen, ycen, airmass, exptime,
+            filter, flux and flux_err (arrays with one value for each of 
+            phot_table.meta['aperture_radii'])
+    '''
+    jobs = [(os.path.join(file_dir, ifile), x, y, aperture_radii, bkg_r_in, bkg_r_out) for ifile in file_list]
+    GMOS_instrumentation.add_fields(files=len(jobs))
+    if nprocesses > 1:
+        pool = Pool(nprocesses)
+        try:
+            results = pool.map(_measure_std_frame, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_measure_std_frame(job) for job in jobs]
+    columns = OrderedDict([('filename', list(file_list))])
+    for colname in ['xcen', 'ycen', 'airmass', 'exptime', 'filter', 'flux', 'flux_err']:
+        columns[colname] = [result[colname] for result in results]
+    phot_table = table.Table(columns)
+    phot_table.meta['aperture_radii'] = list(aperture_radii)
+    return phot_table
+
+def instrumental_mag(phot_table, use_aperture):
+    '''
+    Instrumental magnitude (-2.5 log10(counts/s)) of each row of a measure_std_frames
+    table in the aperture of radius use_aperture
+    '''
+    aper_indx = list(phot_table.meta['aperture_radii']).index(use_aperture)
+    return -2.5*np.log10(np.asarray(phot_table['flux'])[:, aper_indx]/np.asarray(phot_table['exptime'], dtype=float))
+
+@GMOS_instrumentation.instrument
+def fit_zeropoint(phot_table, m_std, use_aperture, k=None, sigma=3.0, iters=5):
+    '''
+    Fit m_std = m_zpt - 2.5 log10(counts/s) - k (airmass - 1) to the frames of a
+    measure_std_frames table with iterative sigma clipping
+    
+    Input:
+        phot_table: astropy.table.Table
+            output of measure_std_frames
+        m_std: float or array
+            catalog magnitude of the standard star (or one per frame)
+        use_aperture: float
+            aperture radius used (one of the aperture_radii of phot_table)
+        k: float
+            extinction coefficient. If None, k is fit as well
+        sigma: float
+            rejection threshold in standard deviations
+        iters: int
+            maximum number of rejection iterations
+    Output:
+        fit: dict
+            'm_zpt': zero point, 'm_zpt_err': its standard error, 'k': extinction
+            coefficient, 'used': boolean array of the frames used in the fit
+    '''
+    airmass = np.asarray(phot_table['airmass'], dtype=float)
+    y = m_std - instrumental_mag(phot_table, use_aperture)
+    used = np.isfinite(y)
+    for i in range(iters+1):
+        if k is None and len(np.unique(airmass[used])) > 1:
+            slope, m_zpt = np.polyfit(airmass[used] - 1, y[used], 1)
+            fit_k = -slope
         else:
-            phot_tab_std = phot_tab_std_tmp
-        if plot is True:
-            plt.figure()
-            for indx, aper in enumerate(apertures_std[:-1]):
-                colname = 'aperture_sum_{}_bkg_sub'.format(indx)
-                plt.plot(aper.r, phot_tab_std[-1][colname], 'o')
-            plt.grid()
-
-    m_zpt = np.median(m_std - phot_tab_std['m_inst_{}'.format(aper_indx)] + 28)  
-    return m_zpt
\ No newline at end of file
+            fit_k = k if k is not None else 0.
+            m_zpt = np.median(y[used] + fit_k*(airmass[used] - 1))
+        residuals = y + fit_k*(airmass - 1) - m_zpt
+        std = np.std(residuals[used])
+        new_used = np.isfinite(y) & (np.abs(residuals) <= sigma*std) if std > 0 else used
+        if np.array_equal(new_used, used) or new_used.sum() < 2:
+            break
+        used = new_used
+    m_zpt_err = np.std(residuals[used])/np.sqrt(max(used.sum(), 1))
+    return {'m_zpt':m_zpt, 'm_zpt_err':m_zpt_err, 'k':fit_k, 'used':used}
+
+def plot_zeropoint(phot_table, fit, m_std, use_aperture, out_filename):
+    '''
+    Plot the curve of growth of each frame and the zero point fit against airmass
+    '''
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=[10, 5])
+    radii = phot_table.meta['aperture_radii']
+    for row in phot_table:
+        ax1.plot(radii, row['flux'], 'o-')
+    ax1.axvline(use_aperture, color='k', linestyle=':')
+    ax1.set_xlabel('Aperture radius (pixels)')
+    ax1.set_ylabel('Background subtracted counts')
+    ax1.grid()
+    airmass = np.asarray(phot_table['airmass'], dtype=float)
+    y = m_std - instrumental_mag(phot_table, use_aperture)
+    ax2.plot(airmass[fit['used']], y[fit['used']], 'o', label='used')
+    ax2.plot(airmass[~fit['used']], y[~fit['used']], 'x', label='rejected')
+    airmass_grid = np.linspace(airmass.min(), airmass.max(), 10)
+    ax2.plot(airmass_grid, fit['m_zpt'] - fit['k']*(airmass_grid - 1), 
+             label='zpt={:.3f} k={:.3f}'.format(fit['m_zpt'], fit['k']))
+    ax2.set_xlabel('Airmass')
+    ax2.set_ylabel('m_std + 2.5 log10(counts/s)')
+    ax2.legend()
+    fig.savefig(out_filename)
+    plt.close(fig)
+
+@GMOS_instrumentation.instrument
+def find_std_zeropoint(file_dir, file_list, k, m_std, use_aperture, 
+                       x=None, y=None, plot=True, fig_dir='./', nprocesses=1):
+    '''
+    Zero point from standard star images with a known extinction coefficient k
+    (see measure_std_frames and fit_zeropoint). If plot is True, the identification
+    of the star in each frame and the fit are plotted in fig_dir.
+    '''
+    phot_tab_std = measure_std_frames(file_list, file_dir, x=x, y=y, nprocesses=nprocesses)
+    fit = fit_zeropoint(phot_tab_std, m_std, use_aperture, k=k)
+    if plot is True:
+        for ifile, session in iter_sessions(file_list, file_dir):
+            session.find_obj_center(x=x, y=y, plot=True, fig_dir=fig_dir)
+            plt.close('all')
+        plot_zeropoint(phot_tab_std, fit, m_std, use_aperture, 
+                       os.path.join(fig_dir, 'std_zeropoint.pdf'))
+    return fit['m_zpt']
+
+def detect_sources(data, fwhm=4, threshold=5, dq=None, sample_step=8):
+    '''
+    Detect point sources over a whole image with DAOStarFinder. The background level and
+    noise are sigma-clipped statistics of every sample_step-th pixel (of the pixels
+    not flagged in dq).
+    
+    Output:
+        x, y: array
+            0-indexed pixel positions of the sources
+    '''
+    sample = data[::sample_step, ::sample_step]
+    if dq is not None:
+        sample = sample[dq[::sample_step, ::sample_step] == 0]
+    sample = sample[np.isfinite(sample)]
+    mean, median, std = sigma_clipped_stats(sample, sigma=3.0, maxiters=5)
+    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold*std)
+    sources = daofind(np.asarray(data) - median)
+    if sources is None:
+        return np.array([]), np.array([])
+    return np.asarray(sources['x_centroid']), np.asarray(sources['y_centroid'])
+
+def _unit_vectors(ra, dec):
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    return np.column_stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+
+def match_catalog(ra, dec, cat_ra, cat_dec, max_sep=1.0):
+    '''
+    Match each source to the nearest catalog star within max_sep arcseconds. The
+    positions are converted to unit vectors and the catalog is searched with a KD-tree,
+    so matching takes O(N log M) time.
+    
+    Output:
+        source_index, catalog_index: array
+            indices of the matched sources and catalog stars. When several sources
+            match the same catalog star, only the closest is kept
+        separation: array
+            separations of the matches in arcseconds
+    '''
+    if len(ra) == 0 or len(cat_ra) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+    tree = cKDTree(_unit_vectors(cat_ra, cat_dec))
+    max_chord = 2*np.sin(np.radians(max_sep/3600.)/2)
+    chord, catalog_index = tree.query(_unit_vectors(ra, dec), distance_upper_bound=max_chord)
+    source_index = np.where(np.isfinite(chord))[0]
+    chord = chord[source_index]
+    catalog_index = catalog_index[source_index]
+    #Keep the closest source to each catalog star
+    order = np.lexsort((chord, catalog_index))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = catalog_index[order][1:] != catalog_index[order][:-1]
+    keep = order[first]
+    separation = np.degrees(2*np.arcsin(chord[keep]/2))*3600.
+    return source_index[keep], catalog_index[keep], separation
+
+@GMOS_instrumentation.instrument
+def field_zeropoint(filename, catalog_filename, mag_col, ra_col='ra', dec_col='dec', 
+                    use_aperture=6, bkg_r_in=16., bkg_r_out=20., k=0., max_sep=1.0, 
+                    fwhm=4, threshold=5, sigma=3.0, iters=5):
+    '''
+    Zero point of an image from the field stars of a reference catalog. The sources
+    of the whole image are detected, converted to RA and DEC with one call to the WCS,
+    matched to the catalog (see match_catalog), and measured in an aperture of radius
+    use_aperture. The zero point is the sigma-clipped median of
+    mag + 2.5 log10(counts/s) + k (airmass - 1).
+    
+    Input:
+        filename: str
+            image (e.g. a mosaicked mrg* image)
+        catalog_filename: str
+            reference catalog in any format astropy.table.Table.read can read
+        mag_col, ra_col, dec_col: str
+            names of the magnitude and (degree) coordinate columns of the catalog
+        use_aperture, bkg_r_in, bkg_r_out: float
+            aperture and background annulus radii in pixels
+        k: float
+            extinction coefficient
+        max_sep: float
+            maximum separation of a match in arcseconds
+        fwhm, threshold:
+            parameters of detect_sources
+        sigma, iters:
+            sigma clipping of the zero points of the individual stars
+    Output:
+        m_zpt: float
+            zero point
+        m_zpt_err: float
+            standard error of the zero point
+        matches: astropy.table.Table
+            the matched stars with their position, catalog magnitude, flux, zero point,
+            and whether they were used
+    
+    A ValueError is raised if no matched star has a usable flux.
+    '''
+    catalog = table.Table.read(catalog_filename)
+    with PhotometrySession(filename) as session:
+        x, y, ra, dec = session.detect_sources(fwhm=fwhm, threshold=threshold)
+        source_index, catalog_index, separation = match_catalog(ra, dec, catalog[ra_col], 
+                                                                catalog[dec_col], max_sep=max_sep)
+        positions = np.column_stack([x[source_index], y[source_index]])
+        cog = session.curve_of_growth(positions, radii=[use_aperture], bkg_r_in=bkg_r_in,
+                                      bkg_r_out=bkg_r_out)[:, 0]
+        exptime = session.get('exptime')
+        airmass = session.get('airmass', 1.)
+    mag = np.asarray(catalog[mag_col], dtype=float)[catalog_index]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        zpts = mag + 2.5*np.log10(cog['flux']/exptime) + k*(airmass - 1)
+    good = np.isfinite(zpts) & (cog['nbad'] == 0)
+    if not np.any(good):
+        raise ValueError('No field stars of {} with a usable flux match {} ({} matches within {}")'
+                         .format(filename, catalog_filename, len(source_index), max_sep))
+    used = good.copy()
+    for i in range(iters):
+        center = np.median(zpts[used])
+        std = np.std(zpts[used])
+        new_used = good & (np.abs(zpts - center) <= sigma*std)
+        if np.array_equal(new_used, used) or new_used.sum() < 2:
+            break
+        used = new_used
+    m_zpt = np.median(zpts[used])
+    m_zpt_err = 1.2533*np.std(zpts[used])/np.sqrt(max(used.sum(), 1))
+    matches = table.Table(OrderedDict([('x', positions[:, 0]), ('y', positions[:, 1]), 
+                                       ('ra', ra[source_index]), ('dec', dec[source_index]),
+                                       ('separation', separation), ('mag', mag), 
+                                       ('flux', cog['flux']), ('flux_err', cog['flux_err']),
+                                       ('zpt', zpts), ('used', used)]))
+    return m_zpt, m_zpt_err, matches
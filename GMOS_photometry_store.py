@@ -0,0 +1,245 @@
+'''
+Persistent store of photometry measurements for light curves.
+
+Centroids, aperture fluxes and zero points are saved in a sqlite3 database, keyed by the
+fingerprint of the image (its name, size and modification time), the target name and
+position (RA and DEC rounded to 1e-5 degrees), and the apertures used. Measuring a list
+of images only measures the images which are new or have changed since they were last
+measured, so the photometry of a growing set of epochs can be re-run after every new
+observation. Light curves are read back per target, position and filter.
+'''
+import os
+import sqlite3
+import hashlib
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+from astropy import table
+
+import GMOS_photometry
+
+def image_fingerprint(filename):
+    '''
+    Fingerprint of an image: changes when the file is replaced or modified
+    '''
+    fstat = os.stat(filename)
+    description = '{}:{}:{}'.format(os.path.basename(filename), fstat.st_size, fstat.st_mtime)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+def aperture_key(aperture_radii, bkg_r_in, bkg_r_out):
+    return '{}|{}:{}'.format(','.join('{:g}'.format(r) for r in aperture_radii), bkg_r_in, bkg_r_out)
+
+def position_key(ra, dec):
+    '''
+    Key of a target position: RA and DEC rounded to 1e-5 degrees, or 'header' for the
+    RA and DEC of each image's primary header
+    '''
+    if ra is None:
+        return 'header'
+    return '{:.5f},{:.5f}'.format(ra, dec)
+
+def _measure_target(job):
+    filename, ra, dec, aperture_radii, bkg_r_in, bkg_r_out = job
+    try:
+        with GMOS_photometry.PhotometrySession(filename) as session:
+            if ra is None:
+                ra, dec = session.get('ra'), session.get('dec')
+            x, y = session.wcs.all_world2pix(ra, dec, 1)
+            xcen, ycen = session.find_obj_center(x=x, y=y, plot=False)
+            cog = session.curve_of_growth([xcen, ycen], radii=aperture_radii,
+                                          bkg_r_in=bkg_r_in, bkg_r_out=bkg_r_out)[0]
+            header = dict((keyword, session.get(keyword)) for keyword in
+                          ['OBJECT', 'FILTER2', 'DATE-OBS', 'TIME-OBS', 'MJD-OBS', 'EXPTIME', 'AIRMASS'])
+        return filename, (xcen, ycen, cog, header), None
+    except Exception as err:
+        return filename, None, str(err)
+
+class PhotometryStore(object):
+    '''
+    sqlite3 database of photometry. Use as a context manager (or call close).
+    '''
+    def __init__(self, database_filename='photometry.sqlite3'):
+        self.database_filename = database_filename
+        self.conn = sqlite3.connect(database_filename)
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS images
+                                 (Fingerprint TEXT PRIMARY KEY, Path TEXT, Object TEXT, Filter TEXT,
+                                  DateObs TEXT, TimeObs TEXT, MJD REAL, Texp REAL, Airmass REAL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS images_path ON images (Path)')
+            #Measurements stored before the Position key can't be told apart by position,
+            #so their table is dropped and the images are measured again
+            existing = [row[1] for row in self.conn.execute('PRAGMA table_info(photometry)')]
+            if (len(existing) > 0) and ('Position' not in existing):
+                self.conn.execute('DROP TABLE photometry')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS photometry
+                                 (Fingerprint TEXT, Target TEXT, Position TEXT, Apertures TEXT, Radius REAL,
+                                  XCen REAL, YCen REAL, Flux REAL, FluxErr REAL, Bkg REAL, NBad INTEGER,
+                                  PRIMARY KEY (Fingerprint, Target, Position, Apertures, Radius))''')
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS photometry_target_position ON photometry 
+                                 (Target, Position, Apertures)''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS zeropoints
+                                 (Fingerprint TEXT PRIMARY KEY, MZpt REAL, MZptErr REAL, Method TEXT)''')
+
+    def _forget_changed(self, path, fingerprint):
+        '''
+        Remove the measurements of earlier versions of the image at path
+        '''
+        old = [row[0] for row in self.conn.execute('SELECT Fingerprint FROM images WHERE Path=? AND Fingerprint!=?',
+                                                   (path, fingerprint))]
+        for old_fingerprint in old:
+            for table_name in ['images', 'photometry', 'zeropoints']:
+                self.conn.execute('DELETE FROM {} WHERE Fingerprint=?'.format(table_name), (old_fingerprint,))
+
+    def _add_image(self, path, fingerprint, header):
+        self._forget_changed(path, fingerprint)
+        self.conn.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (fingerprint, path, header['OBJECT'], header['FILTER2'], header['DATE-OBS'],
+                           header['TIME-OBS'], header['MJD-OBS'], header['EXPTIME'], header['AIRMASS']))
+
+    def measure(self, file_list, target, ra=None, dec=None, aperture_radii=np.arange(2, 15),
+                bkg_r_in=16., bkg_r_out=20., nprocesses=1):
+        '''
+        Measure target in the images of file_list which haven't been measured at this
+        position with these apertures (or which changed since they were measured)
+
+        Input:
+            file_list: list
+                names of the images
+            target: str
+                name of the target the measurements are stored under
+            ra, dec: float
+                position of the target. If None, the RA and DEC of each image's
+                primary header are used
+            aperture_radii, bkg_r_in, bkg_r_out:
+                aperture and background annulus radii in pixels
+            nprocesses: int
+                number of worker processes measuring images
+        Output:
+            summary: dict
+                'measured' and 'cached' lists of file names and 'failed', a list of
+                (filename, error message) tuples
+        '''
+        apertures = aperture_key(aperture_radii, bkg_r_in, bkg_r_out)
+        position = position_key(ra, dec)
+        summary = {'measured':[], 'cached':[], 'failed':[]}
+        jobs = []
+        fingerprints = {}
+        for filename in file_list:
+            fingerprints[filename] = image_fingerprint(filename)
+            cached = self.conn.execute('''SELECT COUNT(*) FROM photometry 
+                                          WHERE Fingerprint=? AND Target=? AND Position=? AND Apertures=?''',
+                                       (fingerprints[filename], target, position, apertures)).fetchone()[0]
+            if cached > 0:
+                summary['cached'].append(filename)
+            else:
+                jobs.append((filename, ra, dec, aperture_radii, bkg_r_in, bkg_r_out))
+        if nprocesses > 1 and len(jobs) > 1:
+            pool = Pool(nprocesses)
+            try:
+                results = pool.map(_measure_target, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_measure_target(job) for job in jobs]
+        with self.conn:
+            for filename, result, err in results:
+                if err is not None:
+                    summary['failed'].append((filename, err))
+                    continue
+                xcen, ycen, cog, header = result
+                self._add_image(os.path.abspath(filename), fingerprints[filename], header)
+                self.conn.executemany('INSERT OR REPLACE INTO photometry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      [(fingerprints[filename], target, position, apertures, float(row['radius']),
+                                        float(xcen), float(ycen), float(row['flux']), float(row['flux_err']),
+                                        float(row['bkg']), int(row['nbad'])) for row in cog])
+                summary['measured'].append(filename)
+        return summary
+
+    def get_zeropoint(self, filename):
+        '''
+        Return the stored (m_zpt, m_zpt_err) of the current version of an image, or None
+        '''
+        return self.conn.execute('SELECT MZpt, MZptErr FROM zeropoints WHERE Fingerprint=?',
+                                 (image_fingerprint(filename),)).fetchone()
+
+    def set_zeropoint(self, filename, m_zpt, m_zpt_err=None, method='std'):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO zeropoints VALUES (?, ?, ?, ?)',
+                              (image_fingerprint(filename), m_zpt, m_zpt_err, method))
+
+    def field_zeropoints(self, file_list, catalog_filename, mag_col, **kwargs):
+        '''
+        Compute and store the field star zero point (GMOS_photometry.field_zeropoint) of
+        each image of file_list which doesn't have a stored zero point
+        '''
+        for filename in file_list:
+            if self.get_zeropoint(filename) is None:
+                m_zpt, m_zpt_err, matches = GMOS_photometry.field_zeropoint(filename, catalog_filename,
+                                                                            mag_col, **kwargs)
+                self.set_zeropoint(filename, m_zpt, m_zpt_err, method='field')
+
+    def light_curve(self, target, ra=None, dec=None, filter_name=None, aperture_radius=None,
+                    aperture_radii=np.arange(2, 15), bkg_r_in=16., bkg_r_out=20.):
+        '''
+        Light curve of target from the stored measurements
+
+        Input:
+            target: str
+                name the measurements were stored under
+            ra, dec: float
+                position the measurements were made at (None: the header positions)
+            filter_name: str
+                only return images whose filter starts with filter_name (e.g. 'r'
+                matches 'r_G0303'). If None, all filters are returned
+            aperture_radius: float
+                aperture to return. If None, every aperture is returned
+            aperture_radii, bkg_r_in, bkg_r_out:
+                apertures the measurements were made with
+        Output:
+            light_curve: astropy.table.Table
+                one row per image and aperture, ordered by date, with mag and mag_err
+                for images with a stored zero point (NaN otherwise)
+        '''
+        sql = '''SELECT images.Path, images.Filter, images.DateObs, images.TimeObs, images.MJD,
+                        images.Texp, images.Airmass, photometry.Radius, photometry.XCen,
+                        photometry.YCen, photometry.Flux, photometry.FluxErr,
+                        zeropoints.MZpt, zeropoints.MZptErr
+                 FROM photometry JOIN images ON photometry.Fingerprint = images.Fingerprint
+                 LEFT JOIN zeropoints ON photometry.Fingerprint = zeropoints.Fingerprint
+                 WHERE photometry.Target=? AND photometry.Position=? AND photometry.Apertures=?'''
+        params = [target, position_key(ra, dec), aperture_key(aperture_radii, bkg_r_in, bkg_r_out)]
+        if filter_name is not None:
+            sql += ' AND images.Filter LIKE ?'
+            params.append(filter_name + '%')
+        if aperture_radius is not None:
+            sql += ' AND photometry.Radius=?'
+            params.append(float(aperture_radius))
+        sql += ' ORDER BY images.DateObs, images.TimeObs, photometry.Radius'
+        rows = self.conn.execute(sql, params).fetchall()
+        colnames = ['filename', 'filter', 'date_obs', 'time_obs', 'mjd', 'exptime', 'airmass', 'radius',
+                    'xcen', 'ycen', 'flux', 'flux_err', 'm_zpt', 'm_zpt_err']
+        columns = OrderedDict()
+        for icol, colname in enumerate(colnames):
+            values = [row[icol] for row in rows]
+            if icol >= 4: #numeric columns, with NULL (e.g. no zero point) as NaN
+                values = np.array([np.nan if value is None else value for value in values], dtype=float)
+            columns[colname] = values
+        light_curve = table.Table(columns)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            light_curve['mag'] = columns['m_zpt'] - 2.5*np.log10(columns['flux']/columns['exptime'])
+            light_curve['mag_err'] = 2.5/np.log(10)*columns['flux_err']/columns['flux']
+        return light_curve
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
@@ -0,0 +1,401 @@
+'''
+Make-style incremental driver for the imaging reduction.
+
+The reduction is described as a graph of nodes over files:
+
+    raw bias frames -> MCbias.fits
+    raw flats, MCbias.fits -> MCflat_<filter>.fits
+    raw science frame, MCbias.fits, MCflat_<filter>.fits -> rg<frame>.fits -> mrg<frame>.fits
+    mrg<frame>.fits of a target and filter -> <target>_<filter>.fits
+
+Each node has a fingerprint computed from the function it runs, its parameters, and the
+fingerprints of its inputs (the size and modification time of raw files, or the
+fingerprint of the node which creates the file). The fingerprints of the outputs of each
+node that ran are recorded in a state file in the reduction directory, and a node is only
+run again if one of its outputs is missing, its fingerprint changed, or a node it depends
+on is run. Nodes whose inputs are ready run concurrently on a pool of threads; IRAF tasks
+are then sent to a GMOS_iraf_pool.IrafPool.
+
+When a new science frame is added, only the reduction and mosaic of that frame and the
+co-add of its target and filter are run.
+'''
+import os
+import json
+import hashlib
+import traceback
+import queue
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import fileSelect
+import GMOS_compressed_io
+import GMOS_obslog
+import GMOS_precalibration
+import GMOS_imaging_calibration
+import GMOS_iraf_pool
+import GMOS_parallel
+import GMOS_instrumentation
+
+STATE_FILENAME = 'pipeline_state.json'
+
+#Arguments of a node's function which don't change its result
+IGNORED_PARAMS = ('iraf_pool', 'data_dir')
+
+class Node(object):
+    '''
+    One step of the pipeline: func(**kwargs) creates the files outputs from the files
+    inputs. If clean is True, existing outputs are removed before func is run (IRAF
+    tasks won't overwrite their output).
+    '''
+    def __init__(self, name, inputs, outputs, func, kwargs=None, clean=True):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.func = func
+        if kwargs is None:
+            kwargs = {}
+        self.kwargs = kwargs
+        self.clean = clean
+
+    def params(self):
+        params = dict((k, v) for k, v in self.kwargs.items() if k not in IGNORED_PARAMS)
+        params['func'] = '{}.{}'.format(self.func.__module__, self.func.__name__)
+        return params
+
+class Pipeline(object):
+    '''
+    A graph of Nodes run in the directory data_dir. Files are named relative to data_dir.
+    '''
+    def __init__(self, data_dir, state_filename=STATE_FILENAME):
+        self.data_dir = os.path.abspath(data_dir)
+        self.state_filename = os.path.join(self.data_dir, state_filename)
+        self.nodes = OrderedDict()
+        self.producers = {}
+
+    def add(self, name, inputs, outputs, func, kwargs=None, clean=True):
+        '''
+        Add a node (see Node). Nodes can be added in any order.
+        '''
+        if name in self.nodes:
+            raise ValueError('Duplicate pipeline node {}'.format(name))
+        for ifile in outputs:
+            if ifile in self.producers:
+                raise ValueError('{} is created by both {} and {}'.format(ifile, self.producers[ifile], name))
+            self.producers[ifile] = name
+        self.nodes[name] = Node(name, inputs, outputs, func, kwargs, clean)
+        return self.nodes[name]
+
+    def dependencies(self, name):
+        return set(self.producers[ifile] for ifile in self.nodes[name].inputs if ifile in self.producers)
+
+    def _sorted_nodes(self):
+        '''
+        Node names in an order in which each node comes after the nodes it depends on
+        '''
+        order = []
+        visiting = set()
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError('Pipeline has a cycle through {}'.format(name))
+            visiting.add(name)
+            for dep in sorted(self.dependencies(name)):
+                visit(dep)
+            visiting.remove(name)
+            order.append(name)
+        for name in self.nodes:
+            visit(name)
+        return order
+
+    def _file_fingerprint(self, filename, fingerprints):
+        if filename in self.producers:
+            return fingerprints[self.producers[filename]]
+        #raw frames may be kept compressed (.fits.bz2 or .fits.fz)
+        path = GMOS_compressed_io.resolve_fits(os.path.join(self.data_dir, filename))
+        if not os.path.exists(path):
+            return 'missing'
+        fstat = os.stat(path)
+        return '{}:{}'.format(fstat.st_size, fstat.st_mtime)
+
+    def fingerprints(self):
+        '''
+        Return a dictionary of node name: fingerprint for all nodes
+        '''
+        fingerprints = {}
+        for name in self._sorted_nodes():
+            node = self.nodes[name]
+            description = {'params':node.params(),
+                           'inputs':[(ifile, self._file_fingerprint(ifile, fingerprints))
+                                     for ifile in node.inputs]}
+            fingerprints[name] = hashlib.sha1(json.dumps(description, sort_keys=True,
+                                              default=str).encode('utf-8')).hexdigest()
+        return fingerprints
+
+    def read_state(self):
+        if not os.path.exists(self.state_filename):
+            return {}
+        with open(self.state_filename, 'r') as ofile:
+            return json.load(ofile)
+
+    def write_state(self, state):
+        tmp_filename = '{}.tmp'.format(self.state_filename)
+        with open(tmp_filename, 'w') as ofile:
+            json.dump(state, ofile, indent=1, sort_keys=True)
+        os.rename(tmp_filename, self.state_filename)
+
+    def stale_nodes(self, fingerprints=None):
+        '''
+        Return the names of the nodes which need to be run, in dependency order
+        '''
+        if fingerprints is None:
+            fingerprints = self.fingerprints()
+        state = self.read_state()
+        stale = []
+        for name in self._sorted_nodes():
+            node = self.nodes[name]
+            out_of_date = any((not os.path.exists(os.path.join(self.data_dir, ifile))) or
+                              (state.get(ifile) != fingerprints[name]) for ifile in node.outputs)
+            if out_of_date or (len(self.dependencies(name) & set(stale)) > 0):
+                stale.append(name)
+        return stale
+
+    def _run_node(self, name):
+        node = self.nodes[name]
+        try:
+            if node.clean:
+                for ifile in node.outputs:
+                    if os.path.exists(ifile):
+                        os.remove(ifile)
+            #The reduction functions modify the query dictionaries they are given
+            kwargs = dict((k, dict(v) if isinstance(v, dict) else v) for k, v in node.kwargs.items())
+            with GMOS_instrumentation.stage(name, module=__name__, node=name):
+                node.func(**kwargs)
+            missing = [ifile for ifile in node.outputs if not os.path.exists(ifile)]
+            if len(missing) > 0:
+                return name, '{} did not create {}'.format(name, ', '.join(missing))
+            return name, None
+        except BaseException: #including the sys.exit calls of the reduction functions
+            return name, traceback.format_exc()
+
+    def run(self, nthreads=1, dry_run=False):
+        '''
+        Run the stale nodes. A node starts as soon as all of the nodes it depends on have
+        finished, with up to nthreads nodes running at once. Nodes which depend on a node
+        which failed are not run.
+
+        Input:
+            nthreads: int
+                maximum number of nodes run at the same time
+            dry_run: bool
+                if True, only report which nodes would be run
+        Output:
+            report: dict
+                'run': names of nodes which were run, 'up_to_date': names of nodes which
+                were not run, 'failed': names of nodes which failed, 'skipped': names of
+                nodes which were not run because a node they depend on failed.
+                A RuntimeError is raised after all other nodes finish if any node fails.
+        '''
+        fingerprints = self.fingerprints()
+        stale = self.stale_nodes(fingerprints)
+        report = {'run':[], 'up_to_date':[name for name in self.nodes if name not in stale],
+                  'failed':[], 'skipped':[]}
+        if dry_run:
+            report['run'] = stale
+            return report
+        state = self.read_state()
+        pending = list(stale)
+        running = set()
+        finished = queue.Queue()
+        cur_dir = os.getcwd()
+        #All nodes share the process's current directory, so it is set once here
+        os.chdir(self.data_dir)
+        pool = ThreadPool(nthreads)
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                for name in list(pending):
+                    deps = self.dependencies(name) & set(stale)
+                    if len(deps & set(report['failed'] + report['skipped'])) > 0:
+                        pending.remove(name)
+                        report['skipped'].append(name)
+                    elif deps <= set(report['run']):
+                        pending.remove(name)
+                        running.add(name)
+                        print('PIPELINE running {}'.format(name))
+                        pool.apply_async(self._run_node, (name,), callback=finished.put)
+                if len(running) == 0:
+                    continue
+                name, error = finished.get()
+                running.remove(name)
+                if error is None:
+                    report['run'].append(name)
+                    for ifile in self.nodes[name].outputs:
+                        state[ifile] = fingerprints[name]
+                    self.write_state(state)
+                else:
+                    print('ERROR in {}:\n{}'.format(name, error))
+                    report['failed'].append(name)
+        finally:
+            pool.close()
+            pool.join()
+            os.chdir(cur_dir)
+        if len(report['failed']) > 0:
+            raise RuntimeError('Pipeline nodes failed: {} (skipped: {})'.format(
+                               ', '.join(report['failed']), ', '.join(report['skipped'])))
+        return report
+
+def _fits(filename):
+    return '{}.fits'.format(filename)
+
+def build_pipeline(qd, targets, dbFile, data_dir, bias_date_range=None, flat_date_range=None,
+                   filters=None, backend='iraf', max_lookback=365, cache_dir=None,
+                   iraf_pool=None, prefix='rg', compress=False):
+    '''
+    Create the Pipeline which reduces the science images selected by qd and co-adds
+    them for each of targets, using the observation database dbFile in data_dir.
+
+    Input:
+        qd: dict
+            query dictionary of the science images (as for calibrate_science_images)
+        targets: list
+            names of the co-add targets (as for create_coadd_img)
+        dbFile: str
+            name of the observation database in data_dir
+        data_dir: str
+            reduction directory
+        bias_date_range, flat_date_range: str
+            DateObs ('start:end') used to select the bias and flat frames. If None,
+            qd['DateObs'] is used
+        filters: list
+            filters to reduce (default GMOS_imaging_calibration.FILTERS)
+        backend: str
+            'iraf' or 'native' (see GMOS_imaging_calibration)
+        max_lookback, cache_dir:
+            see create_master_bias
+        iraf_pool: GMOS_iraf_pool.IrafPool
+            pool the IRAF tasks are sent to. Required to run IRAF nodes concurrently
+        prefix: str
+            prefix of the reduced images
+        compress: bool
+            write the master calibrations, reduced and mosaicked images, and co-adds
+            tile-compressed (backend='native' only, see GMOS_compressed_io)
+    Output:
+        pipeline: Pipeline
+    '''
+    if filters is None:
+        filters = GMOS_imaging_calibration.FILTERS
+    data_dir = os.path.abspath(data_dir)
+    db_path = os.path.join(data_dir, dbFile)
+    pipeline = Pipeline(data_dir)
+    #Only passed when set, so that the fingerprints of uncompressed reductions don't change
+    write_kwargs = {'compress':True} if compress else {}
+
+    bias_qd = dict(qd)
+    if bias_date_range is not None:
+        bias_qd['DateObs'] = bias_date_range
+    bias_files, date_range = GMOS_obslog.select_calibrations('bias', dict(bias_qd), db_path,
+                                        min_frames=7, max_lookback=max_lookback)
+    pipeline.add('bias', [_fits(x) for x in bias_files], ['MCbias.fits'],
+                 GMOS_imaging_calibration.create_master_bias,
+                 {'qd':bias_qd, 'dbFile':dbFile, 'data_dir':data_dir, 'max_lookback':max_lookback,
+                  'cache_dir':cache_dir, 'backend':backend, 'iraf_pool':iraf_pool,
+                  **write_kwargs}, clean=False)
+
+    for f in filters:
+        flat_qd = dict(qd)
+        if flat_date_range is not None:
+            flat_qd['DateObs'] = flat_date_range
+        flat_qd['Filter2'] = f + '_G%'
+        flat_files, date_range = GMOS_obslog.select_calibrations('twiFlat', dict(flat_qd), db_path,
+                                            min_frames=7, max_lookback=max_lookback)
+        sci_qd = dict(qd)
+        sci_qd['Filter2'] = f + '_G%'
+        sci_files = fileSelect.fileListQuery(db_path, fileSelect.createQuery('sciImg', sci_qd), sci_qd)
+        if len(sci_files) == 0:
+            continue
+        if len(flat_files) == 0:
+            print('No flats for filter {}, skipping {} science images'.format(f, len(sci_files)))
+            continue
+        pipeline.add('flat_{}'.format(f), [_fits(x) for x in flat_files] + ['MCbias.fits'],
+                     ['MCflat_{}.fits'.format(f)], GMOS_imaging_calibration.create_master_twilight_flat,
+                     {'qd':dict(flat_qd), 'dbFile':dbFile, 'data_dir':data_dir,
+                      'max_lookback':max_lookback, 'cache_dir':cache_dir, 'backend':backend,
+                      'filters':[f], 'iraf_pool':iraf_pool, **write_kwargs}, clean=False)
+        for ifile in sci_files:
+            ifile = str(ifile)
+            pipeline.add('reduce_{}'.format(ifile),
+                         [_fits(ifile), 'MCbias.fits', 'MCflat_{}.fits'.format(f)],
+                         [_fits(prefix+ifile)], GMOS_imaging_calibration.reduce_science_images,
+                         {'file_list':[ifile], 'instrument':qd['Instrument'],
+                          'flat_file':'MCflat_{}'.format(f), 'biasfilename':'MCbias',
+                          'backend':backend, 'iraf_pool':iraf_pool, 'prefix':prefix,
+                          **write_kwargs})
+            pipeline.add('mosaic_{}'.format(ifile), [_fits(prefix+ifile)], [_fits('m'+prefix+ifile)],
+                         GMOS_imaging_calibration.mosaic_images,
+                         {'file_list':[prefix+ifile], 'data_dir':data_dir, 'iraf_pool':iraf_pool,
+                          'backend':backend, **write_kwargs})
+        for t in targets:
+            coadd_qd = dict(sci_qd)
+            coadd_qd['Object'] = t + '%'
+            coadd_files = fileSelect.fileListQuery(db_path, fileSelect.createQuery('sciImg', coadd_qd),
+                                                   coadd_qd)
+            coadd_files = [str(x) for x in coadd_files if str(x) in [str(y) for y in sci_files]]
+            if len(coadd_files) > 1:
+                out_image = t + '_' + f + '.fits'
+                pipeline.add('coadd_{}_{}'.format(t, f), [_fits('m'+prefix+x) for x in coadd_files],
+                             [out_image], GMOS_imaging_calibration.coadd_images,
+                             {'file_list':['m'+prefix+x for x in coadd_files], 'out_image':out_image,
+                              'iraf_pool':iraf_pool, 'clean_up':False, 'backend':backend,
+                              **write_kwargs})
+    return pipeline
+
+def run_pipeline(qd, targets, dbFile, data_dir, raw_directory_list=None, nprocesses=1,
+                 dry_run=False, decompress=True, workspace_dir=None, **kwargs):
+    '''
+    Bring the reduction directory up to date: stage any new downloads, update the
+    observation database, and run the stale nodes of build_pipeline.
+
+    Input:
+        qd, targets, dbFile, data_dir:
+            see build_pipeline
+        raw_directory_list: list
+            download directories passed to GMOS_precalibration.stage_in. If None,
+            nothing is staged
+        nprocesses: int
+            number of nodes run at once and of IRAF worker processes (backend='iraf')
+        dry_run: bool
+            if True, only report which nodes would be run
+        decompress: bool
+            if False, staged .bz2 archives are kept compressed (backend='native' only)
+        workspace_dir: str
+            directory on a fast local volume (e.g. /dev/shm) in which each IRAF task runs
+            in a private directory, so that only its products are written to data_dir
+            (see GMOS_parallel.workspace)
+        kwargs:
+            other parameters of build_pipeline
+    Output:
+        report: dict
+            see Pipeline.run
+    '''
+    if raw_directory_list is not None:
+        GMOS_precalibration.stage_in(raw_directory_list, data_dir, decompress=decompress)
+    GMOS_precalibration.create_observation_database(None, data_dir, database_filename=dbFile)
+    iraf_pool = None
+    if nprocesses > 1 and kwargs.get('iraf_pool') is None and kwargs.get('backend', 'iraf') == 'iraf':
+        iraf_pool = GMOS_iraf_pool.IrafPool(nprocesses)
+        kwargs['iraf_pool'] = iraf_pool
+    try:
+        with GMOS_parallel.workspace(workspace_dir):
+            pipeline = build_pipeline(qd, targets, dbFile, data_dir, **kwargs)
+            report = pipeline.run(nthreads=nprocesses, dry_run=dry_run)
+            if any(name.startswith('coadd_') for name in report['run']) and not dry_run and \
+               kwargs.get('backend', 'iraf') != 'native':
+                cur_dir = os.getcwd()
+                os.chdir(data_dir)
+                GMOS_imaging_calibration.clean_coadd_files(kwargs.get('iraf_pool'))
+                os.chdir(cur_dir)
+    finally:
+        if iraf_pool is not None:
+            iraf_pool.close()
+    print('PIPELINE {} nodes run, {} up to date'.format(len(report['run']), len(report['up_to_date'])))
+    return report
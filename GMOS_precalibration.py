@@ -4,38 +4,157 @@ import subprocess
 import glob
 import sys
 import stat
+import hashlib
+import bz2
+import json
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from astropy.io import ascii as asc
 
-def check_download(directory_list):
+import GMOS_obslog
+import GMOS_instrumentation
+
+def _md5_file(filename, buffer_size=2**22):
+    '''
+    Compute the md5 hash of a file in-process, reading it in large blocks
+
+    Input:
+        filename: str
+            name of the file to hash
+        buffer_size: int
+            number of bytes read per block
+    Output:
+        hexdigest of the md5 hash
+    '''
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as ofile:
+        for block in iter(lambda: ofile.read(buffer_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def _read_checksum_cache(cache_filename):
+    if os.path.exists(cache_filename):
+        with open(cache_filename, 'r') as ofile:
+            return json.load(ofile)
+    return {}
+
+def _write_checksum_cache(cache, cache_filename):
+    tmp_filename = cache_filename + '.tmp'
+    with open(tmp_filename, 'w') as ofile:
+        json.dump(cache, ofile, indent=1, sort_keys=True)
+    os.rename(tmp_filename, cache_filename)
+
+def _verify_one(args):
+    filename, expected_hash, buffer_size = args
+    file_hash = _md5_file(filename, buffer_size=buffer_size)
+    return filename, file_hash, file_hash == expected_hash
+
+@GMOS_instrumentation.instrument
+def verify_checksums(directory_list, nthreads=4, buffer_size=2**22, 
+                     cache_filename='md5sums_verified.json'):
     '''
-    Run md5sum on files and compare to gemini file to make sure nothing was corrupted in the
-    download. (Note macs natively come with md5 which, with the -r flag reproduced the 
-    md5sum hash)
+    Compare the md5 hash of each downloaded file to the hash in the Gemini md5sums.txt file.
+    Files are hashed in-process with hashlib on a pool of threads (hashlib releases the GIL
+    while hashing large buffers, so the threads run in parallel).
+    
+    Every verified hash is recorded in cache_filename in each directory together with the
+    size and modification time of the file. Files whose size and modification time have 
+    not changed since they were last verified are not read again.
+    
+    Input:
+        directory_list: list
+            list of directories to check. Each directory must have a md5sums.txt file
+            with 2 columns: the hash and the filename
+        nthreads: int
+            number of threads used to hash files
+        buffer_size: int
+            number of bytes read per block when hashing
+        cache_filename: str
+            name of the file (written in each directory) which records verified hashes.
+            If None, no cache is read or written
+    Output:
+        report: dict
+            dictionary with the keys:
+            'verified': list of files whose hash matched
+            'skipped': list of files which were previously verified and have not changed
+            'missing': list of files in md5sums.txt which are not in the directory
+            'mismatched': list of (filename, computed hash, expected hash) tuples
+    '''
+    report = {'verified':[], 'skipped':[], 'missing':[], 'mismatched':[]}
+    pool = ThreadPool(nthreads)
+    try:
+        for idir in directory_list:
+            tbdata = asc.read(os.path.join(idir, 'md5sums.txt'), names=['md5_hash', 'filename'],
+                             format='no_header')
+            if cache_filename is not None:
+                cache_path = os.path.join(idir, cache_filename)
+                cache = _read_checksum_cache(cache_path)
+            else:
+                cache = {}
+            jobs = []
+            stats = {}
+            for ihash, ifile in tbdata:
+                ihash, ifile = str(ihash), str(ifile)
+                filename = os.path.join(idir, ifile)
+                if not os.path.exists(filename):
+                    report['missing'].append(filename)
+                    continue
+                fstat = os.stat(filename)
+                stats[filename] = (ifile, fstat.st_size, fstat.st_mtime)
+                cached = cache.get(ifile)
+                if (cached is not None) and (cached['md5_hash'] == ihash) and \
+                   (cached['size'] == fstat.st_size) and (cached['mtime'] == fstat.st_mtime):
+                    report['skipped'].append(filename)
+                else:
+                    jobs.append((filename, ihash, buffer_size))
+            for filename, file_hash, match in pool.imap_unordered(_verify_one, jobs):
+                ifile, size, mtime = stats[filename]
+                if match:
+                    report['verified'].append(filename)
+                    cache[ifile] = {'md5_hash':file_hash, 'size':size, 'mtime':mtime}
+                else:
+                    expected_hash = [job[1] for job in jobs if job[0] == filename][0]
+                    report['mismatched'].append((filename, file_hash, expected_hash))
+                    cache.pop(ifile, None)
+            if cache_filename is not None:
+                _write_checksum_cache(cache, cache_path)
+    finally:
+        pool.close()
+        pool.join()
+    GMOS_instrumentation.add_fields(files=len(report['verified']) + len(report['mismatched']))
+    return report
+
+@GMOS_instrumentation.instrument
+def check_download(directory_list, nthreads=4):
+    '''
+    Run md5 on files and compare to gemini file to make sure nothing was corrupted in the
+    download. Hashes are computed in-process by verify_checksums, files which were already 
+    verified and have not changed are skipped.
     
     It is assumed that each directory has a md5sums.txt file with 2 columns. The first
     column is the hash and the second is the filename. Each file in the filename column
-    is run through md5sum and if the hash is different, then a message is printed to the 
+    is hashed and if the hash is different, then a message is printed to the 
     screen
     
     Input:
         directory_list: list
             list of directories to check. 
+        nthreads: int
+            number of threads used to hash files
     Output:
-        if all files are uncorrupted, None, otherwise a message is printed to the screen
+        report: dict
+            the report returned by verify_checksums. If any files are corrupted or missing
+            a message is printed to the screen
     '''
-    for idir in directory_list:
-        tbdata = asc.read(os.path.join(idir, 'md5sums.txt'), names=['md5_hash', 'filename'])
-
-        for ihash, ifile in tbdata:
-            if os.path.exists(os.path.join(idir, ifile)):
-                if sys.platform=='darwin':
-                    x = subprocess.check_output('md5 -r {}'.format(os.path.join(idir, ifile)), shell=True)
-                else:
-                    x = subprocess.check_output('md5sum {}'.format(os.path.join(idir, ifile)), shell=True)
-                if x.split()[0] != ihash:
-                    print(ifile, x.split()[0], ihash)
+    report = verify_checksums(directory_list, nthreads=nthreads)
+    for ifile, file_hash, expected_hash in report['mismatched']:
+        print(os.path.basename(ifile), file_hash, expected_hash)
+    for ifile in report['missing']:
+        print('MISSING {}'.format(ifile))
+    return report
 
                 
+@GMOS_instrumentation.instrument
 def unzip_files(directory_list):
     '''
     Unzip *.bz2 files in each directory in the directory_list
@@ -49,6 +168,7 @@ def unzip_files(directory_list):
     for idir in directory_list:
         subprocess.call('bunzip2 {}'.format(os.path.join(idir, '*.bz2')), shell=True)
     
+@GMOS_instrumentation.instrument
 def copy_to_reduction_dir(input_directory_list, output_directory):
     '''
     Copy all files to a new directory for calibration and reduction
@@ -67,25 +187,172 @@ def copy_to_reduction_dir(input_directory_list, output_directory):
         for ifile in flist:
             shutil.move(ifile, os.path.join(output_directory, os.path.basename(ifile)))
 
+
+def _read_expected_hashes(directory):
+    md5_filename = os.path.join(directory, 'md5sums.txt')
+    if not os.path.exists(md5_filename):
+        return {}
+    tbdata = asc.read(md5_filename, names=['md5_hash', 'filename'], format='no_header')
+    return dict((str(ifile), str(ihash)) for ihash, ifile in tbdata)
+
+def _stage_in_one(args):
+    '''
+    Move one file into the reduction directory, hashing the bytes as they are read. 
+    .bz2 archives are decompressed on the fly into the reduction directory so that
+    each archive is read exactly once. If the file can't be staged (e.g. a truncated
+    or corrupt archive), it is left in the download directory, nothing is written to
+    the reduction directory, and the error message is returned.
+    '''
+    filename, output_directory, expected_hash, buffer_size, decompress = args
+    md5 = hashlib.md5()
+    basename = os.path.basename(filename)
+    file_hash = None
+    if decompress and filename.endswith('.bz2'):
+        out_filename = os.path.join(output_directory, basename[:-len('.bz2')])
+        tmp_filename = out_filename + '.part'
+        try:
+            decompressor = bz2.BZ2Decompressor()
+            with open(filename, 'rb') as infile, open(tmp_filename, 'wb') as outfile:
+                for block in iter(lambda: infile.read(buffer_size), b''):
+                    md5.update(block)
+                    #bzip2 files can be made of several concatenated streams
+                    while block:
+                        if decompressor.eof:
+                            decompressor = bz2.BZ2Decompressor()
+                        outfile.write(decompressor.decompress(block))
+                        block = decompressor.unused_data if decompressor.eof else b''
+            file_hash = md5.hexdigest()
+            if (expected_hash is not None) and (file_hash != expected_hash):
+                os.remove(tmp_filename)
+            elif not decompressor.eof:
+                raise EOFError('{} is truncated'.format(filename))
+            else:
+                os.rename(tmp_filename, out_filename)
+                os.remove(filename)
+        except Exception as err:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            return filename, out_filename, file_hash, expected_hash, '{}: {}'.format(type(err).__name__, err)
+    else:
+        out_filename = os.path.join(output_directory, basename)
+        try:
+            file_hash = _md5_file(filename, buffer_size=buffer_size)
+            if (expected_hash is None) or (file_hash == expected_hash):
+                shutil.move(filename, out_filename)
+        except Exception as err:
+            return filename, out_filename, file_hash, expected_hash, '{}: {}'.format(type(err).__name__, err)
+    return filename, out_filename, file_hash, expected_hash, None
+
+@GMOS_instrumentation.instrument
+def stage_in(input_directory_list, output_directory, nprocesses=None, buffer_size=2**22,
+             decompress=True):
+    '''
+    Move all .fits and .bz2 files to the reduction directory in a single pass. This 
+    combines check_download, copy_to_reduction_dir, and unzip_files: each .bz2 archive
+    is streamed from the download directory, the md5 hash of the compressed bytes is 
+    computed while it is decompressed directly into the reduction directory. Files are 
+    distributed over a pool of worker processes.
+    
+    Files whose hash does not match md5sums.txt are left in the download directory and 
+    are not written to the reduction directory. Files which are not listed in md5sums.txt
+    (or directories without a md5sums.txt file) are staged without a check.
+    
+    Input:
+        input_directory_list: list
+            list of directories with files to stage. These can be .fits or .bz2
+        output_directory: str
+            name of directory where all files will be written to
+        nprocesses: int
+            number of worker processes. If None, the number of CPUs is used
+        buffer_size: int
+            number of bytes read per block
+        decompress: bool
+            if False, .bz2 archives are moved without being decompressed. The native
+            backend, the observation log, and the photometry read them directly
+    Output:
+        report: dict
+            dictionary with the keys:
+            'staged': list of files written to output_directory
+            'unchecked': list of staged files which had no hash in md5sums.txt
+            'missing': list of files in md5sums.txt which are not in the directory
+            'mismatched': list of (filename, computed hash, expected hash) tuples
+            'failed': list of (filename, error message) tuples of files which could
+            not be read or decompressed. They are left in the download directory
+    '''
+    report = {'staged':[], 'unchecked':[], 'missing':[], 'mismatched':[], 'failed':[]}
+    jobs = []
+    for idir in input_directory_list:
+        print('STAGING .fits and .bz2 files from {} to {}'.format(idir, output_directory))
+        expected_hashes = _read_expected_hashes(idir)
+        flist = glob.glob(os.path.join(idir, '*.fits')) + \
+                glob.glob(os.path.join(idir, '*.bz2'))
+        for ifile in flist:
+            jobs.append((ifile, output_directory, expected_hashes.pop(os.path.basename(ifile), None), buffer_size,
+                         decompress))
+        report['missing'].extend([os.path.join(idir, ifile) for ifile in expected_hashes])
+    #Largest files first so that one big archive does not finish last on its own
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+    GMOS_instrumentation.add_fields(files=len(jobs))
+    pool = Pool(nprocesses)
+    try:
+        for filename, out_filename, file_hash, expected_hash, err in pool.imap_unordered(_stage_in_one, jobs):
+            if err is not None:
+                report['failed'].append((filename, err))
+                print('ERROR staging {}: {}'.format(filename, err))
+            elif expected_hash is None:
+                report['unchecked'].append(out_filename)
+                report['staged'].append(out_filename)
+            elif file_hash == expected_hash:
+                report['staged'].append(out_filename)
+            else:
+                report['mismatched'].append((filename, file_hash, expected_hash))
+                print(os.path.basename(filename), file_hash, expected_hash)
+    finally:
+        pool.close()
+        pool.join()
+    return report
         
-def create_observation_database(code_directory, output_directory, database_filename='obsLog.sqlite3'):
+        
+@GMOS_instrumentation.instrument
+def create_observation_database(code_directory, output_directory, database_filename='obsLog.sqlite3',
+                                use_obslog_script=False, nprocesses=None):
     '''
     The calibration pipeline requires the creation of a database like file to 
     create lists of the files required for each calibration step. 
     
+    By default the database is built by GMOS_obslog.index_observations, which only reads
+    new or modified files (their headers and the per amplifier statistics used to reject
+    bad calibration frames) and updates an existing database in place. 
+    Set use_obslog_script=True to instead rebuild it from scratch with the Gemini 
+    script obslog.py.
+    
     Input:
-        input_directory_list: list
-            list of directories with files to copy. These can be .fits or .bz2
+        code_directory: str
+            directory with obslog.py (only used if use_obslog_script is True)
         output_directory: str
-            name of directory where all files will be copied to
+            reduction directory with the raw files, where the database is written
+        database_filename: str
+            name of the sqlite3 database
+        use_obslog_script: bool
+            if True, run obslog.py in a subprocess
+        nprocesses: int
+            number of processes used to read the headers. If None, the number of 
+            CPUs is used
     Output:
         database file: a sqlite3 database with the name given in database_filename
     '''
+    if use_obslog_script is False:
+        summary = GMOS_obslog.index_observations(output_directory, database_filename, 
+                                                 nprocesses=nprocesses)
+        GMOS_instrumentation.add_fields(files=summary['indexed'])
+        for ifile, err in summary['failed']:
+            print('ERROR reading header of {}: {}'.format(ifile, err))
+        print('UPDATED {} observation database: {} files indexed, {} unchanged, {} removed'.format(
+              database_filename, summary['indexed'], summary['unchanged'], summary['removed']))
+        return
     cur_dir = os.getcwd()
     shutil.copyfile(os.path.join(code_directory, 'obslog.py'), os.path.join(output_directory, 'obslog.py'))
     os.chdir(output_directory)
-    cmd = '{} {}'.format(os.path.join(code_directory, 'obslog.py'),
-                         os.path.join(output_directory, database_filename))
     os.chmod('obslog.py', stat.S_IXUSR|stat.S_IXGRP|stat.S_IXOTH|stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH|stat.S_IWUSR|stat.S_IWGRP|stat.S_IWOTH)
     subprocess.call('ls -l obslog.py', shell=True)
     command_run = subprocess.call('./obslog.py {}'.format(database_filename), shell=True)
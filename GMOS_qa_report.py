@@ -0,0 +1,272 @@
+'''
+Night-level quality assessment report.
+
+Every file of the obslog is looked up in the reduction directory at each stage of the
+reduction (raw, rg* from gireduce, and mrg* from gmosaic). Each frame is read in a single
+pass over its extensions, which computes the per amplifier statistics (median, clipped
+standard deviation, overscan level, and fraction of pixels flagged in the DQ plane) and
+the block-averaged thumbnails drawn by GMOS_visualization. Frames are processed on a pool
+of worker processes and the results are stored in a sqlite3 database, so re-running the
+report only processes the frames which are new or changed. The report is a single HTML
+page with a thumbnail (PNG) and a table of statistics for every frame.
+'''
+import os
+import html
+import sqlite3
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+from astropy.io import fits
+from matplotlib.figure import Figure
+
+import GMOS_compressed_io
+import GMOS_native_reduction
+import GMOS_visualization
+
+#Reduction stages included in the report and the prefix of their files
+QA_STAGES = [('raw', ''), ('rg', 'rg'), ('mrg', 'mrg')]
+
+#Number of pixels per amplifier sampled for the statistics
+QA_STAT_SAMPLES = 250000
+
+def _section_fits(section, shape):
+    return (section[0].stop <= shape[0]) and (section[1].stop <= shape[1])
+
+def frame_statistics(filename, thumbnail_filename=None, max_samples=QA_STAT_SAMPLES,
+                     thumb_size=GMOS_visualization.QA_THUMB_SIZE):
+    '''
+    Compute the statistics of each amplifier (or of the mosaic) of a raw or reduced
+    frame in a single pass over its extensions
+
+    Input:
+        filename: str
+            name of the frame
+        thumbnail_filename: str
+            if given, a PNG of the block-averaged amplifiers is written to this file
+        max_samples: int
+            the median and clipped standard deviation of each amplifier are computed
+            from a strided sample of about max_samples pixels
+        thumb_size: int
+            largest dimension of the block-averaged amplifier images
+    Output:
+        amps: list
+            a dictionary for each SCI extension with the extension version 'amp',
+            'median', 'clipped_std', 'overscan' (median of the overscan region of
+            raw data, or the OVERSCAN keyword written by gireduce), and 'dq_fraction'
+            (fraction of pixels with a non-zero DQ value). Values which can't be
+            measured are NaN
+    '''
+    amps = OrderedDict()
+    thumbnails = []
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as ofile:
+        object_name = ofile[0].header.get('OBJECT', '')
+        for iext, hdu in enumerate(ofile[1:], 1):
+            header = hdu.header
+            if header.get('NAXIS', 0) != 2:
+                continue
+            extname = header.get('EXTNAME', 'SCI')
+            extver = header.get('EXTVER', iext)
+            if extname == 'SCI':
+                img = hdu.data
+                overscan = header.get('OVERSCAN', np.nan)
+                if ('BIASSEC' in header) and ('DATASEC' in header):
+                    biassec = GMOS_native_reduction.parse_section(header['BIASSEC'])
+                    datasec = GMOS_native_reduction.parse_section(header['DATASEC'])
+                    if _section_fits(biassec, img.shape) and _section_fits(datasec, img.shape):
+                        overscan = np.median(GMOS_native_reduction.scale_array(img[biassec], header))
+                        img = img[datasec]
+                stride = max(1, int(np.ceil(np.sqrt(img.size/float(max_samples)))))
+                sample = GMOS_native_reduction.scale_array(img[::stride, ::stride], header)
+                mean, clipped_median, std = GMOS_native_reduction.clipped_stats(sample)
+                amps[extver] = {'amp':extver, 'median':float(np.median(sample)),
+                                'clipped_std':float(std), 'overscan':float(overscan),
+                                'dq_fraction':np.nan}
+                if thumbnail_filename is not None:
+                    thumbnails.append(GMOS_visualization.amp_thumbnail(img, header, thumb_size=thumb_size))
+            elif (extname == 'DQ') and (extver in amps):
+                dq = GMOS_native_reduction.scale_array(hdu.data, header, np.uint16)
+                amps[extver]['dq_fraction'] = np.count_nonzero(dq)/float(dq.size)
+    if thumbnail_filename is not None:
+        fig = Figure(figsize=[max(3, 0.8*len(thumbnails)), 4], dpi=72)
+        ax_list = np.atleast_1d(fig.subplots(nrows=1, ncols=len(thumbnails), sharey=True))
+        fig.suptitle('{} {}'.format(os.path.basename(filename), object_name))
+        GMOS_visualization.draw_thumbnails(ax_list, thumbnails, 'EXT')
+        fig.subplots_adjust(wspace=0)
+        GMOS_visualization.save_figure(fig, thumbnail_filename)
+    return list(amps.values())
+
+def _frame_job(job):
+    frame, filename, thumbnail_filename = job
+    try:
+        return filename, frame_statistics(filename, thumbnail_filename), None
+    except Exception as err:
+        return filename, None, str(err)
+
+def _create_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS qa_frames
+                    (Frame TEXT PRIMARY KEY, File TEXT, Stage TEXT, Size INTEGER, MTime REAL,
+                     Thumbnail TEXT)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS qa_amps
+                    (Frame TEXT, Amp INTEGER, Median REAL, ClippedStd REAL, Overscan REAL,
+                     DQFraction REAL, PRIMARY KEY (Frame, Amp))''')
+
+def _obslog_rows(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.row_factory = sqlite3.Row
+        return conn.execute('''SELECT use_me, File, ObsType, ObsClass, Object, Filter2, DateObs, TimeObs, Texp
+                               FROM obslog ORDER BY DateObs, TimeObs, File''').fetchall()
+    finally:
+        conn.close()
+
+def update_qa(data_dir, db_file='obsLog.sqlite3', qa_database='qaReport.sqlite3',
+              thumb_dir='qa_thumbnails', nprocesses=None):
+    '''
+    Measure the frames of every obslog file (at each of the QA_STAGES) which are new
+    or whose size or modification time changed since the last run. Frames which no
+    longer exist are removed from the QA database.
+
+    Input:
+        data_dir: str
+            reduction directory
+        db_file: str
+            observation database (relative to data_dir)
+        qa_database: str
+            sqlite3 database the statistics are stored in (relative to data_dir)
+        thumb_dir: str
+            directory (relative to data_dir) the thumbnails are written to
+        nprocesses: int
+            number of worker processes. If None, the number of CPUs is used
+    Output:
+        summary: dict
+            number of frames 'processed' and 'unchanged', and 'failed', a list of
+            (filename, error message) tuples
+    '''
+    data_dir = os.path.abspath(data_dir)
+    if not os.path.exists(os.path.join(data_dir, thumb_dir)):
+        os.makedirs(os.path.join(data_dir, thumb_dir))
+    summary = {'processed':0, 'unchanged':0, 'failed':[]}
+    conn = sqlite3.connect(os.path.join(data_dir, qa_database))
+    try:
+        _create_tables(conn)
+        measured = dict((row[0], (row[1], row[2])) for row in
+                        conn.execute('SELECT Frame, Size, MTime FROM qa_frames'))
+        current = {}
+        jobs = []
+        for row in _obslog_rows(os.path.join(data_dir, db_file)):
+            for stage, prefix in QA_STAGES:
+                frame = '{}{}.fits'.format(prefix, row['File'])
+                filename = GMOS_compressed_io.resolve_fits(os.path.join(data_dir, frame))
+                if not os.path.exists(filename):
+                    continue
+                fstat = os.stat(filename)
+                current[frame] = (row['File'], stage, fstat.st_size, fstat.st_mtime)
+                if measured.get(frame) == (fstat.st_size, fstat.st_mtime):
+                    summary['unchanged'] += 1
+                else:
+                    jobs.append((frame, filename, os.path.join(data_dir, thumb_dir, frame.replace('.fits', '.png'))))
+        removed = [frame for frame in measured if frame not in current]
+
+        results = []
+        if len(jobs) > 0:
+            pool = Pool(nprocesses)
+            try:
+                results = pool.map(_frame_job, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        with conn:
+            for frame in removed:
+                conn.execute('DELETE FROM qa_frames WHERE Frame=?', (frame,))
+                conn.execute('DELETE FROM qa_amps WHERE Frame=?', (frame,))
+            #frame is the .fits name of the obslog, also for compressed (e.g. .fits.bz2) files
+            for (frame, filename, thumbnail_filename), (measured_filename, amps, err) in zip(jobs, results):
+                if err is not None:
+                    summary['failed'].append((filename, err))
+                    continue
+                conn.execute('DELETE FROM qa_amps WHERE Frame=?', (frame,))
+                conn.execute('INSERT OR REPLACE INTO qa_frames VALUES (?, ?, ?, ?, ?, ?)',
+                             (frame,) + current[frame] + (os.path.relpath(thumbnail_filename, data_dir),))
+                conn.executemany('INSERT INTO qa_amps VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(frame, amp['amp'], amp['median'], amp['clipped_std'], amp['overscan'],
+                                   amp['dq_fraction']) for amp in amps])
+                summary['processed'] += 1
+    finally:
+        conn.close()
+    return summary
+
+def _format(value, fmt='{:.2f}'):
+    if (value is None) or np.isnan(value):
+        return '-'
+    return fmt.format(value)
+
+def _stage_cell(frame_row, amp_rows):
+    lines = ['<td><a href="{0}"><img src="{0}" height="160"></a>'.format(html.escape(frame_row['Thumbnail'])),
+             '<table class="amps"><tr><th>Amp</th><th>Median</th><th>Std</th><th>Overscan</th><th>DQ %</th></tr>']
+    for amp in amp_rows:
+        lines.append('<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>'.format(
+                     amp['Amp'], _format(amp['Median']), _format(amp['ClippedStd']), _format(amp['Overscan']),
+                     _format(None if amp['DQFraction'] is None else 100*amp['DQFraction'])))
+    lines.append('</table></td>')
+    return '\n'.join(lines)
+
+def write_report(data_dir, db_file='obsLog.sqlite3', qa_database='qaReport.sqlite3',
+                 out_filename='qa_report.html'):
+    '''
+    Write the HTML report of the frames in the QA database (see update_qa) to
+    out_filename (relative to data_dir). One row is written for each file of the obslog,
+    with a column for each of the QA_STAGES.
+    '''
+    data_dir = os.path.abspath(data_dir)
+    conn = sqlite3.connect(os.path.join(data_dir, qa_database))
+    try:
+        conn.row_factory = sqlite3.Row
+        _create_tables(conn)
+        frames = dict(((row['File'], row['Stage']), row) for row in conn.execute('SELECT * FROM qa_frames'))
+        amps = {}
+        for row in conn.execute('SELECT * FROM qa_amps ORDER BY Frame, Amp'):
+            amps.setdefault(row['Frame'], []).append(row)
+    finally:
+        conn.close()
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>GMOS QA report</title>',
+             '<style>table {border-collapse: collapse;} td, th {border: 1px solid #ccc; padding: 2px 4px;',
+             'vertical-align: top; font-size: small;} table.amps td {text-align: right;}</style></head><body>',
+             '<h1>GMOS QA report: {}</h1>'.format(html.escape(data_dir)), '<table>',
+             '<tr><th>File</th><th>Type</th><th>Object</th><th>Filter</th><th>Date</th><th>Texp</th>' +
+             ''.join('<th>{}</th>'.format(stage) for stage, prefix in QA_STAGES) + '</tr>']
+    for row in _obslog_rows(os.path.join(data_dir, db_file)):
+        lines.append('<tr><td>{}{}</td><td>{}/{}</td><td>{}</td><td>{}</td><td>{} {}</td><td>{}</td>'.format(
+                     html.escape(row['File']), '' if row['use_me'] else ' (use_me=0)',
+                     html.escape(str(row['ObsType'])), html.escape(str(row['ObsClass'])),
+                     html.escape(str(row['Object'])), html.escape(str(row['Filter2'])),
+                     row['DateObs'], row['TimeObs'], _format(row['Texp'], '{:g}')))
+        for stage, prefix in QA_STAGES:
+            frame_row = frames.get((row['File'], stage))
+            if frame_row is None:
+                lines.append('<td></td>')
+            else:
+                lines.append(_stage_cell(frame_row, amps.get(frame_row['Frame'], [])))
+        lines.append('</tr>')
+    lines.extend(['</table>', '</body></html>'])
+    out_filename = os.path.join(data_dir, out_filename)
+    with open(out_filename, 'w') as ofile:
+        ofile.write('\n'.join(lines))
+    return out_filename
+
+def qa_report(data_dir, db_file='obsLog.sqlite3', qa_database='qaReport.sqlite3',
+              thumb_dir='qa_thumbnails', out_filename='qa_report.html', nprocesses=None):
+    '''
+    Update the QA database with the new or changed frames of the reduction directory
+    and write the HTML report. See update_qa and write_report.
+
+    Output:
+        out_filename: str
+            path of the report
+        summary: dict
+            summary of update_qa
+    '''
+    summary = update_qa(data_dir, db_file, qa_database, thumb_dir, nprocesses)
+    for filename, err in summary['failed']:
+        print('WARNING: could not measure {}: {}'.format(filename, err))
+    return write_report(data_dir, db_file, qa_database, out_filename), summary
@@ -0,0 +1,409 @@
+'''
+Synthetic GMOS imaging data for tests and benchmarks.
+
+Writes raw 12 amplifier (Hamamatsu) GMOS-N and GMOS-S frames with the layout of the
+Gemini archive files: a primary header with the keywords read by the observation log,
+followed by one uint16 (BZERO=32768) extension per amplifier with its overscan region
+(overscan_size columns at 2x2 binning, to the right of the data of odd amplifiers and
+to the left of even amplifiers, as assumed by GMOS_visualization), an unusable strip of
+unusable_bottom rows at the bottom, and a WCS. Bias frames have a fixed pattern and read
+noise, twilight flats and science frames are multiplied by a flat field response, and
+science frames have a sky background and stars (Gaussian PSF) from a catalog which is
+written next to the frames. Mosaicked frames (the gmosaic layout: single SCI, VAR, and
+DQ extensions) can be written directly for the co-add and photometry stages.
+
+make_night writes a whole night (biases, flats, dithered science frames) and indexes it
+in an obslog database. write_download compresses frames into a download directory with
+a md5sums.txt file, as they are retrieved from the Gemini archive.
+'''
+import os
+import bz2
+import hashlib
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.time import Time
+from astropy import table
+
+import GMOS_obslog
+import GMOS_native_reduction
+from GMOS_visualization import overscan_size, unusable_bottom
+
+NAMPS = 12
+AMPS_PER_CCD = 4
+#Unbinned size of the data section of an amplifier, and of the gaps between CCDs
+AMP_COLUMNS = 512
+AMP_ROWS = 4224
+CHIP_GAP = 60
+#Unbinned pixel scale in arcsec
+PIXEL_SCALE = {'GMOS-N':0.0807, 'GMOS-S':0.080}
+FILTER_NAMES = {'GMOS-N':{'g':'g_G0301', 'r':'r_G0303', 'i':'i_G0302', 'z':'z_G0304'},
+                'GMOS-S':{'g':'g_G0325', 'r':'r_G0326', 'i':'i_G0327', 'z':'z_G0328'}}
+#Magnitude of a source giving 1 ADU/s
+ZEROPOINT = 28.0
+
+def amp_layout(binning=2):
+    '''
+    Geometry of the raw amplifiers
+
+    Input:
+        binning: int
+            binning in both axes (1, 2, or 4)
+    Output:
+        layout: dict
+            'rows', 'data_columns', 'overscan_columns', 'unusable_rows', 'gap' (between
+            CCDs, in binned pixels), 'mosaic_shape', and 'amps': a list with a dictionary
+            for each amplifier with its 'biassec' and 'datasec' (IRAF sections), 'x0'
+            (first column of its data in the mosaic) and 'data_start' (first data column
+            in the raw amplifier)
+    '''
+    #overscan_size and unusable_bottom are given for 2x2 binning
+    data_columns = AMP_COLUMNS//binning
+    overscan_columns = overscan_size*2//binning
+    rows = AMP_ROWS//binning
+    gap = CHIP_GAP//binning
+    amps = []
+    for iamp in range(NAMPS):
+        if iamp%2 == 0: #EXTVER odd: overscan to the right
+            biassec = '[{}:{},1:{}]'.format(data_columns+1, data_columns+overscan_columns, rows)
+            datasec = '[1:{},1:{}]'.format(data_columns, rows)
+            data_start = 0
+        else:
+            biassec = '[1:{},1:{}]'.format(overscan_columns, rows)
+            datasec = '[{}:{},1:{}]'.format(overscan_columns+1, overscan_columns+data_columns, rows)
+            data_start = overscan_columns
+        amps.append({'biassec':biassec, 'datasec':datasec, 'data_start':data_start,
+                     'x0':iamp*data_columns + (iamp//AMPS_PER_CCD)*gap})
+    return {'rows':rows, 'data_columns':data_columns, 'overscan_columns':overscan_columns,
+            'unusable_rows':unusable_bottom*2//binning, 'gap':gap,
+            'mosaic_shape':(rows, NAMPS*data_columns + (NAMPS//AMPS_PER_CCD - 1)*gap), 'amps':amps}
+
+def mosaic_wcs(ra, dec, binning=2, instrument='GMOS-S'):
+    '''
+    WCS of the mosaic of the three CCDs, centered on ra, dec with north up and east left
+    '''
+    nrows, ncolumns = amp_layout(binning)['mosaic_shape']
+    scale = PIXEL_SCALE[instrument]*binning/3600.
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [(ncolumns+1)/2., (nrows+1)/2.]
+    wcs.wcs.cd = [[-scale, 0], [0, scale]]
+    return wcs
+
+def star_field(ra, dec, nstars=100, radius=0.04, mag_range=(16., 23.), seed=0):
+    '''
+    Catalog of stars distributed uniformly within radius degrees of ra, dec with
+    magnitudes uniform in mag_range
+
+    Output:
+        stars: astropy.table.Table
+            columns ra, dec, mag
+    '''
+    rng = np.random.default_rng(seed)
+    dra = rng.uniform(-radius, radius, nstars)
+    ddec = rng.uniform(-radius, radius, nstars)
+    return table.Table([ra + dra/np.cos(np.radians(dec)), dec + ddec, rng.uniform(*mag_range, size=nstars)],
+                       names=['ra', 'dec', 'mag'])
+
+def render_stars(shape, wcs, stars, exptime, fwhm=0.8, pixel_scale=0.16):
+    '''
+    Image (in ADU) of the stars of a catalog with a Gaussian PSF of fwhm arcsec
+
+    Input:
+        shape: tuple
+            shape of the image
+        wcs: astropy.wcs.WCS
+            WCS of the image
+        stars: astropy.table.Table
+            catalog with ra, dec, mag columns (see star_field)
+        exptime: float
+            exposure time in seconds
+        fwhm, pixel_scale: float
+            PSF FWHM and pixel scale in arcsec
+    '''
+    image = np.zeros(shape, dtype=np.float32)
+    sigma = fwhm/pixel_scale/2.3548
+    size = int(np.ceil(5*sigma))
+    x, y = wcs.all_world2pix(stars['ra'], stars['dec'], 0)
+    fluxes = exptime*10**(-0.4*(np.asarray(stars['mag']) - ZEROPOINT))
+    for xcen, ycen, flux in zip(x, y, fluxes):
+        xlow, xhigh = max(int(xcen) - size, 0), min(int(xcen) + size + 1, shape[1])
+        ylow, yhigh = max(int(ycen) - size, 0), min(int(ycen) + size + 1, shape[0])
+        if (xlow >= xhigh) or (ylow >= yhigh):
+            continue
+        yy, xx = np.mgrid[ylow:yhigh, xlow:xhigh]
+        image[ylow:yhigh, xlow:xhigh] += flux/(2*np.pi*sigma**2) * \
+            np.exp(-((xx-xcen)**2 + (yy-ycen)**2)/(2*sigma**2))
+    return image
+
+def flat_response(binning=2, seed=0):
+    '''
+    Flat field response of the mosaic: amplifier to amplifier gain differences and
+    vignetting towards the edges of the field
+    '''
+    layout = amp_layout(binning)
+    rng = np.random.default_rng(seed)
+    nrows, ncolumns = layout['mosaic_shape']
+    yy, xx = np.ogrid[0:nrows, 0:ncolumns]
+    r2 = ((xx - ncolumns/2.)/ncolumns)**2 + ((yy - nrows/2.)/ncolumns)**2
+    response = (1 - 0.3*r2).astype(np.float32)
+    for amp in layout['amps']:
+        response[:, amp['x0']:amp['x0']+layout['data_columns']] *= rng.uniform(0.95, 1.05)
+    return response
+
+def _amp_properties(seed):
+    rng = np.random.default_rng(seed)
+    return {'gain':rng.uniform(1.6, 2.0, NAMPS), 'rdnoise':rng.uniform(3.5, 4.5, NAMPS),
+            'bias_level':rng.uniform(800., 1200., NAMPS)}
+
+def primary_header(instrument, obstype, obsclass, object_name, date_obs, time_obs, exptime,
+                   ra, dec, filter_name=None, airmass=1.1):
+    '''
+    Primary header of a raw frame with the keywords used by the observation log
+    '''
+    header = fits.Header()
+    header['INSTRUME'] = instrument
+    header['OBSID'] = '{}-2018B-Q-1-1'.format('GS' if instrument == 'GMOS-S' else 'GN')
+    header['OBJECT'] = object_name
+    header['OBSTYPE'] = obstype
+    header['OBSCLASS'] = obsclass
+    header['DATE-OBS'] = date_obs
+    header['TIME-OBS'] = time_obs
+    header['MJD-OBS'] = Time('{}T{}'.format(date_obs, time_obs)).mjd
+    header['EXPTIME'] = float(exptime)
+    header['AIRMASS'] = airmass
+    header['RA'] = ra
+    header['DEC'] = dec
+    header['FILTER1'] = 'open1-6'
+    header['FILTER2'] = 'open2-8' if filter_name is None else FILTER_NAMES[instrument][filter_name]
+    header['GRATING'] = 'MIRROR'
+    header['MASKNAME'] = 'None'
+    header['CENTWAVE'] = 0.
+    header['DETECTOR'] = 'GMOS + Hamamatsu'
+    header['DETNROI'] = 1
+    header['DETRO1X'] = 1
+    header['DETRO1XS'] = NAMPS//AMPS_PER_CCD*AMP_COLUMNS*AMPS_PER_CCD
+    header['DETRO1Y'] = 1
+    header['DETRO1YS'] = AMP_ROWS
+    header['NEXTEND'] = NAMPS
+    return header
+
+def write_raw_frame(filename, header, signal=None, binning=2, seed=0, amp_seed=0):
+    '''
+    Write a raw frame
+
+    Input:
+        filename: str
+            name of the output file
+        header: astropy.io.fits.Header
+            primary header (see primary_header). Its RA and DEC set the WCS
+        signal: array
+            image (in ADU, in the mosaic geometry of amp_layout) added to the bias. If
+            None, a bias frame is written
+        binning: int
+            binning in both axes
+        seed: int
+            seed of the noise
+        amp_seed: int
+            seed of the gain, read noise, and bias level of the amplifiers (the same for
+            all frames of a night)
+    '''
+    layout = amp_layout(binning)
+    props = _amp_properties(amp_seed)
+    rng = np.random.default_rng(seed)
+    wcs = mosaic_wcs(header['RA'], header['DEC'], binning, header['INSTRUME'])
+    nrows = layout['rows']
+    ncolumns = layout['data_columns'] + layout['overscan_columns']
+    #fixed pattern of the bias: a gradient along the rows, the same in every frame
+    pattern = np.linspace(0, 5, nrows, dtype=np.float32)[:, None]
+    hdulist = [fits.PrimaryHDU(header=header)]
+    for iamp, amp in enumerate(layout['amps']):
+        gain, rdnoise = props['gain'][iamp], props['rdnoise'][iamp]
+        raw = np.full((nrows, ncolumns), props['bias_level'][iamp], dtype=np.float32)
+        data_columns = slice(amp['data_start'], amp['data_start'] + layout['data_columns'])
+        raw[:, data_columns] += pattern
+        variance = np.full(raw.shape, (rdnoise/gain)**2, dtype=np.float32)
+        if signal is not None:
+            amp_signal = np.array(signal[:, amp['x0']:amp['x0']+layout['data_columns']], dtype=np.float32)
+            amp_signal[:layout['unusable_rows']] = 0
+            amp_signal = np.clip(amp_signal, 0, None)
+            raw[:, data_columns] += amp_signal
+            variance[:, data_columns] += amp_signal/gain
+        raw += rng.standard_normal(raw.shape, dtype=np.float32)*np.sqrt(variance)
+        ext_header = fits.Header()
+        ext_header['EXTNAME'] = 'SCI'
+        ext_header['EXTVER'] = iamp + 1
+        ext_header['CCDSUM'] = '{0} {0}'.format(binning)
+        ext_header['BIASSEC'] = amp['biassec']
+        ext_header['DATASEC'] = amp['datasec']
+        ext_header['CCDNAME'] = 'CCD{}'.format(iamp//AMPS_PER_CCD + 1)
+        ext_header['AMPNAME'] = 'AMP{}'.format(iamp + 1)
+        ext_header['GAIN'] = gain
+        ext_header['RDNOISE'] = rdnoise
+        ext_header['SATLEVEL'] = 65535.
+        amp_wcs = wcs.deepcopy()
+        amp_wcs.wcs.crpix = [wcs.wcs.crpix[0] - amp['x0'] + amp['data_start'], wcs.wcs.crpix[1]]
+        ext_header.update(amp_wcs.to_header())
+        hdulist.append(fits.ImageHDU(np.clip(np.round(raw), 0, 65535).astype(np.uint16), header=ext_header))
+    fits.HDUList(hdulist).writeto(filename, overwrite=True)
+
+def write_mosaic_frame(filename, header, signal, sky, binning=2, seed=0, gain=1.8, rdnoise=4.):
+    '''
+    Write a bias subtracted, flat fielded, mosaicked frame (the layout of the gmosaic
+    output, with SCI, VAR, and DQ extensions). The gaps between the CCDs are flagged in
+    the DQ plane.
+
+    Input:
+        filename: str
+            name of the output file
+        header: astropy.io.fits.Header
+            primary header (see primary_header)
+        signal: array
+            image of the stars in ADU (in the mosaic geometry of amp_layout)
+        sky: float
+            sky level in ADU
+    '''
+    layout = amp_layout(binning)
+    rng = np.random.default_rng(seed)
+    var = (np.clip(signal + sky, 0, None)/gain + (rdnoise/gain)**2).astype(np.float32)
+    sci = (signal + sky + rng.standard_normal(signal.shape, dtype=np.float32)*np.sqrt(var)).astype(np.float32)
+    dq = np.full(signal.shape, GMOS_native_reduction.DQ_NODATA, dtype=np.uint16)
+    for amp in layout['amps']:
+        dq[:, amp['x0']:amp['x0']+layout['data_columns']] = 0
+    sci[dq > 0] = 0
+    ext_header = mosaic_wcs(header['RA'], header['DEC'], binning, header['INSTRUME']).to_header()
+    ext_header['CCDSUM'] = '{0} {0}'.format(binning)
+    hdulist = [fits.PrimaryHDU(header=header)]
+    for extname, plane in [('SCI', sci), ('VAR', var), ('DQ', dq)]:
+        hdu = fits.ImageHDU(plane, header=ext_header.copy())
+        hdu.header['EXTNAME'] = extname
+        hdu.header['EXTVER'] = 1
+        hdulist.append(hdu)
+    fits.HDUList(hdulist).writeto(filename, overwrite=True)
+
+def frame_name(instrument, date_obs, number):
+    site = 'S' if instrument == 'GMOS-S' else 'N'
+    return '{}{}S{:04d}.fits'.format(site, date_obs.replace('-', ''), number)
+
+def make_night(directory, instrument='GMOS-S', date_obs='2018-09-02', nbias=7, nflat=7, nscience=4,
+               filters=('r',), binning=2, target='SYNTH-1', ra=150.0, dec=-30.0, exptime=60.,
+               nstars=100, sky=200., flat_level=20000., dither=5., mosaics=False, index=True,
+               nprocesses=None, seed=0):
+    '''
+    Write the raw frames of a synthetic night into directory
+
+    Input:
+        directory: str
+            output directory (created if it doesn't exist)
+        instrument: str
+            'GMOS-N' or 'GMOS-S'
+        date_obs: str
+            date of the night (YYYY-MM-DD)
+        nbias, nflat, nscience: int
+            number of bias frames, and of twilight flats and science frames in each filter
+        filters: list
+            filters (g, r, i, z)
+        binning: int
+            binning in both axes (1, 2, or 4)
+        target, ra, dec:
+            name and position of the science target
+        exptime: float
+            exposure time of the science frames
+        nstars: int
+            number of stars in the field
+        sky, flat_level: float
+            sky level of the science frames and level of the first twilight flat (ADU).
+            Each following flat is 10% fainter
+        dither: float
+            offset (arcsec) between consecutive science frames
+        mosaics: bool
+            if True, also write mosaicked science frames (named mrg + raw name)
+        index: bool
+            if True, index the frames in the obslog database obsLog.sqlite3 in directory
+        nprocesses: int
+            number of processes used to index the frames
+        seed: int
+            seed of the random numbers
+    Output:
+        night: dict
+            'bias', 'flat', 'science', and 'mosaic' lists of file names (flats and science
+            frames of all filters), 'catalog': the name of the star catalog (stars.ecsv,
+            with ra, dec, and mag columns)
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    night = {'bias':[], 'flat':[], 'science':[], 'mosaic':[]}
+    stars = star_field(ra, dec, nstars=nstars, seed=seed)
+    night['catalog'] = os.path.join(directory, 'stars.ecsv')
+    stars.write(night['catalog'], overwrite=True)
+    response = flat_response(binning, seed=seed)
+    shape = response.shape
+    number = 1
+    for ibias in range(nbias):
+        filename = os.path.join(directory, frame_name(instrument, date_obs, number))
+        header = primary_header(instrument, 'BIAS', 'dayCal', 'Bias', date_obs,
+                                '{:02d}:00:00.0'.format(ibias % 24), 0., ra, dec)
+        write_raw_frame(filename, header, binning=binning, seed=seed + number, amp_seed=seed)
+        night['bias'].append(filename)
+        number += 1
+    for filter_name in filters:
+        for iflat in range(nflat):
+            filename = os.path.join(directory, frame_name(instrument, date_obs, number))
+            header = primary_header(instrument, 'OBJECT', 'dayCal', 'Twilight', date_obs,
+                                    '23:{:02d}:00.0'.format(iflat % 60), 5., ra, dec, filter_name)
+            write_raw_frame(filename, header, flat_level*0.9**iflat*response, binning=binning,
+                            seed=seed + number, amp_seed=seed)
+            night['flat'].append(filename)
+            number += 1
+        for iscience in range(nscience):
+            filename = os.path.join(directory, frame_name(instrument, date_obs, number))
+            offset = dither*(iscience - (nscience - 1)/2.)/3600.
+            frame_ra = ra + offset/np.cos(np.radians(dec))
+            frame_dec = dec + offset
+            header = primary_header(instrument, 'OBJECT', 'science', target, date_obs,
+                                    '04:{:02d}:00.0'.format(iscience % 60), exptime, frame_ra, frame_dec,
+                                    filter_name)
+            wcs = mosaic_wcs(frame_ra, frame_dec, binning, instrument)
+            signal = render_stars(shape, wcs, stars, exptime, pixel_scale=PIXEL_SCALE[instrument]*binning)
+            write_raw_frame(filename, header, (signal + sky)*response, binning=binning,
+                            seed=seed + number, amp_seed=seed)
+            night['science'].append(filename)
+            if mosaics:
+                mosaic_filename = os.path.join(directory, 'mrg' + os.path.basename(filename))
+                write_mosaic_frame(mosaic_filename, header, signal, sky, binning=binning, seed=seed + number)
+                night['mosaic'].append(mosaic_filename)
+            number += 1
+    if index:
+        GMOS_obslog.index_observations(directory, nprocesses=nprocesses)
+    return night
+
+def write_download(file_list, download_dir, compress=True):
+    '''
+    Copy frames into a download directory (as .bz2 archives if compress is True) and
+    write the md5sums.txt file of the copies, as retrieved from the Gemini archive
+
+    Output:
+        download_list: list
+            names of the files in download_dir
+    '''
+    if not os.path.exists(download_dir):
+        os.makedirs(download_dir)
+    download_list = []
+    lines = []
+    for filename in file_list:
+        with open(filename, 'rb') as ofile:
+            content = ofile.read()
+        basename = os.path.basename(filename)
+        if compress:
+            content = bz2.compress(content, compresslevel=1)
+            basename += '.bz2'
+        out_filename = os.path.join(download_dir, basename)
+        with open(out_filename, 'wb') as ofile:
+            ofile.write(content)
+        lines.append('{}  {}'.format(hashlib.md5(content).hexdigest(), basename))
+        download_list.append(out_filename)
+    with open(os.path.join(download_dir, 'md5sums.txt'), 'w') as ofile:
+        ofile.write('\n'.join(lines) + '\n')
+    return download_list
@@ -1,14 +1,29 @@
 '''
 Visualize steps of the calibration process to ensure everything went according to plan
 '''
+import os
+import json
+from multiprocessing import Pool
+
+import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from astropy.io import fits
 
 from visualization import zscale #https://github.com/abostroem/utilities
+import GMOS_native_reduction
+import GMOS_instrumentation
 
 overscan_size = 32 #pixels
 unusable_bottom = 48//2 #pixels
 
+#Fast QA rendering: number of pixels sampled per amplifier for the zscale limits and
+#the largest dimension (in pixels) of the block-averaged amplifier images
+QA_SAMPLES = 20000
+QA_THUMB_SIZE = 512
+
+@GMOS_instrumentation.instrument
 def visualize_bias(biasfile, out_filename):
     fig, ax_list = plt.subplots(nrows=1, ncols=12, sharey=True, figsize=[10, 7])
     ofile = fits.open(biasfile)
@@ -33,9 +48,11 @@ def visualize_bias(biasfile, out_filename):
         extnum+=1
     plt.subplots_adjust(wspace=0)
     plt.savefig(out_filename)
+    plt.close(fig)
         
     
 
+@GMOS_instrumentation.instrument
 def visualize_flat(flatfile, out_filename):
     fig, ax_list = plt.subplots(nrows=1, ncols=12, sharey=True, figsize=[10, 7])
     ofile = fits.open(flatfile)
@@ -51,7 +68,9 @@ def visualize_flat(flatfile, out_filename):
         extnum += 1
     plt.subplots_adjust(wspace=0)
     plt.savefig(out_filename)
+    plt.close(fig)
 
+@GMOS_instrumentation.instrument
 def visualize_science(sciencefile, out_filename, remove_overscan=False):
     fig, ax_list = plt.subplots(nrows=1, ncols=12, sharey=True, figsize=[10, 7])
     ofile = fits.open(sciencefile)
@@ -73,7 +92,9 @@ def visualize_science(sciencefile, out_filename, remove_overscan=False):
         ax.set_title('EXT {}'.format(extnum))
         extnum += 1
     plt.savefig(out_filename)
+    plt.close(fig)
 
+@GMOS_instrumentation.instrument
 def comp_to_science(biasfile, flatfile, sciencefile, out_filename, remove_overscan=False):
     fig, ax_list = plt.subplots(nrows=1, ncols=36, sharey=True, figsize=[25, 7])
     #BIAS
@@ -121,6 +142,218 @@ def comp_to_science(biasfile, flatfile, sciencefile, out_filename, remove_oversc
         ax.set_title('SCI {}'.format(extnum))
         extnum += 1
     plt.savefig(out_filename)
+    plt.close(fig)
+
+#---------------------
+#FAST QA RENDERING
+#---------------------
+
+def sampled_zscale(img, header=None, max_samples=QA_SAMPLES):
+    '''
+    zscale limits of an image computed from a strided sample of about max_samples pixels.
+    If header is given, img is unscaled data (e.g. a memory mapped extension opened with
+    do_not_scale_image_data=True) and only the sampled pixels are read and scaled.
+    '''
+    stride = max(1, int(np.ceil(np.sqrt(img.size/float(max_samples)))))
+    sample = img[::stride, ::stride]
+    if header is not None:
+        sample = GMOS_native_reduction.scale_array(sample, header)
+    return zscale(sample)
 
+def block_average(img, factor):
+    '''
+    Average img in factor x factor blocks (rows and columns which don't fill a block are dropped)
+    '''
+    if factor <= 1:
+        return img
+    nrows = img.shape[0]//factor*factor
+    ncols = img.shape[1]//factor*factor
+    return img[:nrows, :ncols].reshape(nrows//factor, factor, ncols//factor, factor).mean(axis=(1, 3))
 
+def amp_thumbnail(img, header=None, max_samples=QA_SAMPLES, thumb_size=QA_THUMB_SIZE):
+    '''
+    Return the (block-averaged image, block factor, vmin, vmax) of an amplifier. If header is
+    given, img is unscaled data which is scaled with its BSCALE and BZERO.
+    '''
+    vmin, vmax = sampled_zscale(img, header, max_samples)
+    factor = max(1, int(np.ceil(max(img.shape)/float(thumb_size))))
+    if header is not None:
+        img = GMOS_native_reduction.scale_array(img, header)
+    thumb = block_average(img, factor)
+    return thumb.astype(np.float32), factor, vmin, vmax
+
+def _qa_sections(ofile, kind, remove_overscan=False):
+    '''
+    Return the (unscaled data, header) of the amplifiers displayed for a file of kind
+    'bias', 'flat', or 'science', trimmed as in visualize_bias, visualize_flat, and
+    visualize_science
+    '''
+    if (kind == 'bias') and (len(ofile) > 13):
+        exts = ofile[1::3]
+    else:
+        exts = ofile[1:]
+    sections = []
+    for extnum, ext in enumerate(exts[:12], 1):
+        img = ext.data
+        if kind == 'bias':
+            if extnum%2 == 0:
+                img = img[unusable_bottom//2:, overscan_size:]
+            else:
+                img = img[unusable_bottom:, :-overscan_size]
+        elif (kind == 'science') and (remove_overscan is True):
+            if extnum%2 == 0:
+                img = img[unusable_bottom:, overscan_size:]
+            else:
+                img = img[unusable_bottom:, :-overscan_size]
+        sections.append((img, ext.header))
+    return sections
 
+def qa_thumbnails(filename, kind, remove_overscan=False, cache_dir=None,
+                  max_samples=QA_SAMPLES, thumb_size=QA_THUMB_SIZE):
+    '''
+    Compute the zscale limits and block-averaged images of the amplifiers of a file
+
+    Input:
+        filename: str
+            bias, flat, or science file
+        kind: str
+            'bias', 'flat', or 'science' (sets the extensions shown and the trimming)
+        remove_overscan: bool
+            trim the overscan and unusable bottom rows of science files
+        cache_dir: str
+            if given, the thumbnails are saved in cache_dir and reused until the file
+            (or the parameters) change
+        max_samples: int
+            number of pixels sampled per amplifier to compute the zscale limits
+        thumb_size: int
+            largest dimension of the block-averaged amplifier images
+    Output:
+        object_name: str
+            OBJECT keyword of the file
+        thumbnails: list
+            (image, block factor, vmin, vmax) of each amplifier
+    '''
+    fstat = os.stat(filename)
+    key = json.dumps([os.path.basename(filename), fstat.st_size, fstat.st_mtime, kind,
+                      remove_overscan, max_samples, thumb_size])
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, '{}.{}.qa.npz'.format(os.path.basename(filename), kind))
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if str(cached['key']) == key:
+                    thumbnails = [(cached['thumb_{}'.format(iamp)], int(cached['factors'][iamp]),
+                                   cached['limits'][iamp][0], cached['limits'][iamp][1])
+                                  for iamp in range(len(cached['factors']))]
+                    return str(cached['object_name']), thumbnails
+    thumbnails = []
+    with fits.open(filename, memmap=True, do_not_scale_image_data=True) as ofile:
+        object_name = ofile[0].header['OBJECT']
+        for img, header in _qa_sections(ofile, kind, remove_overscan):
+            thumbnails.append(amp_thumbnail(img, header, max_samples, thumb_size))
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        arrays = dict(('thumb_{}'.format(iamp), thumb[0]) for iamp, thumb in enumerate(thumbnails))
+        np.savez(cache_file, key=key, object_name=object_name,
+                 factors=np.array([thumb[1] for thumb in thumbnails]),
+                 limits=np.array([thumb[2:] for thumb in thumbnails], dtype=float), **arrays)
+    return object_name, thumbnails
+
+def draw_thumbnails(ax_list, thumbnails, title_prefix):
+    for extnum, (ax, (thumb, factor, vmin, vmax)) in enumerate(zip(ax_list, thumbnails), 1):
+        #extent in the pixels of the full resolution image, so panels share the y axis
+        nrows, ncols = thumb.shape
+        ax.imshow(thumb, cmap='bone', vmin=vmin, vmax=vmax,
+                  extent=[-0.5, ncols*factor-0.5, nrows*factor-0.5, -0.5])
+        ax.set_xticks([])
+        ax.set_title('{} {}'.format(title_prefix, extnum))
+
+def save_figure(fig, out_filename):
+    '''
+    Draw a Figure with the Agg renderer (without pyplot, so nothing is kept open)
+    '''
+    FigureCanvasAgg(fig)
+    fig.savefig(out_filename)
+
+@GMOS_instrumentation.instrument
+def render_qa(filename, out_filename, kind, remove_overscan=False, cache_dir=None,
+              max_samples=QA_SAMPLES, thumb_size=QA_THUMB_SIZE):
+    '''
+    Fast version of visualize_bias, visualize_flat, and visualize_science (selected
+    by kind): the zscale limits are computed from a sample of the pixels and the
+    amplifiers are block-averaged to about thumb_size pixels before they are drawn.
+    See qa_thumbnails for the arguments.
+    '''
+    object_name, thumbnails = qa_thumbnails(filename, kind, remove_overscan, cache_dir,
+                                            max_samples, thumb_size)
+    fig = Figure(figsize=[10, 7])
+    ax_list = fig.subplots(nrows=1, ncols=12, sharey=True)
+    fig.suptitle(object_name)
+    draw_thumbnails(ax_list, thumbnails, 'EXT')
+    if kind in ['bias', 'flat']:
+        fig.subplots_adjust(wspace=0)
+    save_figure(fig, out_filename)
+    return out_filename
+
+@GMOS_instrumentation.instrument
+def render_comparison(biasfile, flatfile, sciencefile, out_filename, remove_overscan=False,
+                      cache_dir=None, max_samples=QA_SAMPLES, thumb_size=QA_THUMB_SIZE):
+    '''
+    Fast version of comp_to_science (see render_qa)
+    '''
+    fig = Figure(figsize=[25, 7])
+    ax_list = fig.subplots(nrows=1, ncols=36, sharey=True)
+    for ipanel, (filename, kind, title_prefix) in enumerate([(biasfile, 'bias', 'BIA'),
+                                                             (flatfile, 'flat', 'FLT'),
+                                                             (sciencefile, 'science', 'SCI')]):
+        object_name, thumbnails = qa_thumbnails(filename, kind, remove_overscan, cache_dir,
+                                                max_samples, thumb_size)
+        draw_thumbnails(ax_list[ipanel::3], thumbnails, title_prefix)
+    fig.suptitle(object_name)
+    save_figure(fig, out_filename)
+    return out_filename
+
+def _render_job(job):
+    render, args = job
+    try:
+        return render(*args), None
+    except Exception as err:
+        return args[1] if render is render_qa else args[3], str(err)
+
+@GMOS_instrumentation.instrument
+def render_qa_files(jobs, nprocesses=1, cache_dir=None, remove_overscan=False):
+    '''
+    Render the QA figures of many files on a pool of processes
+
+    Input:
+        jobs: list
+            (kind, filename, out_filename) tuples where kind is 'bias', 'flat' or 'science',
+            or ('comparison', biasfile, flatfile, sciencefile, out_filename) tuples
+        nprocesses: int
+            number of figures rendered at the same time
+        cache_dir: str
+            directory where the zscale limits and thumbnails of each file are cached
+        remove_overscan: bool
+            trim the overscan of science files
+    Output:
+        failed: list
+            (out_filename, error message) of the figures which could not be rendered
+    '''
+    GMOS_instrumentation.add_fields(files=len(jobs))
+    full_jobs = []
+    for job in jobs:
+        if job[0] == 'comparison':
+            full_jobs.append((render_comparison, tuple(job[1:]) + (remove_overscan, cache_dir)))
+        else:
+            kind, filename, out_filename = job
+            full_jobs.append((render_qa, (filename, out_filename, kind, remove_overscan, cache_dir)))
+    if (nprocesses > 1) and (len(full_jobs) > 1):
+        pool = Pool(nprocesses)
+        try:
+            results = pool.map(_render_job, full_jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_render_job(job) for job in full_jobs]
+    return [(out_filename, err) for out_filename, err in results if err is not None]
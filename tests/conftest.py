@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+#The pipeline modules are top-level scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def mosaic_night(tmp_path_factory):
+    '''
+    One synthetic mosaicked science frame (with its raw frame and star catalog)
+    '''
+    GMOS_synthetic = pytest.importorskip('GMOS_synthetic')
+    directory = str(tmp_path_factory.mktemp('mosaic_night'))
+    return GMOS_synthetic.make_night(directory, nbias=0, nflat=0, nscience=1, mosaics=True,
+                                     index=False)
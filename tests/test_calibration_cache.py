@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import GMOS_calibration_cache
+
+
+def _write_master(filename, key):
+    fits.PrimaryHDU(np.zeros((16, 16), dtype=np.float32)).writeto(filename)
+    GMOS_calibration_cache.write_key(filename, key)
+
+
+def test_store_keeps_new_master_when_cache_is_full(tmp_path):
+    cache = GMOS_calibration_cache.CalibrationCache(str(tmp_path / 'cache'), max_size=1)
+    for key in ['first', 'second']:
+        filename = str(tmp_path / '{}.fits'.format(key))
+        _write_master(filename, key)
+        cache.store(key, filename)
+        assert cache.lookup(key) == cache.path(key)
+    assert cache.lookup('first') is None
+    master_filename = str(tmp_path / 'MCbias.fits')
+    assert GMOS_calibration_cache.reuse_master(master_filename, 'second', cache=cache)
+    assert GMOS_calibration_cache.read_key(master_filename) == 'second'
+
+
+def test_evict_ignores_files_removed_by_other_processes(tmp_path, monkeypatch):
+    cache = GMOS_calibration_cache.CalibrationCache(str(tmp_path / 'cache'), max_age=0)
+    filename = str(tmp_path / 'old.fits')
+    _write_master(filename, 'old')
+    cache.store('old', filename)
+    os.utime(cache.path('old'), (0, 0))
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda path: listdir(path) + ['removed.fits'])
+    cache.evict()
+    assert cache.lookup('old') is None
+    assert not GMOS_calibration_cache.reuse_master(str(tmp_path / 'MCbias.fits'), 'old', cache=cache)
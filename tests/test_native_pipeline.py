@@ -0,0 +1,101 @@
+'''
+Smoke tests of the native reduction chain (combine, reduce, mosaic, photometry) on a
+small synthetic night
+'''
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+GMOS_synthetic = pytest.importorskip('GMOS_synthetic')
+import GMOS_native_combine
+import GMOS_native_reduction
+import GMOS_native_mosaic
+
+BINNING = 4
+SKY = 200.
+
+
+@pytest.fixture(scope='module')
+def night(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp('night'))
+    return GMOS_synthetic.make_night(directory, binning=BINNING, nbias=3, nflat=3, nscience=2,
+                                     sky=SKY, index=False)
+
+
+@pytest.fixture(scope='module')
+def products(night, tmp_path_factory):
+    '''
+    Master calibrations, reduced and mosaicked science frames, written outside the night
+    '''
+    output_dir = str(tmp_path_factory.mktemp('products'))
+    bias = os.path.join(output_dir, 'MCbias.fits')
+    flat = os.path.join(output_dir, 'MCflat.fits')
+    GMOS_native_combine.make_master_bias(night['bias'], bias)
+    GMOS_native_combine.make_master_flat(night['flat'], flat, bias=bias)
+    reduced = GMOS_native_reduction.reduce_frames(night['science'], bias=bias, flat=flat,
+                                                  output_dir=output_dir)
+    mosaics = GMOS_native_mosaic.mosaic_frames(reduced)
+    return {'bias':bias, 'flat':flat, 'reduced':reduced, 'mosaics':mosaics}
+
+
+def _planes(filename, extname):
+    with fits.open(filename) as ofile:
+        return [hdu.data for hdu in ofile[1:] if hdu.header.get('EXTNAME') == extname]
+
+
+def test_master_calibrations(night, products):
+    layout = GMOS_synthetic.amp_layout(BINNING)
+    with fits.open(products['bias']) as ofile:
+        assert ofile[0].header['NCOMBINE'] == len(night['bias'])
+    bias = np.array(_planes(products['bias'], 'SCI'))
+    assert bias.shape == (GMOS_synthetic.NAMPS, layout['rows'], layout['data_columns'])
+    flat = np.array(_planes(products['flat'], 'SCI'))
+    flat_dq = np.array(_planes(products['flat'], 'DQ'))
+    assert flat.shape == bias.shape
+    good = flat[flat_dq == 0]
+    assert np.all(np.isfinite(good))
+    mean, median, std = GMOS_native_reduction.clipped_stats(good)
+    assert abs(mean - 1.) < 0.01
+
+
+def test_reduced_frames(night, products):
+    for raw, reduced in zip(night['science'], products['reduced']):
+        assert os.path.dirname(reduced) == os.path.dirname(products['bias'])
+        assert os.path.basename(reduced) == 'rg' + os.path.basename(raw)
+        sci = np.array(_planes(reduced, 'SCI'))
+        var = np.array(_planes(reduced, 'VAR'))
+        dq = np.array(_planes(reduced, 'DQ'))
+        assert sci.shape == var.shape == dq.shape
+        assert sci.shape[0] == GMOS_synthetic.NAMPS
+        assert np.all(var[dq == 0] > 0)
+        assert abs(np.median(sci[dq == 0]) - SKY) < 0.05*SKY
+
+
+def test_mosaicked_frames(products):
+    layout = GMOS_synthetic.amp_layout(BINNING)
+    for mosaic in products['mosaics']:
+        with fits.open(mosaic) as ofile:
+            assert [hdu.header.get('EXTNAME') for hdu in ofile[1:]] == ['SCI', 'VAR', 'DQ']
+            sci = ofile['SCI'].data
+            dq = ofile['DQ'].data
+        assert abs(sci.shape[0] - layout['mosaic_shape'][0]) <= 2
+        assert sci.shape[1] >= layout['mosaic_shape'][1] - 2
+        assert abs(np.median(sci[dq == 0]) - SKY) < 0.05*SKY
+
+
+def test_curve_of_growth_on_mosaic(night, products):
+    pytest.importorskip('photutils')
+    pytest.importorskip('visualization')
+    import GMOS_photometry
+    with GMOS_photometry.PhotometrySession(products['mosaics'][0]) as session:
+        x, y, ra, dec = session.detect_sources()
+        assert len(x) > 10
+        cog = session.curve_of_growth(np.column_stack([x, y]), radii=[2., 4., 6.], bkg_r_in=8.,
+                                      bkg_r_out=12.)
+    assert cog.shape == (len(x), 3)
+    assert np.all(cog['area'][:, 1:] > cog['area'][:, :-1])
+    bright = np.argsort(cog['flux'][:, -1])[-5:]
+    assert np.all(cog['flux'][bright, -1] >= cog['flux'][bright, 0])
+    assert np.all(np.abs(cog['bkg'][cog['nbad'][:, -1] == 0, -1] - SKY) < 0.1*SKY)
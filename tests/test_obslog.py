@@ -0,0 +1,56 @@
+import os
+import sqlite3
+
+import GMOS_obslog
+
+
+def _write_obslog(db_file, dates):
+    conn = sqlite3.connect(db_file)
+    with conn:
+        GMOS_obslog._create_tables(conn)
+        conn.executemany('''INSERT INTO obslog (use_me, File, ObsType, Object, Instrument, CcdBin, RoI, DateObs)
+                            VALUES (1, ?, 'BIAS', 'Bias', 'GMOS-S', '2 2', 'Full', ?)''',
+                         [('S{}S{:04d}'.format(date.replace('-', ''), i), date) for i, date in enumerate(dates)])
+    conn.close()
+
+
+def test_select_calibrations_closest_dates(tmp_path):
+    db_file = str(tmp_path / 'obsLog.sqlite3')
+    _write_obslog(db_file, ['2017-08-01', '2018-08-20', '2018-08-30', '2018-08-30', '2018-09-02',
+                            '2018-09-10'])
+    qd = {'Instrument':'GMOS-S', 'CcdBin':'2 2', 'RoI':'Full', 'DateObs':'2018-09-01:2018-09-03'}
+    mtime = os.path.getmtime(db_file)
+    files, date_range = GMOS_obslog.select_calibrations('bias', qd, db_file, min_frames=2, limits={})
+    assert files == ['S20180902S0004', 'S20180830S0002', 'S20180830S0003']
+    assert date_range == '2018-08-30:2018-09-03'
+    files, date_range = GMOS_obslog.select_calibrations('bias', qd, db_file, min_frames=10,
+                                                        max_lookback=12, limits={})
+    assert files == ['S20180902S0004', 'S20180830S0002', 'S20180830S0003', 'S20180820S0001']
+    files, date_range = GMOS_obslog.select_calibrations('bias', qd, db_file, min_frames=10,
+                                                        max_lookback=11, limits={})
+    assert 'S20180820S0001' not in files
+    assert os.path.getmtime(db_file) == mtime
+
+
+def test_date_range_uses_index(tmp_path, monkeypatch):
+    db_file = str(tmp_path / 'obsLog.sqlite3')
+    _write_obslog(db_file, ['2018-09-02'])
+    statements = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(GMOS_obslog.sqlite3, 'connect', traced_connect)
+    qd = {'Instrument':'GMOS-S', 'CcdBin':'2 2', 'RoI':'Full', 'DateObs':'2018-09-01:2018-09-03'}
+    GMOS_obslog.select_calibrations('bias', qd, db_file, limits={})
+    monkeypatch.undo()
+    assert not any(statement.startswith('CREATE') for statement in statements)
+    selection = [statement for statement in statements if statement.lstrip().startswith('SELECT File, DateObs')]
+    assert len(selection) == 1
+    conn = sqlite3.connect(db_file)
+    plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + selection[0])]
+    conn.close()
+    assert any(('obslog_calib' in detail) and ('DateObs>' in detail) for detail in plan)
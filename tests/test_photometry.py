@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('photutils')
+pytest.importorskip('visualization')
+
+import GMOS_photometry
+
+
+def test_curve_of_growth_counts_flagged_pixels():
+    data = np.full((64, 64), 10.)
+    dq = np.zeros(data.shape, dtype=np.uint16)
+    dq[30:35, 30:35] = 1
+    cog = GMOS_photometry.curve_of_growth(data, [32., 32.], radii=[4, 6, 8], bkg_r_in=12.,
+                                          bkg_r_out=16., dq=dq)
+    assert cog['nbad'].tolist() == [[25, 25, 25]]
+    np.testing.assert_allclose(cog['bkg'], 10.)
+    np.testing.assert_allclose(cog['flux'], 0., atol=1e-8)
+
+
+def test_curve_of_growth_rejects_unsorted_radii():
+    data = np.zeros((32, 32))
+    with pytest.raises(ValueError):
+        GMOS_photometry.curve_of_growth(data, [16., 16.], radii=[6, 4])
+    with pytest.raises(ValueError):
+        GMOS_photometry.curve_of_growth(data, [16., 16.], radii=[2, 4], bkg_r_in=10., bkg_r_out=8.)
+
+
+def test_field_zeropoint(mosaic_night):
+    import GMOS_synthetic
+    m_zpt, m_zpt_err, matches = GMOS_photometry.field_zeropoint(mosaic_night['mosaic'][0],
+                                                               mosaic_night['catalog'], 'mag')
+    assert matches['used'].sum() > 10
+    assert abs(m_zpt - GMOS_synthetic.ZEROPOINT) < 0.05
+
+
+def test_field_zeropoint_without_matches(mosaic_night, tmp_path):
+    from astropy import table
+    catalog = table.Table.read(mosaic_night['catalog'])
+    catalog['dec'] += 1.
+    catalog_filename = str(tmp_path / 'offset_stars.ecsv')
+    catalog.write(catalog_filename)
+    with pytest.raises(ValueError):
+        GMOS_photometry.field_zeropoint(mosaic_night['mosaic'][0], catalog_filename, 'mag')
+
+
+def test_aperture_photometry_matches_curve_of_growth(mosaic_night):
+    with GMOS_photometry.PhotometrySession(mosaic_night['mosaic'][0]) as session:
+        x, y, ra, dec = session.detect_sources()
+        positions = np.column_stack([x, y])
+        cog = session.curve_of_growth(positions, radii=[6.])[:, 0]
+        brightest = np.argmax(cog['flux'])
+        phot_table, apertures = session.aperture_photometry(x[brightest], y[brightest],
+                                                            aperture_radii=[6.])
+    assert len(apertures) == 2
+    np.testing.assert_allclose(phot_table['aperture_sum_0_bkg_sub'][0], cog['flux'][brightest],
+                               rtol=0.01)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('photutils')
+pytest.importorskip('visualization')
+
+from astropy import table
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import GMOS_photometry_store
+
+
+def _bright_stars(mosaic_night, nstars=2):
+    filename = mosaic_night['mosaic'][0]
+    stars = table.Table.read(mosaic_night['catalog'])
+    with fits.open(filename) as ofile:
+        shape = ofile['SCI'].data.shape
+        x, y = WCS(ofile['SCI'].header).all_world2pix(stars['ra'], stars['dec'], 0)
+    inside = (x > 100) & (x < shape[1] - 100) & (y > 100) & (y < shape[0] - 100)
+    stars = stars[inside]
+    stars.sort('mag')
+    return stars[:nstars]
+
+
+def test_measurements_are_keyed_by_position(mosaic_night, tmp_path):
+    filename = mosaic_night['mosaic'][0]
+    first, second = _bright_stars(mosaic_night)
+    radii = [4., 8.]
+    with GMOS_photometry_store.PhotometryStore(str(tmp_path / 'photometry.sqlite3')) as store:
+        summary = store.measure([filename], 'star', ra=first['ra'], dec=first['dec'], aperture_radii=radii)
+        assert summary['measured'] == [filename]
+        summary = store.measure([filename], 'star', ra=first['ra'], dec=first['dec'], aperture_radii=radii)
+        assert summary['cached'] == [filename]
+        summary = store.measure([filename], 'star', ra=second['ra'], dec=second['dec'], aperture_radii=radii)
+        assert summary['measured'] == [filename]
+        first_curve = store.light_curve('star', ra=first['ra'], dec=first['dec'], aperture_radii=radii)
+        second_curve = store.light_curve('star', ra=second['ra'], dec=second['dec'], aperture_radii=radii)
+    assert len(first_curve) == len(second_curve) == len(radii)
+    assert np.hypot(first_curve['xcen'][0] - second_curve['xcen'][0],
+                    first_curve['ycen'][0] - second_curve['ycen'][0]) > 10
+    assert first_curve['flux'][-1] > second_curve['flux'][-1]